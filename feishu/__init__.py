@@ -1,3 +1,13 @@
 from .identification import Identification
 from .spreadsheet import SpreadSheet
-from .message import Message
+from .pool import SpreadSheetPool, open
+from .message import Message, MessageQueue
+from .snapshot import DiffWriter
+from .sheet_index import SheetIndex
+from .watcher import SheetWatcher, watch
+from .profiler import profile
+from .metrics import MetricsCollector
+from .transport import SingleFlight, CredentialPool
+from .transfer import transfer
+from .mirror import SheetMirror
+from .sheet_view import SheetView
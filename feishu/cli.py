@@ -0,0 +1,403 @@
+import os
+import csv
+import sys
+import json
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from .spreadsheet import cell_to_xy, xy_to_cell, import_optional, WRITE_MAX_ROWS
+from . import pool
+from .transfer import transfer
+
+logger = logging.getLogger(__name__)
+
+
+# 0. Common
+FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+def parse_sheet(sheet):
+    """
+    命令行中的sheet：纯数字表示sheet_index，否则为sheet_title或sheet_id
+    """
+    return int(sheet) if sheet.lstrip('-').isdigit() else sheet
+
+
+def guess_format(path, fmt=None):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    fmt = {'json': 'jsonl', 'ndjson': 'jsonl', 'pq': 'parquet'}.get(ext, ext)
+    assert fmt in FORMATS, f'无法从文件名{path}判断格式，请通过--format指定：{FORMATS}'
+    return fmt
+
+
+def is_empty(row):
+    return all(v is None or v == '' for v in row)
+
+
+def open_spreadsheet(token, args):
+    return pool.open(token, user_access_token=args.user_access_token)
+
+
+def resolve_range(spsh, sheet_id, range_):
+    """
+    :param range_: 形如'A1:F1000'，或只指定左上角'B2'，为None时取整个sheet
+    :return: (cell_start, cell_end, 是否指定了右下角)
+    """
+    cell_start, _, cell_end = (range_ or 'A1').partition(':')
+    if cell_end:
+        return cell_start, cell_end, True
+    grid_properties = spsh.sheets[spsh.sheet_id2index[sheet_id]]['grid_properties']
+    cell_end = xy_to_cell(grid_properties['row_count'] - 1, grid_properties['column_count'] - 1)
+    return cell_start, cell_end, False
+
+
+class Checkpoint(object):
+    """
+    断点文件：每完成1块保存1次进度，--resume时从上次完成的位置继续，全部完成后删除
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        return None
+
+    def save(self, state):
+        if self.path:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# 1. 文件读写
+class RowWriter(object):
+    """
+    按行流式写入CSV/JSONL/Parquet文件，path为'-'时写到标准输出(仅CSV/JSONL)
+    Parquet依赖pyarrow，列统一保存为字符串
+    """
+    def __init__(self, path, fmt, append=False):
+        self.path = path
+        self.fmt = fmt
+        self.header = None
+        if fmt == 'parquet':
+            assert path != '-', 'Parquet不支持输出到标准输出'
+            assert not append, 'Parquet不支持--resume'
+            pyarrow = import_optional('pyarrow', '导出Parquet')
+            import pyarrow.parquet
+            self.pa, self.pq = pyarrow, pyarrow.parquet
+            self.parquet_writer = None
+        elif path == '-':
+            self.f = sys.stdout
+        else:
+            self.f = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+        if fmt == 'csv':
+            self.csv_writer = csv.writer(self.f)
+
+    def write_header(self, header, write=True):
+        """
+        :param header: 空列名用列号代替，比如'C'
+        :param write: CSV是否写出表头行
+        :return:
+        """
+        self.header = [x if x not in (None, '') else xy_to_cell(0, i).rstrip('1') for i, x in enumerate(header)]
+        if self.fmt == 'csv' and write:
+            self.csv_writer.writerow(header)
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        if self.fmt == 'csv':
+            self.csv_writer.writerows([['' if v is None else v for v in row] for row in rows])
+        elif self.fmt == 'jsonl':
+            self.f.writelines(json.dumps(dict(zip(self.header, row)), ensure_ascii=False, default=str) + '\n'
+                              for row in rows)
+        else:
+            pa = self.pa
+            columns = [pa.array([None if row[i] is None else str(row[i]) for row in rows], type=pa.string())
+                       for i in range(len(self.header))]
+            table = pa.Table.from_arrays(columns, names=[str(x) for x in self.header])
+            if self.parquet_writer is None:
+                self.parquet_writer = self.pq.ParquetWriter(self.path, table.schema)
+            self.parquet_writer.write_table(table)
+
+    def tell(self):
+        """
+        :return: 已写入的字节数，用于断点续传时截断未完成的部分
+        """
+        if self.fmt == 'parquet' or self.path == '-':
+            return None
+        self.f.flush()
+        return self.f.tell()
+
+    def close(self):
+        if self.fmt == 'parquet':
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+        elif self.path != '-':
+            self.f.close()
+        else:
+            self.f.flush()
+
+
+def iter_file_chunks(path, fmt, chunk_size, has_header=True):
+    """
+    流式读取CSV/JSONL/Parquet文件，每次chunk_size行
+    :return: 迭代器，每个元素为(表头, 二维数组)，没有表头时表头为None
+    """
+    if fmt == 'csv':
+        reader = pd.read_csv(path, chunksize=chunk_size, header=0 if has_header else None, dtype=object,
+                             keep_default_na=False)
+    elif fmt == 'jsonl':
+        reader = pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False)
+    else:
+        import_optional('pyarrow', '导入Parquet')
+        import pyarrow.parquet
+        reader = (batch.to_pandas() for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size))
+    for df in reader:
+        df = df.astype(object).where(df.notna(), None)
+        yield (list(df.columns) if has_header else None), [list(row) for row in df.itertuples(index=False)]
+
+
+# 2. 写入sheet
+def write_chunks(spsh, sheet_id, chunks, x_start, y_start, max_workers=4, on_progress=None):
+    """
+    把按顺序产生的数据块并发写入sheet：主线程按需扩展sheet行列后提交写入，最多同时有max_workers块在写入
+    :param chunks: 迭代器，每个元素为二维数组
+    :param x_start: 第1块的起始行号
+    :param y_start:
+    :param max_workers:
+    :param on_progress: 函数，on_progress(rows)，rows为从第1块开始连续写完的行数，用于保存断点
+    :return: 写入的总行数
+    """
+    x, done = x_start, 0
+    pending = deque()           # [(行数, future), ...]，按提交顺序
+
+    def finish_first():
+        nonlocal done
+        n, future = pending.popleft()
+        future.result()
+        done += n
+        if on_progress:
+            on_progress(done)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for values in chunks:
+            if not values:
+                continue
+            values = [list(row) for row in values]
+            spsh._ensure_grid(x + len(values), y_start + max(len(row) for row in values), sheet_id)
+            pending.append((len(values), executor.submit(spsh._write_block, values, x, y_start, sheet_id)))
+            x += len(values)
+            while pending and (len(pending) >= max_workers or pending[0][1].done()):
+                finish_first()
+        while pending:
+            finish_first()
+    return done
+
+
+# 3. 命令
+def cmd_sheets(args):
+    spsh = open_spreadsheet(args.token, args)
+    sheets = [{'index': x['index'], 'sheet_id': x['sheet_id'], 'title': x['title'],
+               'row_count': x.get('grid_properties', {}).get('row_count'),
+               'column_count': x.get('grid_properties', {}).get('column_count'),
+               'hidden': x.get('hidden', False)} for _, x in sorted(spsh.sheets.items())]
+    if args.json:
+        print(json.dumps({'title': spsh.title, 'url': spsh.spreadsheet_url, 'sheets': sheets}, ensure_ascii=False))
+        return
+    print(f'{spsh.title}  {spsh.spreadsheet_url}')
+    print(f'{"index":>5}  {"sheet_id":<12}{"rows":>8}{"columns":>9}  title')
+    for x in sheets:
+        print(f'{x["index"]:>5}  {x["sheet_id"]:<12}{x["row_count"] or "":>8}{x["column_count"] or "":>9}  {x["title"]}')
+
+
+def cmd_export(args):
+    fmt = guess_format(args.output, args.format)
+    spsh = open_spreadsheet(args.token, args)
+    sheet = parse_sheet(args.sheet)
+    sheet_id = spsh.sheet_index2id.get(sheet, spsh.sheet_title2id.get(sheet, sheet))
+    cell_start, cell_end, explicit = resolve_range(spsh, sheet_id, args.range)
+    (x_start, y_start), (x_end, y_end) = cell_to_xy(cell_start), cell_to_xy(cell_end)
+    chunk_size = min(args.chunk_size, WRITE_MAX_ROWS)
+
+    checkpoint = Checkpoint(None if args.output == '-' else args.checkpoint or f'{args.output}.resume.json')
+    state = checkpoint.load() if args.resume else None
+    if state:
+        with open(args.output, 'r+b') as f:        # 丢弃上次最后1个断点之后写入的内容
+            f.truncate(state['offset'])
+        logger.info(f'Resume Export: {args.output}, from row {state["row"]}')
+    else:
+        state = {'row': x_start, 'offset': 0, 'pending': 0, 'header': None, 'rows': 0, 'n_cols': y_end - y_start + 1}
+    writer = RowWriter(args.output, fmt, append=state['offset'] > 0)
+    if state['header'] is not None:
+        writer.header = state['header']
+    elif args.no_header:
+        writer.write_header([None] * state['n_cols'], write=False)
+        state['header'] = writer.header
+
+    chunks = spsh._iter_range_chunks(xy_to_cell(state['row'], y_start), xy_to_cell(x_end, y_end), sheet_id,
+                                     chunk_size, args.concurrency)
+    for x, values in chunks:
+        n_rows, rows = min(x_end, x + chunk_size - 1) - x + 1, []
+        for i in range(n_rows):
+            row = list(values[i]) if i < len(values) and values[i] else []
+            if state['header'] is None:
+                header = row + [None] * (state['n_cols'] - len(row))
+                if not explicit:        # 没指定范围时，去掉表头右侧的空列
+                    while len(header) > 1 and header[-1] in (None, ''):
+                        header.pop()
+                state['n_cols'] = len(header)
+                writer.write_header(header)
+                state['header'] = writer.header
+                continue
+            row = row[: state['n_cols']] + [None] * (state['n_cols'] - len(row))
+            if is_empty(row):           # 空行先暂存，后面还有数据时才写出，从而去掉末尾的空行
+                state['pending'] += 1
+                continue
+            rows.extend([[None] * state['n_cols']] * state['pending'] + [row])
+            state['pending'] = 0
+        writer.write_rows(rows)
+        state['rows'] += len(rows)
+        state['row'] = x + n_rows
+        state['offset'] = writer.tell()
+        if state['offset'] is not None:
+            checkpoint.save(state)
+    writer.close()
+    checkpoint.remove()
+    logger.info(f'Export Successfully: {args.output}, {state["rows"]} rows')
+    if args.output != '-':
+        print(f'Export Successfully: {args.output}, {state["rows"]} rows')
+
+
+def cmd_import(args):
+    fmt = guess_format(args.input, args.format)
+    spsh = open_spreadsheet(args.token, args)
+    sheet = parse_sheet(args.sheet)
+    sheet_id = spsh.sheet_index2id.get(sheet, spsh.sheet_title2id.get(sheet, sheet))
+    x0, y0 = cell_to_xy(args.cell_start)
+    chunk_size = min(args.chunk_size, WRITE_MAX_ROWS)
+
+    checkpoint = Checkpoint(args.checkpoint or f'{args.input}.resume.json')
+    state = checkpoint.load() if args.resume else None
+    skip = 0
+    if state:
+        assert state['chunk_size'] == chunk_size, f'--resume时--chunk-size需要与上次一致：{state["chunk_size"]}'
+        skip = state['rows']
+        logger.info(f'Resume Import: {args.input}, from row {skip}')
+    state = {'rows': skip, 'chunk_size': chunk_size}
+    x_start = x0 + (0 if args.no_header else 1)
+
+    def chunks():
+        n = 0
+        for header, values in iter_file_chunks(args.input, fmt, chunk_size, has_header=not args.no_header):
+            if n == 0 and header is not None and skip == 0:
+                spsh._ensure_grid(x0 + 1, y0 + len(header), sheet_id)
+                spsh._write_block([header], x0, y0, sheet_id)
+            n += len(values)
+            if n <= skip:
+                continue
+            yield values
+
+    def on_progress(rows):
+        state['rows'] = skip + rows
+        checkpoint.save(state)
+
+    rows = write_chunks(spsh, sheet_id, chunks(), x_start + skip, y0, args.concurrency, on_progress)
+    checkpoint.remove()
+    logger.info(f'Import Successfully: {args.input}, {skip + rows} rows')
+    print(f'Import Successfully: {args.input}, {skip + rows} rows')
+
+
+def cmd_copy(args):
+    src = open_spreadsheet(args.src_token, args)
+    dst = open_spreadsheet(args.dst_token, args) if args.dst_token != args.src_token else src
+    src_sheet, dst_sheet = parse_sheet(args.sheet), parse_sheet(args.dst_sheet)
+    src_id = src.sheet_index2id.get(src_sheet, src.sheet_title2id.get(src_sheet, src_sheet))
+    dst_id = dst.sheet_index2id.get(dst_sheet, dst.sheet_title2id.get(dst_sheet, dst_sheet))
+
+    checkpoint = Checkpoint(args.checkpoint or f'.feishu_copy_{args.src_token}_{src_id}_{args.dst_token}_{dst_id}.json')
+    state = checkpoint.load() if args.resume else None
+    skip = state['rows'] if state else 0
+    if skip:
+        logger.info(f'Resume Copy: from row {skip}')
+
+    stats = transfer(src, dst, src_id, dst_id, args.range, args.dst_cell, args.chunk_size,
+                     read_workers=args.concurrency, write_workers=args.concurrency, queue_size=2 * args.concurrency,
+                     skip_rows=skip, on_progress=lambda rows: checkpoint.save({'rows': rows}))
+    checkpoint.remove()
+    logger.info(f'Copy Successfully: {skip + stats["rows"]} rows')
+    print(f'Copy Successfully: {skip + stats["rows"]} rows')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m feishu', description='飞书表格命令行工具：导出、导入、复制sheet，查看sheet信息')
+    parser.add_argument('--user-access-token', default=None, help='默认通过Identification从配置中心获取')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出INFO日志')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_transfer_args(sub):
+        sub.add_argument('--concurrency', type=int, default=4, help='并发读写的块数')
+        sub.add_argument('--chunk-size', type=int, default=1000, help=f'每块的行数，最多{WRITE_MAX_ROWS}')
+        sub.add_argument('--resume', action='store_true', help='从上次中断的位置继续')
+        sub.add_argument('--checkpoint', default=None, help='断点文件路径')
+
+    sub = subparsers.add_parser('sheets', help='列出所有sheet的元数据')
+    sub.add_argument('token', help='spreadsheet_token')
+    sub.add_argument('--json', action='store_true', help='输出JSON')
+    sub.set_defaults(func=cmd_sheets)
+
+    sub = subparsers.add_parser('export', help='sheet导出为CSV/Parquet/JSONL')
+    sub.add_argument('token', help='spreadsheet_token')
+    sub.add_argument('-o', '--output', required=True, help="输出文件，'-'表示标准输出")
+    sub.add_argument('--sheet', default='0', help='sheet_index、sheet_title或sheet_id，默认第1个sheet')
+    sub.add_argument('--range', default=None, help="如'A1:F1000'，或只指定左上角'B2'，默认整个sheet")
+    sub.add_argument('--format', choices=FORMATS, default=None, help='默认按文件扩展名判断')
+    sub.add_argument('--no-header', action='store_true', help='范围内第1行不是表头')
+    add_transfer_args(sub)
+    sub.set_defaults(func=cmd_export)
+
+    sub = subparsers.add_parser('import', help='CSV/Parquet/JSONL导入sheet')
+    sub.add_argument('input', help='输入文件')
+    sub.add_argument('token', help='spreadsheet_token')
+    sub.add_argument('--sheet', default='0', help='sheet_index、sheet_title或sheet_id，默认第1个sheet')
+    sub.add_argument('--cell-start', default='A1', help='写入位置左上角')
+    sub.add_argument('--format', choices=FORMATS, default=None, help='默认按文件扩展名判断')
+    sub.add_argument('--no-header', action='store_true', help='CSV没有表头，不写表头')
+    add_transfer_args(sub)
+    sub.set_defaults(func=cmd_import)
+
+    sub = subparsers.add_parser('copy', help='sheet复制到另一个sheet(可以跨表格)')
+    sub.add_argument('src_token', help='源spreadsheet_token')
+    sub.add_argument('dst_token', help='目标spreadsheet_token')
+    sub.add_argument('--sheet', default='0', help='源sheet')
+    sub.add_argument('--dst-sheet', default='0', help='目标sheet')
+    sub.add_argument('--range', default=None, help="源范围，如'A1:F1000'，默认整个sheet")
+    sub.add_argument('--dst-cell', default='A1', help='写入位置左上角')
+    add_transfer_args(sub)
+    sub.set_defaults(func=cmd_copy)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        args.func(args)
+    except (AssertionError, ValueError, ImportError) as e:
+        logger.error(f'{args.command} Failed: {e}')
+        print(f'{args.command} failed: {e}', file=sys.stderr)
+        return 1
+    return 0
@@ -1,4 +1,19 @@
-import requests
+import logging
+import threading
+import time
+import re
+import json
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+
+from . import transport
+
+logger = logging.getLogger(__name__)
+
+
+# 0. Common
+PERM_LEVELS = {'view': 1, 'edit': 2, 'full_access': 3}    # 协作者权限由低到高
+LISTED_MEMBER_TYPES = ('openid', 'unionid', 'userid', 'openchat', 'opendepartmentid')  # 协作者列表返回的member_type，email等不会出现
 
 
 def get_headers(access_token):
@@ -9,29 +24,222 @@ def get_headers(access_token):
     return headers
 
 
-def add_permission(file_token, file_type, user_access_token, openids=[], emails=[]):
+class RateLimiter(object):
+    """
+    令牌桶限流器，线程安全：每秒最多放行qps个请求，允许最多burst个请求的突发
+    飞书API大多有QPS限制(比如发消息约50次/秒/应用)，并发调用时用它来控制节奏，避免触发限流
+    """
+    def __init__(self, qps=20, burst=None):
+        """
+        :param qps: 每秒放行的请求数
+        :param burst: 令牌桶容量，默认等于qps
+        """
+        self.qps = qps
+        self.burst = burst if burst else qps
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        获取1个令牌，令牌不足时阻塞等待
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.qps)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.qps
+            time.sleep(wait)
+
+
+def iter_json_array(chunks, key):
+    """
+    从JSON字节流中增量解析第1个名为key的数组，逐个yield数组元素，不构建完整的JSON对象树，用于降低大响应的内存峰值
+    解析完成后，用数组之外的部分(很小)检查code，code不为0时抛出异常
+    :param chunks: bytes的迭代器，比如resp.iter_content(chunk_size)
+    :param key: 数组的key，比如'values'
+    :return:
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    chunks = (utf8.decode(x) for x in chunks)
+    buf, head = '', None
+    for chunk in chunks:                    # 1. 找到数组的开头
+        buf += chunk
+        match = pattern.search(buf)
+        if match:
+            head, buf = buf[:match.end() - 1], buf[match.end():]
+            break
+    if head is None:                        # 没有该数组，一般是请求失败，响应很小，直接整体解析
+        resp = json.loads(buf) if buf.strip() else {}
+        if resp.get('code') != 0:
+            raise ValueError(f'Response Error: {resp}')
+        return
+
+    pos, exhausted = 0, False               # 2. 逐个解析数组元素
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            tail = buf[pos + 1:] + ''.join(chunks)
+            break
+        item, end = None, None
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                pass
+        if end is None or (end >= len(buf) and not exhausted):     # 元素不完整(数字等可能被截断)，继续读取
+            if exhausted:
+                raise ValueError(f'Incomplete JSON Response: {buf[pos: pos + 100]}')
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+            else:
+                buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+
+    resp = json.loads(head + '[]' + tail)   # 3. 检查数组之外的部分
+    if resp.get('code') != 0:
+        raise ValueError(f'Response Error: {resp}')
+
+
+def add_permission(file_token, file_type, user_access_token, openids=None, emails=None, perm='view'):
+    """
+    给单个文件添加协作者权限
+    doc: https://open.feishu.cn/document/server-docs/historic-version/docs/drive/permission/add-collaborator-permission
+    :param file_token:
+    :param file_type: doc, sheet, bitable, file等
+    :param user_access_token:
+    :param openids:
+    :param emails:
+    :param perm: view, edit或full_access
+    :return:
+    """
+    members = [('openid', x) for x in openids or []] + [('email', x) for x in emails or []]
+    return _create_permission_members(file_token, file_type, user_access_token,
+                                      [(member_type, member_id, perm) for member_type, member_id in members])
+
+
+def _create_permission_members(file_token, file_type, user_access_token, members):
+    """
+    给单个文件添加多个协作者，1次请求
+    :param members: 形如[(member_type, member_id, perm), ...]
+    :return:
+    """
     body = {
         'token': file_token,
         'type': file_type,
         'members': [
             {
-                'member_type': 'openid',
-                'member_id': x,
-                'perm': 'view'
-            } for x in openids
-        ] + [
-            {
-                'member_type': 'email',
-                'member_id': x,
-                'perm': 'view'
-            } for x in emails
+                'member_type': member_type,
+                'member_id': member_id,
+                'perm': perm
+            } for member_type, member_id, perm in members
         ]
     }
     url = 'https://open.feishu.cn/open-apis/drive/permission/member/create'
-    resp = requests.post(url, json=body, headers=get_headers(user_access_token)).json()
+    resp = transport.post(url, json=body, headers=get_headers(user_access_token)).json()
     return resp
 
 
+def list_permission_members(file_token, file_type, user_access_token):
+    """
+    获取文件的协作者列表
+    doc: https://open.feishu.cn/document/server-docs/docs/permission/permission-member/list
+    :param file_token:
+    :param file_type:
+    :param user_access_token:
+    :return: {(member_type, member_id): perm}，失败时返回None
+    """
+    url = f'https://open.feishu.cn/open-apis/drive/v1/permissions/{file_token}/members'
+    params = {
+        'type': file_type
+    }
+    resp = transport.get(url, params=params, headers=get_headers(user_access_token)).json()
+    if resp['code'] != 0:
+        logger.error(f'List Permission Members Failed: file_token={file_token}, {resp}')
+        return None
+    return {(x['member_type'], x['member_id']): x['perm'] for x in resp['data'].get('items') or []}
+
+
+def add_permissions(file_tokens, file_type, user_access_token, members, perm='view', max_workers=8, rate_limiter=None,
+                    skip_existing=True):
+    """
+    批量添加协作者权限：多个文件 × 多个协作者 × 权限，每个文件1次请求添加所有协作者，多个文件在限流器下并发
+    skip_existing为True时，先获取每个文件已有的协作者，跳过已有同等或更高权限的协作者；
+    协作者列表不返回email，只有member_type在LISTED_MEMBER_TYPES中的协作者才能跳过，email等总是直接添加
+    :param file_tokens: 文件token列表
+    :param file_type: doc, sheet, bitable, file等
+    :param user_access_token:
+    :param members: 形如[('openid', 'ou_xxx'), ('email', 'xxx@xxx.com', 'edit'), ...]，第3个元素为权限，缺省为perm
+    :param perm: 默认权限：view, edit或full_access
+    :param max_workers: 并发线程数
+    :param rate_limiter: RateLimiter实例，默认每秒5个请求
+    :param skip_existing: 是否跳过已有权限的协作者
+    :return: 每个授权的结果，形如{(file_token, member_type, member_id): {'code': 0, 'msg': 'ok', 'perm': 'view'}, ...}，
+             已有权限而跳过的，msg为exists
+    """
+    rate_limiter = rate_limiter if rate_limiter else RateLimiter(qps=5)
+    member2perm = {}                # 同一协作者出现多次时取最高权限
+    for x in members:
+        member_perm = x[2] if len(x) > 2 else perm
+        if PERM_LEVELS[member_perm] > PERM_LEVELS.get(member2perm.get((x[0], x[1])), 0):
+            member2perm[(x[0], x[1])] = member_perm
+    members = [(member_type, member_id, member_perm) for (member_type, member_id), member_perm in member2perm.items()]
+
+    def grant(file_token):
+        results = {}
+        todo = members
+        try:
+            if skip_existing and any(x[0] in LISTED_MEMBER_TYPES for x in members):
+                rate_limiter.acquire()
+                existing = list_permission_members(file_token, file_type, user_access_token) or {}
+                todo = []
+                for member_type, member_id, member_perm in members:
+                    existing_perm = existing.get((member_type, member_id)) if member_type in LISTED_MEMBER_TYPES \
+                        else None
+                    if PERM_LEVELS.get(existing_perm, 0) >= PERM_LEVELS[member_perm]:
+                        results[(file_token, member_type, member_id)] = {'code': 0, 'msg': 'exists',
+                                                                         'perm': existing_perm}
+                    else:
+                        todo.append((member_type, member_id, member_perm))
+            if todo:
+                rate_limiter.acquire()
+                resp = _create_permission_members(file_token, file_type, user_access_token, todo)
+            else:
+                resp = {'code': 0, 'data': {}}
+        except Exception as e:
+            resp = {'code': -1, 'msg': str(e)}
+        if resp['code'] != 0:
+            logger.error(f'Add Permissions Failed: file_token={file_token}, {resp}')
+        failed = {(x['member_type'], x['member_id']) for x in (resp.get('data') or {}).get('fail_members') or []}
+        for member_type, member_id, member_perm in todo:
+            if resp['code'] != 0:
+                result = {'code': resp['code'], 'msg': resp.get('msg'), 'perm': member_perm}
+            elif (member_type, member_id) in failed:
+                result = {'code': -1, 'msg': 'failed', 'perm': member_perm}
+            else:
+                result = {'code': 0, 'msg': 'ok', 'perm': member_perm}
+            results[(file_token, member_type, member_id)] = result
+        return results
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(grant, list(dict.fromkeys(file_tokens))):
+            results.update(result)
+    n_success = sum(1 for x in results.values() if x['code'] == 0)
+    logger.info(f'Add Permissions Finished: {n_success}/{len(results)} succeeded')
+    return results
+
+
 if __name__ == '__main__':
     pass
-
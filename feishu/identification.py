@@ -1,10 +1,13 @@
 import os
+import json
 from urllib.parse import urlencode
-import requests
 import logging
+import threading
 import time
 
+from . import transport
 from .feishu_util import get_headers
+from .profiler import profiled
 from .config_util import config_feishu_read, config_feishu_write
 
 logger = logging.getLogger(__name__)
@@ -16,6 +19,9 @@ APP_SECRET = os.environ.get('FEISHU_APP_SECRET', None)
 REDIRECT_URI = os.environ.get('FEISHU_REDIRECT_URI', None)
 CONFIG_KEY = os.environ.get('FEISHU_CONFIG_KEY', 'yao.liu')
 FEISHU_VERBOSE = os.environ.get('FEISHU_VERBOSE', 'identification')
+# 多个应用，JSON数组，如[{"app_id": "xxx", "app_secret": "xxx", "config_key": "xxx"}, ...]，见identify_apps
+FEISHU_APPS = os.environ.get('FEISHU_APPS', None)
+REFRESH_RETRY_INTERVAL = 60     # refresh user_access_token失败后，多少秒内不再重试
 
 
 def write_config(key, value):
@@ -56,6 +62,8 @@ class Identification(object):
         self.app_secret = app_secret if app_secret else APP_SECRET
         self.api_url = 'https://open.feishu.cn/open-apis'
         self.redirect_uri = redirect_uri if redirect_uri else REDIRECT_URI
+        self.lock = threading.Lock()        # 多个线程同时发现token过期时只refresh 1次
+        self.refresh_retry_at = 0           # refresh失败后，到这个时间(time.monotonic())之前不再重试
         self.headers = {
             'Content-Type': 'application/json; charset=utf-8'
         }
@@ -75,6 +83,7 @@ class Identification(object):
             code_times = int(config['code_times']) + 1
             self.refresh_user_access_token(code_times)        # 重新生成user_access_token等user_xxx变量
 
+    @profiled
     def _get_app_access_token(self):
         """
         1.1 获取app_access_token（企业自建应用）
@@ -87,7 +96,7 @@ class Identification(object):
             'app_id': self.app_id,
             'app_secret': self.app_secret
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -121,6 +130,7 @@ class Identification(object):
         self.code = code
         self._get_user_info()
 
+    @profiled
     def _get_user_info(self):
         """
         1.3 获取user_access_token
@@ -133,7 +143,7 @@ class Identification(object):
             'grant_type': 'authorization_code',
             'code': self.code
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -175,11 +185,13 @@ class Identification(object):
             'code': self.code,
             'code_times': code_times        # 基于最近1次code，refresh tokens的次数
         }
+        self.code_times = code_times
         if FEISHU_VERBOSE in ['identification', 'all']:
             print(f'往配置中心写入配置：config_key={self.config_key}, config_value=\n{values}')
         logger.info(f'往配置中心写入配置：config_key={self.config_key}, config_value=\n{values}')
         write_config(self.config_key, values)
 
+    @profiled
     def refresh_user_access_token(self, code_times):
         """
         1.4 刷新user_access_token   基于user_refresh_token获得新的user_access_token和user_refresh_token
@@ -189,12 +201,16 @@ class Identification(object):
         :return:
         """
         assert int(time.time()) < self.user_refresh_token_expire, 'user_refresh_token已过期，无法refresh，需要重新生成'
+        if int(time.time()) >= getattr(self, 'app_access_token_expire', 0):     # app_access_token有效期2小时，长期运行时先重新获取
+            self.headers.pop('Authorization', None)
+            self._get_app_access_token()
+            self.headers['Authorization'] = f'Bearer {self.app_access_token}'
         url = f'{self.api_url}/authen/v1/refresh_access_token'
         body = {
             'grant_type': 'refresh_token',
             'refresh_token': self.user_refresh_token
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -212,6 +228,28 @@ class Identification(object):
             else:
                 logger.error(f'Refresh User Access Token Failed: {resp}')
 
+    def get_user_access_token(self):
+        """
+        获取有效的user_access_token：已过期(提前2分钟)时先基于user_refresh_token刷新，适合长期运行的服务
+        刷新失败时抛出ValueError，之后REFRESH_RETRY_INTERVAL秒内直接抛出，不再每次调用都重试
+        update: 20261019
+        :return:
+        """
+        if int(time.time()) >= self.user_access_token_expire:
+            with self.lock:
+                if int(time.time()) >= self.user_access_token_expire:
+                    if time.monotonic() < self.refresh_retry_at:
+                        raise ValueError(f'Refresh User Access Token Failed，{REFRESH_RETRY_INTERVAL}秒内不再重试')
+                    try:
+                        self.refresh_user_access_token(self.code_times + 1)
+                    finally:
+                        if int(time.time()) >= self.user_access_token_expire:
+                            self.refresh_retry_at = time.monotonic() + REFRESH_RETRY_INTERVAL
+                    if int(time.time()) >= self.user_access_token_expire:
+                        raise ValueError('Refresh User Access Token Failed')
+        return self.user_access_token
+
+    @profiled
     def get_user_info_identification(self):
         """
         1.5 获取登录用户信息
@@ -221,7 +259,7 @@ class Identification(object):
         """
         headers = get_headers(self.user_access_token)
         url = f'{self.api_url}/authen/v1/user_info'
-        resp = requests.get(url, headers=headers)
+        resp = transport.get(url, headers=headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -230,6 +268,21 @@ class Identification(object):
                 logger.error(f'Get User Info Failed: {resp}')
 
 
+def identify_apps(apps=None):
+    """
+    为多个应用分别初始化Identification，配合transport.CredentialPool把请求分散到多个应用，突破单个应用的QPS配额
+    每个应用需要在配置中心有自己的config_key(保存各自的user_refresh_token)，首次使用同样需要飞书授权获得code
+    update: 20261019
+    :param apps: 形如[{'app_id': 'xxx', 'app_secret': 'xxx', 'config_key': 'xxx'}, ...]，可以包含Identification的其他参数，
+                 默认读取环境变量FEISHU_APPS(JSON)
+    :return: [Identification, ...]
+    """
+    if apps is None:
+        assert FEISHU_APPS, '没有指定apps，也没有设置环境变量FEISHU_APPS！'
+        apps = json.loads(FEISHU_APPS)
+    return [Identification(**app) for app in apps]
+
+
 if __name__ == '__main__':
 
     # 首次使用，需要先初始化
@@ -1,21 +1,50 @@
-import requests
 import logging
+import time
+import queue
+import atexit
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from . import transport
 from .identification import Identification
-from .feishu_util import get_headers
+from .feishu_util import get_headers, RateLimiter
+from .profiler import profiled
 
 logger = logging.getLogger(__name__)
 
 
+# 0. Common
+BATCH_SEND_MAX_NUM = 200        # batch_send单次最多200个open_id/user_id/department_id
+_STOP = object()                # MessageQueue关闭信号
+_queues = weakref.WeakSet()     # 所有未关闭的MessageQueue，弱引用，不影响实例被回收
+
+
+@atexit.register
+def _close_queues():
+    """
+    程序退出时关闭所有MessageQueue：此时线程池已不再接收任务，剩余消息由后台线程直接发送
+    """
+    for mq in list(_queues):
+        mq.close()
+
+
 class Message(object):
-    def __init__(self, tenant_access_token=None):
+    def __init__(self, tenant_access_token=None, qps=20):
+        """
+        :param tenant_access_token:
+        :param qps: 逐条发送时的限流，同一实例的所有并发发送共享这个限流器
+        """
         self.api_url = 'https://open.feishu.cn/open-apis/message/v4'
         if tenant_access_token is None:
             self.idt = Identification()     # TODO 目前Identification不支持tenant_access_token！！！
             tenant_access_token = self.idt.tenant_access_token
         self.tenant_access_token = tenant_access_token
         self.headers = get_headers(self.tenant_access_token)
+        self.rate_limiter = RateLimiter(qps=qps)
 
+    @profiled
     def _send_text(self, text, open_id=None, user_id=None, email=None, chat_id=None, root_id=None, at_user_id=None):
         """
         发送文本消息
@@ -26,7 +55,7 @@ class Message(object):
         :param chat_id:
         :param root_id:
         :param at_user_id:
-        :return:
+        :return: 接口返回结果，code为0表示成功
         """
         url = f'{self.api_url}/send/'
         if at_user_id:
@@ -42,12 +71,244 @@ class Message(object):
                 'text': text
             }
         }
-        resp = requests.post(url, json=body, headers=self.headers).json()
+        resp = transport.post(url, json=body, headers=self.headers).json()
         if resp['code'] == 0:
             message_id = resp['data']['message_id']
             logger.info(f'Send Text Successfully, message_id={message_id}')
         else:
             logger.error(f'Send Text Failed: {resp}')
+        return resp
+
+    @profiled
+    def _batch_send_text(self, text, open_ids=None, user_ids=None, department_ids=None):
+        """
+        批量发送文本消息：一次请求发给多个用户或部门，不支持email和群聊
+        doc: https://open.feishu.cn/document/server-docs/im-v1/batch_message/send-messages-in-batches
+        update: 20261019
+        :param text:
+        :param open_ids: 最多BATCH_SEND_MAX_NUM个，下同
+        :param user_ids:
+        :param department_ids:
+        :return: 接口返回结果，data中包含message_id和invalid_xxx_ids
+        """
+        url = f'{self.api_url}/batch_send/'
+        body = {
+            'open_ids': open_ids or [],
+            'user_ids': user_ids or [],
+            'department_ids': department_ids or [],
+            'msg_type': 'text',
+            'content': {
+                'text': text
+            }
+        }
+        self.rate_limiter.acquire()
+        resp = transport.post(url, json=body, headers=self.headers).json()
+        if resp['code'] == 0:
+            message_id = resp['data']['message_id']
+            logger.info(f'Batch Send Text Successfully, message_id={message_id}')
+        else:
+            logger.error(f'Batch Send Text Failed: {resp}')
+        return resp
+
+    @profiled
+    def send_text_batch(self, text, open_ids=None, user_ids=None, department_ids=None, emails=None, chat_ids=None,
+                        max_workers=8):
+        """
+        给大量用户/部门/群聊发送同一条文本消息
+        open_id, user_id, department_id走batch_send，每BATCH_SEND_MAX_NUM个一次请求；email和chat_id不支持batch_send，
+        在限流器下并发调用_send_text逐条发送
+        update: 20261019
+        :param text:
+        :param open_ids:
+        :param user_ids:
+        :param department_ids:
+        :param emails:
+        :param chat_ids:
+        :param max_workers: 并发线程数
+        :return: 每个接收者的发送结果，形如{('open_id', 'ou_xxx'): {'code': 0, 'msg': 'ok', 'message_id': 'xxx'}, ...}
+        """
+        id_types = {'open_id': open_ids, 'user_id': user_ids, 'department_id': department_ids}
+        batches = []        # [(id_type, ids), ...]
+        for id_type, ids in id_types.items():
+            ids = list(dict.fromkeys(ids or []))        # 去重且保持顺序
+            batches.extend((id_type, ids[i: i + BATCH_SEND_MAX_NUM]) for i in range(0, len(ids), BATCH_SEND_MAX_NUM))
+        singles = [('email', x) for x in dict.fromkeys(emails or [])] + \
+                  [('chat_id', x) for x in dict.fromkeys(chat_ids or [])]
+
+        def send_batch(id_type, ids):
+            try:
+                resp = self._batch_send_text(text, **{f'{id_type}s': ids})
+            except Exception as e:
+                logger.error(f'Batch Send Text Failed: {id_type}s={ids}, error={e}')
+                resp = {'code': -1, 'msg': str(e)}
+            if resp['code'] != 0:
+                return {(id_type, x): {'code': resp['code'], 'msg': resp.get('msg'), 'message_id': None} for x in ids}
+            data = resp['data']
+            invalid = set(data.get(f'invalid_{id_type}s') or [])
+            return {
+                (id_type, x): {'code': -1, 'msg': f'invalid {id_type}', 'message_id': None} if x in invalid else
+                              {'code': 0, 'msg': 'ok', 'message_id': data['message_id']} for x in ids
+            }
+
+        def send_single(id_type, x):
+            self.rate_limiter.acquire()
+            try:
+                resp = self._send_text(text, **{id_type: x})
+            except Exception as e:
+                logger.error(f'Send Text Failed: {id_type}={x}, error={e}')
+                return {(id_type, x): {'code': -1, 'msg': str(e), 'message_id': None}}
+            message_id = resp['data']['message_id'] if resp['code'] == 0 else None
+            return {(id_type, x): {'code': resp['code'], 'msg': resp.get('msg'), 'message_id': message_id}}
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(send_batch, *x) for x in batches] + \
+                      [executor.submit(send_single, *x) for x in singles]
+            for future in futures:
+                results.update(future.result())
+        n_success = sum(1 for x in results.values() if x['code'] == 0)
+        logger.info(f'Send Text Batch Finished: {n_success}/{len(results)} succeeded')
+        return results
+
+
+class MessageQueue(object):
+    """
+    后台异步发送消息：send_text只把消息放入有界队列，立即返回，不会阻塞在飞书请求上
+    后台线程在window秒内把同一接收者的消息合并成1条摘要消息，再交给worker线程在限流器下发送
+    告警风暴时可大幅减少请求数，程序退出时(或调用close时)会把剩余消息全部发出
+    """
+    def __init__(self, message=None, maxsize=10000, window=5, max_workers=4, max_digest_num=50):
+        """
+        :param message: Message实例，默认新建一个
+        :param maxsize: 队列最大长度，队列满时新消息会被丢弃(计入dropped)，而不是阻塞调用方
+        :param window: 合并窗口(秒)，同一接收者第1条消息进入后，window秒内的消息合并发送，为0表示不合并
+        :param max_workers: 发送线程数
+        :param max_digest_num: 1条摘要消息最多列出的不同消息数，超出部分只计数
+        """
+        self.message = message if message else Message()
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.window = window
+        self.max_digest_num = max_digest_num
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.dispatcher = threading.Thread(target=self._dispatch, name='feishu-message-queue', daemon=True)
+        self.dispatcher.start()
+        _queues.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send_text(self, text, open_id=None, user_id=None, email=None, chat_id=None, root_id=None, at_user_id=None):
+        """
+        非阻塞发送文本消息，参数同Message._send_text
+        :return: 是否成功放入队列
+        """
+        key = (open_id, user_id, email, chat_id, root_id, at_user_id)
+        with self.lock:             # 与close互斥，保证放入的消息都在关闭信号之前
+            if self.closed:
+                logger.warning(f'MessageQueue Closed, Message Dropped: {text}')
+                return False
+            try:
+                self.queue.put_nowait((key, text, time.monotonic()))
+                return True
+            except queue.Full:
+                self.dropped += 1
+                dropped = self.dropped
+        logger.warning(f'MessageQueue Full, Message Dropped: dropped={dropped}')
+        return False
+
+    def _dispatch(self):
+        """
+        后台线程：从队列取消息，按接收者分组，窗口到期后合并发送
+        """
+        pending = OrderedDict()     # key -> (第1条消息的时间, OrderedDict(text -> 次数))，按第1条消息的时间排序
+        while True:
+            if pending:
+                first_time = next(iter(pending.values()))[0]
+                timeout = max(0, first_time + self.window - time.monotonic())
+            else:
+                timeout = None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                key, text, put_time = item
+                if key not in pending:
+                    pending[key] = (put_time, OrderedDict())
+                texts = pending[key][1]
+                texts[text] = texts.get(text, 0) + 1
+            now = time.monotonic()
+            while pending and next(iter(pending.values()))[0] + self.window <= now:
+                key, (_, texts) = pending.popitem(last=False)
+                self._submit(key, texts)
+        while True:                 # 取出关闭信号之后可能残留的消息
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                key, text, put_time = item
+                texts = pending.setdefault(key, (put_time, OrderedDict()))[1]
+                texts[text] = texts.get(text, 0) + 1
+        for key, (_, texts) in pending.items():      # 关闭时在本线程直接发送，不依赖可能已关闭的线程池
+            self._submit(key, texts, sync=True)
+
+    def _submit(self, key, texts, sync=False):
+        """
+        把同一接收者的多条消息合并为1条摘要消息，交给发送线程
+        :param key: 接收者
+        :param texts: OrderedDict(text -> 次数)
+        :param sync: 是否在当前线程直接发送
+        :return:
+        """
+        total = sum(texts.values())
+        if total == 1:
+            digest = next(iter(texts))
+        else:
+            lines = [f'{text} (x{num})' if num > 1 else text for text, num in texts.items()]
+            digest = f'[合并{total}条消息]\n' + '\n'.join(lines[:self.max_digest_num])
+            if len(lines) > self.max_digest_num:
+                digest += f'\n...另有{len(lines) - self.max_digest_num}条不同消息'
+        open_id, user_id, email, chat_id, root_id, at_user_id = key
+        kwargs = dict(open_id=open_id, user_id=user_id, email=email, chat_id=chat_id, root_id=root_id,
+                      at_user_id=at_user_id)
+        if not sync:
+            try:
+                self.executor.submit(self._send, digest, **kwargs)
+                return
+            except RuntimeError:        # 解释器退出中，线程池已关闭
+                pass
+        self._send(digest, **kwargs)
+
+    def _send(self, text, **kwargs):
+        self.message.rate_limiter.acquire()
+        try:
+            self.message._send_text(text, **kwargs)
+        except Exception as e:
+            logger.error(f'MessageQueue Send Text Failed: {kwargs}, error={e}')
+
+    def close(self):
+        """
+        停止接收新消息，立即发出所有待合并的消息，并等待发送完成
+        :return:
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        _queues.discard(self)
+        self.queue.put(_STOP)
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        logger.info(f'MessageQueue Closed: dropped={self.dropped}')
 
 
 if __name__ == '__main__':
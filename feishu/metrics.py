@@ -0,0 +1,182 @@
+import time
+import bisect
+import threading
+
+from .transport import Hook, add_hook, remove_hook
+
+# 0. Common
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)                 # 秒
+SIZE_BUCKETS = (1 << 10, 10 << 10, 100 << 10, 1 << 20, 10 << 20, 50 << 20)       # 字节
+
+
+class Histogram(object):
+    """
+    累积直方图，同Prometheus的histogram：每个桶统计<=上界的观测次数
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # 最后1个为+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: [(上界, 累积次数), ...]，最后1个上界为'+Inf'
+        """
+        result, total = [], 0
+        for le, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+
+class MetricsCollector(Hook):
+    """
+    内置的指标采集钩子：按接口统计请求数、耗时分布、错误码、重试次数、收发字节数分布、读写行数和cell数
+    导出为Prometheus文本格式，可挂到HTTP服务上供Prometheus抓取，或写入node_exporter的textfile目录，用于告警飞书API变慢
+    用法：
+        metrics = MetricsCollector().install()      # 注册到transport，对所有飞书API请求生效
+        ...
+        print(metrics.to_prometheus())
+        print(metrics.throughput())                 # 每个接口每秒读写的行数和cell数
+    """
+    def __init__(self, namespace='feishu', latency_buckets=LATENCY_BUCKETS, size_buckets=SIZE_BUCKETS):
+        """
+        :param namespace: 指标名前缀
+        :param latency_buckets: 耗时直方图的桶上界(秒)
+        :param size_buckets: 收发字节数直方图的桶上界(字节)
+        """
+        self.namespace = namespace
+        self.latency_buckets = latency_buckets
+        self.size_buckets = size_buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.requests = {}          # (endpoint, status_code, code) -> 次数
+            self.latency = {}           # endpoint -> Histogram
+            self.sent = {}              # endpoint -> Histogram
+            self.received = {}          # endpoint -> Histogram
+            self.retries = {}           # (endpoint, reason) -> 次数
+            self.exceptions = {}        # (endpoint, 异常类型) -> 次数
+            self.rows = {}              # endpoint -> 行数
+            self.cells = {}             # endpoint -> cell数
+            self.data_seconds = {}      # endpoint -> 读写了数据的请求的总耗时
+
+    def install(self):
+        add_hook(self)
+        return self
+
+    def uninstall(self):
+        remove_hook(self)
+
+    def _histogram(self, histograms, endpoint, buckets):
+        if endpoint not in histograms:
+            histograms[endpoint] = Histogram(buckets)
+        return histograms[endpoint]
+
+    def after_request(self, ctx, resp):
+        with self.lock:
+            key = (ctx.endpoint, ctx.status_code, ctx.code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._histogram(self.latency, ctx.endpoint, self.latency_buckets).observe(ctx.seconds)
+            self._histogram(self.sent, ctx.endpoint, self.size_buckets).observe(ctx.sent)
+            self._histogram(self.received, ctx.endpoint, self.size_buckets).observe(ctx.received)
+
+    def on_retry(self, ctx, reason, delay):
+        with self.lock:
+            key = (ctx.endpoint, reason)
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def on_error(self, ctx, error):
+        with self.lock:
+            key = (ctx.endpoint, type(error).__name__)
+            self.exceptions[key] = self.exceptions.get(key, 0) + 1
+            self._histogram(self.latency, ctx.endpoint, self.latency_buckets).observe(ctx.seconds)
+
+    def on_data(self, ctx, rows, cells):
+        with self.lock:
+            self.rows[ctx.endpoint] = self.rows.get(ctx.endpoint, 0) + rows
+            self.cells[ctx.endpoint] = self.cells.get(ctx.endpoint, 0) + cells
+            self.data_seconds[ctx.endpoint] = self.data_seconds.get(ctx.endpoint, 0.0) + ctx.seconds
+
+    def throughput(self):
+        """
+        每个接口的读写速度：行数和cell数除以这些请求的总耗时
+        :return: endpoint -> {'rows', 'cells', 'rows_per_second', 'cells_per_second'}
+        """
+        with self.lock:
+            result = {}
+            for endpoint, seconds in self.data_seconds.items():
+                rows, cells = self.rows[endpoint], self.cells[endpoint]
+                result[endpoint] = {'rows': rows, 'cells': cells,
+                                    'rows_per_second': rows / seconds if seconds else 0.0,
+                                    'cells_per_second': cells / seconds if seconds else 0.0}
+            return result
+
+    def to_prometheus(self):
+        """
+        导出为Prometheus文本格式
+        doc: https://prometheus.io/docs/instrumenting/exposition_formats/
+        :return:
+        """
+        ns = self.namespace
+        throughput = self.throughput()
+        with self.lock:
+            lines = []
+
+            def header(name, kind, help_text):
+                lines.append(f'# HELP {ns}_{name} {help_text}')
+                lines.append(f'# TYPE {ns}_{name} {kind}')
+
+            def sample(name, labels, value):
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f'{ns}_{name}{{{label_text}}} {value}')
+
+            def histogram(name, histograms):
+                for endpoint, hist in sorted(histograms.items()):
+                    for le, count in hist.cumulative():
+                        sample(f'{name}_bucket', {'endpoint': endpoint, 'le': le}, count)
+                    sample(f'{name}_sum', {'endpoint': endpoint}, hist.sum)
+                    sample(f'{name}_count', {'endpoint': endpoint}, hist.count)
+
+            header('requests_total', 'counter', 'Feishu API requests by HTTP status and response code.')
+            for (endpoint, status_code, code), count in sorted(self.requests.items(), key=str):
+                sample('requests_total', {'endpoint': endpoint, 'status': status_code,
+                                          'code': '' if code is None else code}, count)
+            header('request_duration_seconds', 'histogram', 'Feishu API request latency.')
+            histogram('request_duration_seconds', self.latency)
+            header('request_bytes', 'histogram', 'Feishu API request body size.')
+            histogram('request_bytes', self.sent)
+            header('response_bytes', 'histogram', 'Feishu API response body size.')
+            histogram('response_bytes', self.received)
+            header('retries_total', 'counter', 'Feishu API request retries by reason.')
+            for (endpoint, reason), count in sorted(self.retries.items()):
+                sample('retries_total', {'endpoint': endpoint, 'reason': reason}, count)
+            header('exceptions_total', 'counter', 'Feishu API requests that raised an exception.')
+            for (endpoint, error), count in sorted(self.exceptions.items()):
+                sample('exceptions_total', {'endpoint': endpoint, 'exception': error}, count)
+            header('rows_total', 'counter', 'Sheet rows read or written.')
+            for endpoint, rows in sorted(self.rows.items()):
+                sample('rows_total', {'endpoint': endpoint}, rows)
+            header('cells_total', 'counter', 'Sheet cells read or written.')
+            for endpoint, cells in sorted(self.cells.items()):
+                sample('cells_total', {'endpoint': endpoint}, cells)
+            header('rows_per_second', 'gauge', 'Sheet rows read or written per second of request time.')
+            for endpoint, stat in sorted(throughput.items()):
+                sample('rows_per_second', {'endpoint': endpoint}, round(stat['rows_per_second'], 3))
+            header('cells_per_second', 'gauge', 'Sheet cells read or written per second of request time.')
+            for endpoint, stat in sorted(throughput.items()):
+                sample('cells_per_second', {'endpoint': endpoint}, round(stat['cells_per_second'], 3))
+            return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
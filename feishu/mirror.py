@@ -0,0 +1,203 @@
+import time
+import json
+import logging
+import sqlite3
+import threading
+
+import pandas as pd
+
+from .spreadsheet import cell_to_xy, segments_to_text, FEISHU_VERBOSE
+from .watcher import SheetWatcher
+from .profiler import profiled
+
+logger = logging.getLogger(__name__)
+
+META_TABLE = '_feishu_mirror'       # 保存每个镜像表的revision、块hash和表头，重新打开时可以继续增量同步
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def infer_sqlite_type(values):
+    """
+    按1列的值推断SQLite类型：都是整数为INTEGER，都是数值为REAL，否则为TEXT，空值不参与推断
+    :param values:
+    :return:
+    """
+    kinds = set()
+    for v in values:
+        if v is None or v == '':
+            continue
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            return 'TEXT'
+        kinds.add('INTEGER' if isinstance(v, int) or v.is_integer() else 'REAL')
+    if not kinds:
+        return 'TEXT'
+    return 'REAL' if 'REAL' in kinds else 'INTEGER'
+
+
+class SheetMirror(object):
+    """
+    把sheet同步到本地SQLite表，在本地执行SQL查询，避免反复调用read_sheet
+    - 以cell_start所在行为表头，按表头和数据推断列类型(INTEGER/REAL/TEXT)，另有_row列保存sheet中的行号(从0开始)
+    - 增量同步：复用SheetWatcher，先比较表格revision(1次很小的请求)，有变化时再按block_size行分块读取，
+      只替换内容hash变化的块，API请求量只与变化量有关；表头变化时整表重建
+    - 块hash和revision保存在SQLite中，path为文件时，重新打开后仍然可以增量同步
+    用法：
+        mirror = SheetMirror(spreadsheet_token='xxx', sheet='xxx', path='mirror.db')
+        df = mirror.query('select city, count(*) as n from sheet group by city')   # 表名默认为sheet标题
+    """
+    def __init__(self, spsh=None, spreadsheet_token=None, sheet=0, path=':memory:', table=None, cell_start='A1',
+                 cell_end=None, block_size=1000, refresh_interval=60):
+        """
+        :param spsh: SpreadSheet实例，默认新建一个
+        :param spreadsheet_token:
+        :param sheet:
+        :param path: SQLite文件路径，默认只保存在内存中
+        :param table: 表名，默认为sheet标题
+        :param cell_start: 表头左上角
+        :param cell_end: 同步范围右下角，为None时取sheet的全部行列
+        :param block_size: 每块的行数
+        :param refresh_interval: query时距上次同步超过refresh_interval秒，先增量同步1次，为None表示只手动调用refresh
+        """
+        self.watcher = SheetWatcher(spsh, spreadsheet_token, sheet, block_size=block_size, cell_start=cell_start,
+                                    cell_end=cell_end, value_render_option='UnformattedValue')
+        self.spsh = self.watcher.spsh
+        self.sheet_id = self.watcher.sheet_id
+        self.table = table if table else self.spsh.sheets[self.spsh.sheet_id2index[self.sheet_id]]['title']
+        self.x0, _ = cell_to_xy(cell_start)
+        self.block_size = block_size
+        self.refresh_interval = refresh_interval
+        self.refresh_time = 0
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {META_TABLE} (name TEXT PRIMARY KEY, spreadsheet_token TEXT, '
+                          f'sheet_id TEXT, revision INTEGER, hashes TEXT, header TEXT, columns TEXT)')
+        self.header, self.columns = None, None
+        row = self.conn.execute(f'SELECT spreadsheet_token, sheet_id, revision, hashes, header, columns '
+                                f'FROM {META_TABLE} WHERE name = ?', (self.table,)).fetchone()
+        if row and row[0] == self.spsh.spreadsheet_token and row[1] == self.sheet_id:
+            self.watcher.revision = row[2]
+            self.watcher.hashes = {int(k): v for k, v in json.loads(row[3]).items()}
+            self.header, self.columns = json.loads(row[4]), json.loads(row[5])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _column_names(self, header):
+        """
+        表头转为SQLite列名：空列名用column_{i}代替，重复的列名加后缀
+        """
+        names, seen = [], {'_row'}
+        for i, name in enumerate(header):
+            name = str(segments_to_text(name)).strip() if name not in (None, '') else f'column_{i}'
+            base, n = name, 2
+            while name.lower() in seen:
+                name, n = f'{base}_{n}', n + 1
+            seen.add(name.lower())
+            names.append(name)
+        return names
+
+    def _rebuild(self, header, blocks):
+        """
+        表头变化或首次同步：按header和所有块的数据推断类型，重建表
+        """
+        n_cols = len(header)
+        rows = [row for block in blocks for row in block['values'][(1 if block['block'] == 0 else 0):]]
+        types = [infer_sqlite_type([row[j] if j < len(row) else None for row in rows]) for j in range(n_cols)]
+        self.header, self.columns = header, self._column_names(header)
+        self.conn.execute(f'DROP TABLE IF EXISTS {_quote(self.table)}')
+        columns = ', '.join(f'{_quote(name)} {t}' for name, t in zip(self.columns, types))
+        self.conn.execute(f'CREATE TABLE {_quote(self.table)} (_row INTEGER PRIMARY KEY, {columns})')
+        logger.info(f'SheetMirror Rebuilt: table={self.table}, columns={dict(zip(self.columns, types))}')
+
+    def _replace_block(self, block):
+        """
+        删除块所在行范围内的旧数据，插入新数据(全空的行不插入)
+        """
+        x_first = self.x0 + block['block'] * self.block_size
+        self.conn.execute(f'DELETE FROM {_quote(self.table)} WHERE _row >= ? AND _row < ?',
+                          (x_first, x_first + self.block_size))
+        n_cols = len(self.columns)
+        rows = []
+        for i, row in enumerate(block['values']):
+            x = x_first + i
+            if x == self.x0:                # 表头
+                continue
+            row = [segments_to_text(v) for v in (row or [])[:n_cols]]
+            if all(v is None or v == '' for v in row):
+                continue
+            rows.append([x] + row + [None] * (n_cols - len(row)))
+        placeholders = ', '.join(['?'] * (n_cols + 1))
+        self.conn.executemany(f'INSERT INTO {_quote(self.table)} VALUES ({placeholders})', rows)
+        return len(rows)
+
+    @profiled
+    def refresh(self, force=False):
+        """
+        增量同步1次
+        :param force: 是否清空块hash，整表重新同步
+        :return: 统计信息，形如{'blocks': 2, 'rows': 1500, 'rebuilt': False}，没有变化时blocks为0
+        """
+        with self.lock:
+            if force:
+                self.watcher.hashes, self.watcher.revision = {}, None
+            blocks = self.watcher.poll()
+            self.refresh_time = time.monotonic()
+            if not blocks:
+                return {'blocks': 0, 'rows': 0, 'rebuilt': False}
+            first = next((x for x in blocks if x['block'] == 0), None)
+            header = list(first['values'][0]) if first and first['values'] else self.header
+            rebuilt = header != self.header
+            if rebuilt:
+                if self.header is not None and len(blocks) < len(self.watcher.hashes):    # 表头变了，需要所有块的数据
+                    self.watcher.hashes, self.watcher.revision = {}, None
+                    blocks = self.watcher.poll()
+                self._rebuild(header or [], blocks)
+            n_rows = 0
+            with self.conn:
+                for block in blocks:
+                    n_rows += self._replace_block(block)
+                self.conn.execute(f'INSERT OR REPLACE INTO {META_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (self.table, self.spsh.spreadsheet_token, self.sheet_id, self.watcher.revision,
+                                   json.dumps(self.watcher.hashes), json.dumps(self.header, ensure_ascii=False,
+                                                                                default=str),
+                                   json.dumps(self.columns, ensure_ascii=False)))
+            stats = {'blocks': len(blocks), 'rows': n_rows, 'rebuilt': rebuilt}
+            if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+                print(f'SheetMirror Refreshed: table={self.table}, {stats}')
+            logger.info(f'SheetMirror Refreshed: table={self.table}, revision={self.watcher.revision}, {stats}')
+            return stats
+
+    def _maybe_refresh(self):
+        if self.refresh_interval is not None and time.monotonic() - self.refresh_time >= self.refresh_interval:
+            self.refresh()
+
+    def execute(self, sql, params=()):
+        """
+        执行SQL，返回所有结果行
+        :param sql:
+        :param params:
+        :return: [(...), ...]
+        """
+        self._maybe_refresh()
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def query(self, sql, params=()):
+        """
+        执行SQL查询，返回DataFrame
+        :param sql:
+        :param params:
+        :return:
+        """
+        self._maybe_refresh()
+        with self.lock:
+            return pd.read_sql_query(sql, self.conn, params=params)
@@ -0,0 +1,184 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from . import transport
+from .identification import Identification
+from .feishu_util import get_headers
+from .spreadsheet import SpreadSheet, FEISHU_VERBOSE
+
+logger = logging.getLogger(__name__)
+
+
+class SpreadSheetHandle(SpreadSheet):
+    """
+    绑定到1个表格的SpreadSheet，由SpreadSheetPool创建：不能切换到其他spreadsheet_token，可在多个线程中同时使用
+    - 元数据(sheets、sheet_*2id等)只在首次打开、超过meta_ttl或sheet结构变化时更新，同一时间只有1个线程在更新；
+      每次更新生成新的快照整体替换，已发布的快照不再修改，其他线程读到的总是某个完整的快照
+    - revision按线程保存，每个线程只看到自己最近1次写入或_get_revision得到的版本号
+    - 没有指定user_access_token时，每次请求前从启用的CredentialPool或共用的Identification获取token，过期前自动refresh
+    - 与同一个池中的其他表格共用Identification(token)，与所有实例共用transport(重试、钩子、SingleFlight等)
+    """
+    def __init__(self, spreadsheet_token, user_access_token=None, get_idt=None):
+        """
+        :param spreadsheet_token:
+        :param user_access_token: 固定使用的token，由调用方负责更新，为None时见get_idt
+        :param get_idt: 函数，返回共用的Identification，没有启用CredentialPool时用于获取token
+        """
+        assert user_access_token is not None or get_idt is not None, '需要指定user_access_token或get_idt！'
+        self.fixed_token = user_access_token
+        self.get_idt = get_idt
+        self.local = threading.local()
+        self.meta_lock = threading.Lock()
+        self.meta = ({}, {}, {}, {})            # (sheets, sheet_index2id, sheet_title2id, sheet_id2index)
+        self.meta_time = None                   # 最近1次更新元数据的时间
+        self.spreadsheet_token = spreadsheet_token
+        self.api_url_v2 = f'https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{spreadsheet_token}'
+        self.api_url_v3 = f'https://open.feishu.cn/open-apis/sheets/v3/spreadsheets/{spreadsheet_token}'
+        self._update_meta_info()
+
+    def _set_spreadsheet_token(self, spreadsheet_token):
+        """
+        只允许传入自身的spreadsheet_token(比如read_sheet(spreadsheet_token=...))，此时直接使用缓存的元数据
+        """
+        if spreadsheet_token != self.spreadsheet_token:
+            raise ValueError(f'SpreadSheetHandle绑定了{self.spreadsheet_token}，不能切换到{spreadsheet_token}，'
+                             f'请使用feishu.open({spreadsheet_token!r})')
+
+    @property
+    def user_access_token(self):
+        if self.fixed_token is not None:
+            return self.fixed_token
+        creds = transport.get_credential_pool()
+        if creds is not None:
+            return creds.user_access_token      # 实际请求时由CredentialPool按负载替换
+        return self.get_idt().get_user_access_token()
+
+    @property
+    def headers(self):
+        return get_headers(self.user_access_token)
+
+    @property
+    def revision(self):
+        return getattr(self.local, 'revision', None)
+
+    @revision.setter
+    def revision(self, revision):
+        self.local.revision = revision
+
+    sheets = property(lambda self: self.meta[0])
+    sheet_index2id = property(lambda self: self.meta[1])
+    sheet_title2id = property(lambda self: self.meta[2])
+    sheet_id2index = property(lambda self: self.meta[3])
+
+    def _set_sheets(self, sheets):
+        """
+        生成新的元数据快照，1次赋值整体替换，调用前需持有meta_lock
+        """
+        sheet_index2id = {val['index']: val['sheet_id'] for key, val in sheets.items()}
+        sheet_title2id = {val['title']: val['sheet_id'] for key, val in sheets.items()}
+        sheet_id2index = {val: key for key, val in sheet_index2id.items()}
+        self.meta = (sheets, sheet_index2id, sheet_title2id, sheet_id2index)
+
+    def _grow_grid(self, sheet_id, key, count):
+        with self.meta_lock:
+            super()._grow_grid(sheet_id, key, count)
+
+    def _update_meta_info(self):
+        with self.meta_lock:
+            super()._update_meta_info()
+            self.meta_time = time.monotonic()
+
+
+class SpreadSheetPool(object):
+    """
+    进程级的表格实例池：按spreadsheet_token(和指定的user_access_token)复用SpreadSheetHandle，最多缓存max_size个表格的元数据(LRU)
+    所有表格共用1个Identification(token过期前自动refresh)，避免每次新建SpreadSheet都重新获取token和元数据，也避免多个线程共用1个SpreadSheet实例
+    操作不同表格时互相修改spreadsheet_token等状态
+    用法：
+        spsh = feishu.open('xxx')                   # 使用默认的池
+        df = spsh.read_sheet(sheet='Sheet1')
+    """
+    def __init__(self, max_size=128, meta_ttl=300):
+        """
+        :param max_size: 最多缓存的表格数，超出时淘汰最久没有使用的，被淘汰的实例仍可继续使用
+        :param meta_ttl: 打开时元数据已超过meta_ttl秒则先更新，为None表示只在sheet结构变化时更新
+        """
+        self.max_size = max_size
+        self.meta_ttl = meta_ttl
+        self.lock = threading.Lock()
+        self.handles = OrderedDict()            # (spreadsheet_token, 指定的user_access_token或None) -> SpreadSheetHandle
+        self.opening = {}                       # 同上 -> 正在打开的锁，同一个表格只打开1次
+        self.idt = None
+
+    def _identification(self):
+        with self.lock:
+            if self.idt is None:
+                self.idt = Identification()
+            return self.idt
+
+    def open(self, spreadsheet_token, user_access_token=None):
+        """
+        获取表格实例
+        :param spreadsheet_token:
+        :param user_access_token: 固定使用的token(过期后需要重新open)，为None时每次请求使用启用的CredentialPool，
+                                  没有启用时使用池中共用的Identification
+        :return: SpreadSheetHandle
+        """
+        assert spreadsheet_token, '没有spreadsheet_token，需要指定！'
+        key = (spreadsheet_token, user_access_token)
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is not None:
+                self.handles.move_to_end(key)
+            else:
+                opening = self.opening.setdefault(key, threading.Lock())
+        if handle is not None:
+            if self.meta_ttl is not None and time.monotonic() - handle.meta_time >= self.meta_ttl:
+                handle._update_meta_info()
+            return handle
+
+        with opening:
+            with self.lock:
+                handle = self.handles.get(key)
+            if handle is not None:
+                return handle
+            try:
+                handle = SpreadSheetHandle(spreadsheet_token, user_access_token, self._identification)
+                with self.lock:
+                    self.handles[key] = handle
+                    while len(self.handles) > self.max_size:
+                        self.handles.popitem(last=False)
+            finally:
+                with self.lock:
+                    self.opening.pop(key, None)
+        if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+            print(f'SpreadSheet Opened: {spreadsheet_token}')
+        logger.info(f'SpreadSheet Opened: {spreadsheet_token}')
+        return handle
+
+    def evict(self, spreadsheet_token=None):
+        """
+        移除缓存的表格实例
+        :param spreadsheet_token: 为None时移除所有
+        :return:
+        """
+        with self.lock:
+            for key in list(self.handles):
+                if spreadsheet_token is None or key[0] == spreadsheet_token:
+                    del self.handles[key]
+
+
+_pool = SpreadSheetPool()
+
+
+def open(spreadsheet_token, user_access_token=None):
+    """
+    从默认的进程级池中获取表格实例，详见SpreadSheetPool
+    update: 20261019
+    :param spreadsheet_token:
+    :param user_access_token:
+    :return: SpreadSheetHandle
+    """
+    return _pool.open(spreadsheet_token, user_access_token)
@@ -0,0 +1,178 @@
+import os
+import time
+import atexit
+import logging
+import cProfile
+import threading
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+# 0. Common
+FEISHU_PROFILE = os.environ.get('FEISHU_PROFILE', '')     # 非空时全程统计，程序退出时输出汇总；以.prof结尾时同时保存cProfile文件
+
+
+class Profiler(object):
+    """
+    性能统计：按阶段(phase)和接口(endpoint)统计耗时、请求数、收发字节数，定位慢在哪里
+    - 阶段：SpreadSheet/Identification/Message的主要方法，以及序列化、JSON编码、元数据更新等，见phase和profiled
+    - 接口：每个HTTP请求，总耗时拆分为等待响应头(网络+服务端处理)和下载响应体两部分
+    开启统计时作为请求钩子(见transport.Hook)接收每个请求的统计信息
+    """
+    def __init__(self, dump=None):
+        """
+        :param dump: cProfile文件路径，为None时不启用cProfile(cProfile只统计开启统计的线程)
+        """
+        self.lock = threading.Lock()
+        self.phases = {}        # name -> {'count', 'time'}
+        self.endpoints = {}     # endpoint -> {'count', 'time', 'wait', 'sent', 'received', 'errors', 'retries'}
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.dump = dump
+        self.cprofile = cProfile.Profile() if dump else None
+
+    def start(self):
+        if self.cprofile:
+            self.cprofile.enable()
+        return self
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump)
+            logger.info(f'cProfile Stats Dumped: {self.dump}')
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            stat = self.phases.setdefault(name, {'count': 0, 'time': 0.0})
+            stat['count'] += 1
+            stat['time'] += seconds
+
+    def after_request(self, ctx, resp):
+        self.record_request(ctx.endpoint, ctx.seconds, ctx.wait, ctx.sent, ctx.received, resp.status_code != 200)
+
+    def on_error(self, ctx, error):
+        self.record_request(ctx.endpoint, ctx.seconds, ctx.wait, ctx.sent, 0, True)
+
+    def on_retry(self, ctx, reason, delay):
+        with self.lock:
+            self._endpoint_stat(ctx.endpoint)['retries'] += 1
+
+    def _endpoint_stat(self, endpoint):
+        return self.endpoints.setdefault(endpoint, {'count': 0, 'time': 0.0, 'wait': 0.0, 'sent': 0, 'received': 0,
+                                                    'errors': 0, 'retries': 0})
+
+    def record_request(self, endpoint, seconds, wait, sent, received, error):
+        """
+        :param endpoint: 形如'GET sheets/v2/spreadsheets/:token/values/:range'
+        :param seconds: 总耗时
+        :param wait: 等待响应头的耗时(网络+服务端处理)，其余为下载响应体的耗时
+        :param sent: 请求体字节数
+        :param received: 响应体字节数
+        :param error: 是否失败(HTTP状态码不是200或抛出异常)
+        :return:
+        """
+        with self.lock:
+            stat = self._endpoint_stat(endpoint)
+            stat['count'] += 1
+            stat['time'] += seconds
+            stat['wait'] += wait
+            stat['sent'] += sent
+            stat['received'] += received
+            stat['errors'] += int(error)
+
+    def summary(self):
+        """
+        :return: 汇总表格(字符串)
+        """
+        total = (self.end_time or time.perf_counter()) - self.start_time
+        lines = [f'Feishu Profile: total {total:.3f}s', '',
+                 f'{"phase":<48}{"count":>8}{"time(s)":>12}{"avg(ms)":>12}']
+        for name, stat in sorted(self.phases.items(), key=lambda x: -x[1]['time']):
+            lines.append(f'{name:<48}{stat["count"]:>8}{stat["time"]:>12.3f}{stat["time"] / stat["count"] * 1000:>12.1f}')
+        lines += ['', f'{"endpoint":<60}{"count":>7}{"time(s)":>10}{"wait(s)":>10}{"download(s)":>13}'
+                      f'{"sent(KB)":>11}{"recv(KB)":>11}{"errors":>8}{"retries":>9}']
+        for name, stat in sorted(self.endpoints.items(), key=lambda x: -x[1]['time']):
+            lines.append(f'{name:<60}{stat["count"]:>7}{stat["time"]:>10.3f}{stat["wait"]:>10.3f}'
+                         f'{stat["time"] - stat["wait"]:>13.3f}{stat["sent"] / 1024:>11.1f}'
+                         f'{stat["received"] / 1024:>11.1f}{stat["errors"]:>8}{stat["retries"]:>9}')
+        n_requests = sum(x['count'] for x in self.endpoints.values())
+        lines += ['', f'{n_requests} requests, {sum(x["sent"] for x in self.endpoints.values()) / 1024:.1f} KB sent, '
+                      f'{sum(x["received"] for x in self.endpoints.values()) / 1024:.1f} KB received']
+        return '\n'.join(lines)
+
+
+_profiler = None        # 当前生效的Profiler，为None时不统计
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextmanager
+def profile(dump=None, verbose=True):
+    """
+    在with范围内统计性能，用法：
+        with profile() as prof:
+            spsh.write_df(df, ...)
+        print(prof.summary())
+    :param dump: cProfile文件路径，为None时不启用cProfile
+    :param verbose: 结束时是否打印汇总表格
+    :return:
+    """
+    global _profiler
+    previous, _profiler = _profiler, Profiler(dump).start()
+    prof = _profiler
+    try:
+        yield prof
+    finally:
+        prof.stop()
+        _profiler = previous
+        if verbose:
+            print(prof.summary())
+
+
+@contextmanager
+def phase(name):
+    """
+    统计1个阶段的耗时，未开启统计时几乎没有开销
+    :param name:
+    :return:
+    """
+    prof = _profiler
+    if prof is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        prof.record_phase(name, time.perf_counter() - start)
+
+
+def profiled(func):
+    """
+    装饰器：把方法作为1个阶段统计耗时，阶段名为类名.方法名
+    """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return func(*args, **kwargs)
+        with phase(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _profile_at_exit():
+    _profiler.stop()
+    print(_profiler.summary())
+
+
+if FEISHU_PROFILE:
+    _profiler = Profiler(FEISHU_PROFILE if FEISHU_PROFILE.endswith('.prof') else None).start()
+    atexit.register(_profile_at_exit)
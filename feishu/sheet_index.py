@@ -0,0 +1,184 @@
+import time
+import logging
+import threading
+
+from .spreadsheet import SpreadSheet, cell_to_xy, xy_to_cell, normalize_value, READ_RANGES_MAX_NUM
+from .profiler import profiled
+
+logger = logging.getLogger(__name__)
+
+
+class SheetIndex(object):
+    """
+    sheet的key列索引：只读取1次key列，在内存中保存key -> 行号，支持按key快速读取和更新单行
+    - get(key): 1次小范围读取
+    - set(key, values): 1次_write_range，新key追加到数据末尾
+    - refresh(): 先用revision判断表格是否有变化(1次很小的请求)，没变化则跳过；有变化时分块读取key列，
+      与SheetWatcher一样按块计算内容hash，只重新解析hash有变化的块
+    本实例自己的写入不会使索引失效；其他人或程序修改表格后，最迟refresh_interval秒后自动重建索引
+    用法：
+        index = SheetIndex(spsh, key='id', spreadsheet_token='xxx', sheet='xxx')
+        row = index.get('id1')                      # {'id': 'id1', 'name': 'xxx', ...}，不存在时返回None
+        index.set('id1', {'name': 'yyy'})
+    """
+    def __init__(self, spsh=None, key='id', spreadsheet_token=None, sheet=0, cell_start='A1', refresh_interval=5):
+        """
+        :param spsh: SpreadSheet实例，默认新建一个
+        :param key: key列名，多列组合为key时传列表，此时get/set的key也传元组
+        :param spreadsheet_token:
+        :param sheet:
+        :param cell_start: 表头左上角
+        :param refresh_interval: get/set时距上次检查revision超过refresh_interval秒，才检查1次，为0表示每次都检查
+        """
+        self.spsh = spsh if spsh else SpreadSheet()
+        if spreadsheet_token:
+            self.spsh._set_spreadsheet_token(spreadsheet_token)
+        else:
+            assert getattr(self.spsh, 'spreadsheet_token', None) is not None, '没有spreadsheet_token，需要指定！'
+        self.keys = [key] if isinstance(key, str) else list(key)
+        self.sheet_id = self.spsh.sheet_index2id.get(sheet, self.spsh.sheet_title2id.get(sheet, sheet))
+        self.cell_start = cell_start
+        self.x0, self.y0 = cell_to_xy(cell_start)
+        self.refresh_interval = refresh_interval
+        self.revision = None
+        self.check_time = 0
+        self.key_cols = None
+        self.key_blocks = {}                # 块起始行号 -> (内容hash, 块内key2row, 块内x_last)，见_read_key_index
+        self.lock = threading.RLock()
+        self.refresh(force=True)
+
+    def __len__(self):
+        return len(self.key2row)
+
+    def __contains__(self, key):
+        self._maybe_refresh()
+        return self._normalize_key(key) in self.key2row
+
+    def _normalize_key(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        assert len(key) == len(self.keys), f'key需要包含{len(self.keys)}个值：{self.keys}'
+        return tuple(normalize_value(v) for v in key)
+
+    @profiled
+    def refresh(self, force=False):
+        """
+        检查revision，表格有变化时重新读取表头和key列，只重新解析内容有变化的key列块
+        :param force: 是否不检查revision，并丢弃已有的分块结果，强制重建
+        :return: 是否重建了索引
+        """
+        with self.lock:
+            spsh = self.spsh
+            revision = spsh._get_revision()
+            self.check_time = time.monotonic()
+            if not force and revision is not None and revision == self.revision:
+                return False
+            spsh._update_meta_info()
+            header = spsh._read_header(self.cell_start, self.sheet_id)
+            missing = [x for x in self.keys if x not in header]
+            assert not missing, f'key列{missing}不在sheet表头中'
+            key_cols = [header.index(x) for x in self.keys]
+            if force or key_cols != self.key_cols:
+                self.key_blocks = {}        # key列位置变化时，旧的分块结果不再可用
+            self.key_cols = key_cols
+            key2row, x_last = spsh._read_key_index(self.keys, header, self.cell_start, self.sheet_id,
+                                                   blocks=self.key_blocks)
+            self.header, self.key2row, self.x_last = header, key2row, x_last
+            self.revision = revision        # 先取revision再读数据，读取期间的修改会在下次refresh时发现
+            logger.info(f'SheetIndex Refreshed: sheet_id={self.sheet_id}, {len(key2row)} keys, revision={revision}')
+            return True
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self.check_time >= self.refresh_interval:
+            self.refresh()
+
+    def _row_range(self, x):
+        return xy_to_cell(x, self.y0), xy_to_cell(x, self.y0 + len(self.header) - 1)
+
+    def row_number(self, key):
+        """
+        :param key:
+        :return: key所在行号(从0开始)，不存在时返回None
+        """
+        self._maybe_refresh()
+        return self.key2row.get(self._normalize_key(key))
+
+    @profiled
+    def get(self, key):
+        """
+        读取key所在的行
+        :param key:
+        :return: 列名 -> 值的字典，key不存在时返回None
+        """
+        x = self.row_number(key)
+        if x is None:
+            return None
+        values = self.spsh._read_range(*self._row_range(x), sheet=self.sheet_id)
+        row = list(values[0]) if values else []
+        return dict(zip(self.header, row + [None] * (len(self.header) - len(row))))
+
+    @profiled
+    def get_many(self, keys):
+        """
+        批量读取多个key所在的行，每READ_RANGES_MAX_NUM个key1次请求
+        :param keys:
+        :return: key -> 行字典，不存在的key不出现在结果中
+        """
+        self._maybe_refresh()
+        found = [(key, self.key2row[self._normalize_key(key)]) for key in keys
+                 if self._normalize_key(key) in self.key2row]
+        result = {}
+        for i in range(0, len(found), READ_RANGES_MAX_NUM):
+            batch = found[i: i + READ_RANGES_MAX_NUM]
+            values_list = self.spsh._read_ranges([self._row_range(x) for _, x in batch], self.sheet_id, as_list=True)
+            assert values_list is not None, '读取sheet数据失败'
+            for (key, _), values in zip(batch, values_list):
+                row = list(values[0]) if values else []
+                result[key] = dict(zip(self.header, row + [None] * (len(self.header) - len(row))))
+        return result
+
+    @profiled
+    def set(self, key, values):
+        """
+        写入key所在的行，key不存在时追加到数据末尾
+        :param key:
+        :param values: 按表头顺序的整行列表，或列名 -> 值的字典(只写这些列，列不连续时会先读取当前行以填充中间的列)
+        :return: 写入的range
+        """
+        with self.lock:
+            self._maybe_refresh()
+            norm_key = self._normalize_key(key)
+            x = self.key2row.get(norm_key)
+            new = x is None
+            if new:
+                x = self.x_last + 1
+            if isinstance(values, dict):
+                unknown = [c for c in values if c not in self.header]
+                assert not unknown, f'列{unknown}不在sheet表头中'
+                values = dict(values)
+                changed_keys = [c for c in self.keys if c in values and not new and
+                                normalize_value(values[c]) != norm_key[self.keys.index(c)]]
+                assert not changed_keys, f'不支持通过set修改key列{changed_keys}'
+                if new:
+                    values.update(zip(self.keys, key if isinstance(key, tuple) else (key,)))
+                positions = sorted(self.header.index(c) for c in values)
+                y_start, y_end = positions[0], positions[-1]
+                row = [None] * len(self.header)
+                if not new and y_end - y_start + 1 > len(values):
+                    row = list(self.get(key).values())
+                for c, v in values.items():
+                    row[self.header.index(c)] = v
+                row = row[y_start: y_end + 1]
+            else:
+                assert len(values) == len(self.header), f'values需要包含{len(self.header)}列：{self.header}'
+                y_start, row = 0, list(values)
+            if new:
+                self.spsh._ensure_grid(x + 1, self.y0 + len(self.header), self.sheet_id)
+            cell_start, cell_end = xy_to_cell(x, self.y0 + y_start), xy_to_cell(x, self.y0 + y_start + len(row) - 1)
+            revision = self.revision
+            result = self.spsh._write_range(cell_start, cell_end, [row], sheet=self.sheet_id, update=False)
+            if result and new:
+                self.key2row[norm_key] = x
+                self.x_last = x
+            if result and revision is not None and self.spsh.revision == revision + 1:
+                self.revision = self.spsh.revision      # 只有本次写入，索引仍然有效
+            return result
@@ -0,0 +1,224 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .spreadsheet import SpreadSheet, cell_to_xy, xy_to_cell, FEISHU_VERBOSE
+
+logger = logging.getLogger(__name__)
+
+
+def _col_index(key):
+    """
+    列号：int原样返回，字母如'F'转为列号(从0开始)
+    """
+    if isinstance(key, str):
+        return cell_to_xy(f'{key.strip().upper()}1')[1]
+    return key
+
+
+class SheetView(object):
+    """
+    sheet的惰性视图，适合对大sheet做零散读取(如第10000~10050行、F列)，不需要read_sheet整表读取
+    - 按block_size行分块，访问时只读取涉及的块(整行宽度)，放入最多max_blocks块的LRU缓存，重复和相邻的访问直接从内存返回
+    - 顺序访问(本次起始行紧接上次访问)时，在后台预读后面prefetch块
+    - 每隔check_interval秒检查1次表格revision(1次很小的请求)，有变化时清空缓存
+    用法：
+        view = SheetView(spreadsheet_token='xxx', sheet='xxx')
+        view[10000:10050, 'F']          # F列第10000~10049行(行号从0开始)，返回列表
+        view[10000:10050, 'B:D']        # B~D列，返回二维数组
+        view[5]                         # 第5行，返回列表
+        view[5, 2]                      # 单个cell
+    行、列为int时返回降1维，为slice时按Python切片处理(不含结束位置)，列还可以是字母'F'或'B:D'(含两端)，超出sheet范围的部分被截掉，
+    不存在的cell为None
+    """
+    def __init__(self, spsh=None, spreadsheet_token=None, sheet=0, block_size=500, max_blocks=64, prefetch=2,
+                 max_workers=2, check_interval=5, value_render_option='ToString'):
+        """
+        :param spsh: SpreadSheet实例，默认新建一个
+        :param spreadsheet_token:
+        :param sheet:
+        :param block_size: 每块的行数，也是单次读取的行数
+        :param max_blocks: 缓存的最多块数，内存占用与max_blocks * block_size * 列数有关
+        :param prefetch: 顺序访问时预读的块数，为0表示不预读
+        :param max_workers: 并发读取的块数
+        :param check_interval: 距上次检查revision超过check_interval秒时，访问前先检查1次，为None表示只手动调用invalidate
+        :param value_render_option: 读取方式，见SpreadSheet._read_range
+        """
+        self.spsh = spsh if spsh else SpreadSheet()
+        if spreadsheet_token:
+            self.spsh._set_spreadsheet_token(spreadsheet_token)
+        else:
+            assert getattr(self.spsh, 'spreadsheet_token', None) is not None, '没有spreadsheet_token，需要指定！'
+        assert block_size > 0 and max_blocks > 0, 'block_size、max_blocks需要大于0！'
+        self.sheet_id = self.spsh.sheet_index2id.get(sheet, self.spsh.sheet_title2id.get(sheet, sheet))
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.prefetch = prefetch
+        self.max_workers = max_workers
+        self.check_interval = check_interval
+        self.value_render_option = value_render_option
+        self.lock = threading.RLock()
+        self.blocks = OrderedDict()         # 块序号 -> 二维数组，按最近访问排序
+        self.pending = {}                   # 块序号 -> 正在读取的Future，避免重复读取
+        self.generation = 0                 # 每次清空缓存加1，丢弃清空前发起的读取结果
+        self.check_time = time.monotonic()
+        self.last_stop = None               # 上次访问的结束行，用于判断顺序访问
+        self.executor = None
+        self.stats = {'hits': 0, 'misses': 0, 'prefetched': 0, 'invalidations': 0}
+        self.revision = self.spsh._get_revision() if check_interval is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    @property
+    def shape(self):
+        """
+        :return: (行数, 列数)
+        """
+        grid_properties = self.spsh.sheets[self.spsh.sheet_id2index[self.sheet_id]]['grid_properties']
+        return grid_properties['row_count'], grid_properties['column_count']
+
+    def __len__(self):
+        return self.shape[0]
+
+    def invalidate(self):
+        """
+        清空缓存，并更新sheet行列数
+        :return:
+        """
+        with self.lock:
+            self.blocks.clear()
+            self.pending.clear()
+            self.generation += 1
+            self.last_stop = None
+            self.stats['invalidations'] += 1
+        self.spsh._update_meta_info()
+
+    def _check_revision(self):
+        if self.check_interval is None or time.monotonic() - self.check_time < self.check_interval:
+            return
+        revision = self.spsh._get_revision()
+        self.check_time = time.monotonic()
+        if revision is not None and revision != self.revision:
+            if self.revision is not None:
+                if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+                    print(f'SheetView Invalidated: sheet_id={self.sheet_id}, revision {self.revision} -> {revision}')
+                logger.info(f'SheetView Invalidated: sheet_id={self.sheet_id}, revision {self.revision} -> {revision}')
+                self.invalidate()
+            self.revision = revision
+
+    def _fetch(self, i, generation):
+        """
+        读取第i块，读取期间缓存没有被清空时放入缓存
+        """
+        try:
+            n_rows, n_cols = self.shape
+            x = i * self.block_size
+            values = self.spsh._read_range(xy_to_cell(x, 0), xy_to_cell(min(n_rows, x + self.block_size) - 1,
+                                                                         n_cols - 1),
+                                           self.sheet_id, self.value_render_option)
+            if values is None:
+                raise ValueError(f'Read Range Failed: sheet_id={self.sheet_id}, row={x}')
+            with self.lock:
+                if generation == self.generation:
+                    self.blocks[i] = values
+                    self.blocks.move_to_end(i)
+                    while len(self.blocks) > self.max_blocks:
+                        self.blocks.popitem(last=False)
+            return values
+        finally:
+            with self.lock:
+                if generation == self.generation:
+                    self.pending.pop(i, None)
+
+    def _submit(self, i):
+        """
+        发起第i块的读取，已在读取中时复用，调用前需持有锁
+        """
+        future = self.pending.get(i)
+        if future is None:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            future = self.executor.submit(self._fetch, i, self.generation)
+            self.pending[i] = future
+        return future
+
+    def _get_blocks(self, block_start, block_end):
+        """
+        获取[block_start, block_end]的所有块，缺失的块并发读取
+        :return: 块序号 -> 二维数组
+        """
+        result, futures = {}, {}
+        with self.lock:
+            for i in range(block_start, block_end + 1):
+                if i in self.blocks:
+                    self.blocks.move_to_end(i)
+                    result[i] = self.blocks[i]
+                    self.stats['hits'] += 1
+                else:
+                    futures[i] = self._submit(i)
+                    self.stats['misses'] += 1
+        for i, future in futures.items():
+            result[i] = future.result()
+        return result
+
+    def _prefetch(self, block_end):
+        n_blocks = (self.shape[0] + self.block_size - 1) // self.block_size
+        with self.lock:
+            for i in range(block_end + 1, min(n_blocks, block_end + 1 + self.prefetch)):
+                if i not in self.blocks and i not in self.pending:
+                    self._submit(i)
+                    self.stats['prefetched'] += 1
+
+    def _normalize(self, key, length, name):
+        """
+        行列下标转为(range, 是否降维)
+        """
+        if isinstance(key, slice):
+            return range(*key.indices(length)), False
+        if name == 'col' and isinstance(key, str) and ':' in key:
+            start, _, end = key.partition(':')
+            return range(_col_index(start), min(length, _col_index(end) + 1)), False
+        index = _col_index(key) if name == 'col' else key
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f'SheetView {name} index out of range: {key}')
+        return range(index, index + 1), True
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        self._check_revision()
+        n_rows, n_cols = self.shape
+        rows, row_scalar = self._normalize(rows, n_rows, 'row')
+        cols, col_scalar = self._normalize(cols, n_cols, 'col')
+        if len(rows) == 0:
+            result = []
+        else:
+            row_min, row_max = min(rows[0], rows[-1]), max(rows[0], rows[-1])
+            block_start, block_end = row_min // self.block_size, row_max // self.block_size
+            blocks = self._get_blocks(block_start, block_end)
+            if self.prefetch and self.last_stop is not None and self.last_stop - 1 <= row_min <= self.last_stop:
+                self._prefetch(block_end)
+            self.last_stop = row_max + 1
+            result = []
+            for x in rows:
+                values = blocks[x // self.block_size]
+                row = values[x % self.block_size] if x % self.block_size < len(values) else None
+                row = row or []
+                result.append([row[y] if y < len(row) else None for y in cols])
+        if col_scalar:
+            result = [row[0] for row in result]
+        if row_scalar:
+            result = result[0]
+        return result
@@ -0,0 +1,129 @@
+import os
+import json
+import logging
+
+from .spreadsheet import SpreadSheet, cell_to_xy, cells_to_rects, rects_to_ranges, normalize_value, FEISHU_VERBOSE, \
+    WRITE_MAX_ROWS, WRITE_MAX_COLUMNS
+from .profiler import profiled
+
+logger = logging.getLogger(__name__)
+
+
+class DiffWriter(object):
+    """
+    基于本地快照的增量写入：记住每个(spreadsheet, sheet, cell_start)上次写入的数据，再次写入时只写变化的cell
+    变化的cell合并为尽量少的矩形，通过values_batch_update批量写入，请求数和流量只与变化量有关，与表格大小无关
+    适用于定期整体刷新、但大部分cell不变的看板类sheet
+    用法：
+        writer = DiffWriter(spsh, path='snapshot.json')   # path为None时快照只保存在内存中
+        writer.write_df(df, spreadsheet_token='xxx', sheet='xxx', cell_start='A1')
+    """
+    def __init__(self, spsh=None, path=None, check_revision=False):
+        """
+        :param spsh: SpreadSheet实例，默认新建一个
+        :param path: 快照文件(json)，为None时只保存在内存中
+        :param check_revision: 写入前是否检查表格revision，若与上次写入后的revision不一致(表格被其他人或程序修改过)，
+                               则快照失效，整体重写。注意：同一表格中其他sheet的修改也会导致revision变化
+        """
+        self.spsh = spsh if spsh else SpreadSheet()
+        self.path = path
+        self.check_revision = check_revision
+        self.snapshots = {}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.snapshots = json.load(f)
+
+    def _save(self):
+        if self.path:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshots, f, ensure_ascii=False, default=str)
+
+    def clear(self, spreadsheet_token=None):
+        """
+        清除快照，下次写入时整体重写
+        :param spreadsheet_token: 为None时清除所有快照
+        :return:
+        """
+        if spreadsheet_token is None:
+            self.snapshots = {}
+        else:
+            self.snapshots = {k: v for k, v in self.snapshots.items() if not k.startswith(f'{spreadsheet_token}|')}
+        self._save()
+
+    @profiled
+    def write_df(self, df, spreadsheet_token=None, sheet=0, cell_start='A1', max_num=1000):
+        """
+        把DataFrame(含表头)写入sheet，只写与快照相比变化的cell；没有快照时整体写入
+        update: 20261019
+        :param df:
+        :param spreadsheet_token:
+        :param sheet:
+        :param cell_start:
+        :param max_num: 整体写入时单次写入的最多行数
+        :return: 统计信息，形如{'cells': 12, 'rects': 3, 'requests': 1}
+        """
+        spsh = self.spsh
+        if spreadsheet_token and spreadsheet_token != getattr(spsh, 'spreadsheet_token', None):
+            spsh._set_spreadsheet_token(spreadsheet_token)
+        else:
+            assert getattr(spsh, 'spreadsheet_token', None) is not None, '没有spreadsheet_token，需要指定！'
+        sheet_id = spsh.sheet_index2id.get(sheet, spsh.sheet_title2id.get(sheet, sheet))
+        x0, y0 = cell_to_xy(cell_start)
+        key = f'{spsh.spreadsheet_token}|{sheet_id}|{cell_start}'
+
+        df = df.astype(object).where(df.notna(), None)
+        values = [list(df.columns)] + [list(row) for row in df.itertuples(index=False)]
+        snapshot = self.snapshots.get(key)
+        if snapshot and self.check_revision and spsh._get_revision() != snapshot['revision']:
+            logger.info(f'SpreadSheet Revision Changed, Snapshot Expired: {key}')
+            snapshot = None
+
+        try:
+            stats = self._write(spsh, values, snapshot, x0, y0, sheet_id, max_num)
+        except Exception as e:
+            # 写入失败时sheet中的数据未知，丢弃快照，下次整体写入
+            if self.snapshots.pop(key, None) is not None:
+                self._save()
+            logger.error(f'Diff Write Failed: {key}, error={e}')
+            raise
+
+        self.snapshots[key] = {'values': values, 'revision': spsh.revision}
+        self._save()
+        if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+            print(f'Diff Write Successfully: {key}, {stats}')
+        logger.info(f'Diff Write Successfully: {key}, {stats}')
+        return stats
+
+    def _write(self, spsh, values, snapshot, x0, y0, sheet_id, max_num):
+        """
+        没有快照时整体写入，否则只写变化的cell，任何1批写入失败都抛出ValueError
+        :return: 统计信息
+        """
+        if snapshot is None:
+            spsh._update_meta_info()
+            spsh._write_values(values, x0, y0, sheet_id, max_num, strict=True)
+            n_rows, n_cols = len(values), len(values[0])
+            n_requests = -(-n_rows // min(max_num, WRITE_MAX_ROWS)) * -(-n_cols // WRITE_MAX_COLUMNS)
+            return {'cells': n_rows * n_cols, 'rects': 1, 'requests': n_requests}
+
+        old = snapshot['values']
+        n_rows = max(len(old), len(values))
+        n_cols = max([len(x) for x in old + values])
+        cells = set()
+        for x in range(n_rows):
+            old_row = old[x] if x < len(old) else []
+            new_row = values[x] if x < len(values) else []
+            for y in range(n_cols):
+                old_value = old_row[y] if y < len(old_row) else None
+                new_value = new_row[y] if y < len(new_row) else None     # 新数据比快照小时，多出的部分清空
+                if normalize_value(old_value) != normalize_value(new_value):
+                    cells.add((x, y))
+        if len(values) > len(old) or len(values[0]) > len(old[0]):
+            spsh._update_meta_info()
+            spsh._ensure_grid(x0 + len(values), y0 + len(values[0]), sheet_id)
+
+        rects = cells_to_rects(cells)
+        ranges = rects_to_ranges(rects, lambda x, y: values[x][y] if x < len(values) and y < len(values[x]) else None,
+                                 x0, y0)
+        n_requests = spsh._write_ranges_batch(ranges, sheet_id)
+        return {'cells': len(cells), 'rects': len(rects), 'requests': n_requests}
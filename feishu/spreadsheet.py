@@ -1,14 +1,22 @@
 import os
-import requests
 import logging
 import re
 from tqdm import tqdm
 import pandas as pd
+import numpy as np
 import cv2
 import json
+import hashlib
+import importlib
+import threading
+from contextlib import closing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from . import transport
 from .identification import Identification
-from .feishu_util import get_headers
+from .feishu_util import get_headers, iter_json_array
+from .profiler import profiled, phase
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +25,19 @@ logger = logging.getLogger(__name__)
 ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 PATTERN = re.compile(r'([a-zA-Z]+)(\d+)')   # 拆分字母和数字
 FEISHU_VERBOSE = os.environ.get('FEISHU_VERBOSE', 'spreadsheet')
+SHEETS_BATCH_MAX_NUM = 50     # 单次sheets_batch_update最多包含的操作数，保守取值
+DIMENSION_MAX_NUM = 5000      # 单次增加或删除行列最多5000行(列)
+WRITE_MAX_ROWS = 5000         # 单次写入最多5000行、100列
+WRITE_MAX_COLUMNS = 100
+KEY_READ_MAX_NUM = 50000      # 读取单列(如key列)时每次读取的行数，单次读取返回数据限制为10M
+READ_RANGES_MAX_NUM = 100     # 单次values_batch_get最多读取的range数，ranges拼在url中，不宜过多
+SHEET_MAX_ROWS = 50000        # 单个sheet最多行数，保守取值，用于分片写入
+SHEET_MAX_CELLS = 5000000     # 单个sheet最多cell数，保守取值，用于分片写入
+WRITE_RANGES_MAX_NUM = 100    # 单次values_batch_update最多包含的range数
+WRITE_RANGES_MAX_CELLS = 50000    # 单次values_batch_update最多写入的cell数，保守取值
+SHARD_META_SHEET = '_feishu_shards'  # 隐藏sheet，记录write_df_sharded创建的续表，每行：[sheet_id, 写入行数, 写入列数, 续表sheet_id...]
+OUTPUTS = ['pandas', 'arrow', 'polars', 'dict', 'records']     # read_sheet支持的返回类型
+OPTIONAL_MIN_VERSIONS = {'pyarrow': (14, 0), 'polars': (0, 20)}    # 可选依赖的最低版本，见requirements-extras.txt
 
 
 def xy_to_cell(row_index, col_index):
@@ -55,6 +76,285 @@ def cell_to_xy(cell):
         raise e
 
 
+def normalize_value(value):
+    """
+    把cell值统一转化为字符串，用于对比本地数据与按ToString读取的sheet数据，比如：None/NaN -> '', 3.0 -> '3'
+    :param value:
+    :return:
+    """
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def values_digest(values):
+    """
+    计算二维数组内容的hash，用于按块判断sheet内容是否有变化
+    :param values:
+    :return:
+    """
+    return hashlib.md5(json.dumps(values, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def segments_to_text(value):
+    """
+    按UnformattedValue读取时，包含url、@人、@文档等的cell返回分段列表，拼接各段的文本，比如：
+    [{'type': 'text', 'text': 'see '}, {'type': 'url', 'text': 'doc', 'link': 'https://xxx'}] -> 'see doc'
+    :param value:
+    :return:
+    """
+    if isinstance(value, dict):
+        return value.get('text', value.get('link', ''))
+    if isinstance(value, list):
+        return ''.join(str(segments_to_text(x)) for x in value)
+    return value
+
+
+def decode_column(values, dtype=None, infer_types=True):
+    """
+    把按UnformattedValue读取的一列值转化为pandas的Series
+    - 纯数值列(允许有空值)走快速路径：1次np.array(dtype=float64)完成转化，没有空值且都是整数时再转为int64
+    - 其他列先把分段列表转为文本，再按dtype转化
+    :param values: list或object类型的ndarray
+    :param dtype: 目标类型，如'float64', 'int64', 'Int64', 'str', 'bool', 'category', 'datetime64[ns]'等，
+                  为None时按infer_types推断
+    :param infer_types: dtype为None时，是否把纯数值列转为数值类型，否则保留为object
+    :return: pd.Series
+    """
+    numeric = dtype is not None and dtype not in ['str', str, 'string', 'bool', bool, 'category', 'object', object] \
+        and not str(dtype).startswith('datetime')
+    if dtype is None and not infer_types:
+        return pd.Series([segments_to_text(v) for v in values], dtype=object)
+    if dtype is None or numeric:
+        # 所有非空值都是数值时才走快速路径，混有布尔值、文本(如'12')的列保留原值，不被静默转为数值
+        if all(v is None or (isinstance(v, (int, float, np.number)) and not isinstance(v, bool)) for v in values):
+            arr = np.array(values, dtype='float64')     # None -> NaN
+            if dtype is not None:
+                return pd.Series(arr).astype(dtype)
+            if arr.size and not np.isnan(arr).any() and np.abs(arr).max() < 2 ** 53 and (arr == np.trunc(arr)).all():
+                return pd.Series(arr.astype('int64'))
+            return pd.Series(arr)
+    series = pd.Series([segments_to_text(v) for v in values], dtype=object)
+    if dtype is None:
+        return series.infer_objects()
+    if numeric:
+        return pd.to_numeric(series.mask(series.eq('')), errors='coerce').astype(dtype)
+    if str(dtype).startswith('datetime'):
+        return pd.to_datetime(series.mask(series.eq('')), errors='coerce').astype(dtype)     # 保留指定的精度和时区
+    if dtype in ['str', str]:
+        return series.map(lambda v: v if v is None or isinstance(v, str) else normalize_value(v))
+    return series.astype(dtype)
+
+
+def decode_frame(columns, col_names, dtypes=None, infer_types=True):
+    """
+    按列解码为DataFrame，见decode_column
+    :param columns: 按列存储的数据，[[第1列的值], [第2列的值], ...]
+    :param col_names: 列名，None表示用列序号
+    :param dtypes: 所有列的目标类型，或列名 -> 目标类型的字典(未指定的列按infer_types推断)
+    :param infer_types:
+    :return:
+    """
+    col_names = list(col_names) if col_names is not None else list(range(len(columns)))
+    data = {}
+    for i, (name, column) in enumerate(zip(col_names, columns)):
+        dtype = dtypes.get(name) if isinstance(dtypes, dict) else dtypes
+        data[i] = decode_column(column, dtype, infer_types)
+    df = pd.DataFrame(data)
+    df.columns = col_names
+    return df
+
+
+def _column_name(name, i):
+    return f'column_{i}' if name is None or name == '' else str(name)
+
+
+def _to_arrow(pa, values):
+    """
+    把1列转为pyarrow.Array，类型混杂时转为字符串
+    :param pa: pyarrow模块
+    :param values: pd.Series或list
+    :return:
+    """
+    if isinstance(values, pd.Series):
+        try:
+            return pa.Array.from_pandas(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            values = values.tolist()
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(segments_to_text(v)) for v in values], type=pa.string())
+
+
+def _to_polars(pl, name, values):
+    """
+    把1列转为polars.Series，类型混杂时转为字符串
+    :param pl: polars模块
+    :param name:
+    :param values: pd.Series或list
+    :return:
+    """
+    if isinstance(values, pd.Series):
+        if values.dtype.kind in 'iufbM':
+            return pl.Series(name, values.to_numpy())
+        values = [None if v is pd.NA or v is pd.NaT else v for v in values.tolist()]
+    try:
+        return pl.Series(name, values, strict=False)
+    except Exception:
+        return pl.Series(name, [None if v is None else str(segments_to_text(v)) for v in values], dtype=pl.Utf8)
+
+
+def import_optional(name, feature):
+    """
+    导入可选依赖pyarrow/polars，未安装或版本低于OPTIONAL_MIN_VERSIONS时抛出ImportError，说明缺少什么、怎么安装
+    :param name: 模块名
+    :param feature: 需要该模块的功能，用于报错信息
+    :return: 模块
+    """
+    min_version = '.'.join(str(x) for x in OPTIONAL_MIN_VERSIONS[name])
+    hint = f"{feature}需要安装{name}>={min_version}：pip install -r requirements-extras.txt"
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        raise ImportError(hint)
+    version = tuple(int(x) for x in re.findall(r'\d+', module.__version__)[:2])
+    if version < OPTIONAL_MIN_VERSIONS[name]:
+        raise ImportError(f'{hint}，当前版本为{module.__version__}')
+    return module
+
+
+def build_output(columns, col_names, output='pandas', dtypes=None, infer_types=False):
+    """
+    把按列存储的数据直接构建为指定类型，不经过行列表转置；指定dtypes或infer_types时先按decode_column转化每列
+    :param columns: [[第1列的值], [第2列的值], ...]
+    :param col_names: 列名，None表示用列序号
+    :param output: pandas, arrow, polars, dict, records，其中arrow和polars需要安装对应的包
+    :param dtypes:
+    :param infer_types:
+    :return:
+    """
+    assert output in OUTPUTS, f'output需要是{OUTPUTS}之一'
+    typed = dtypes is not None or infer_types
+    col_names = list(col_names) if col_names is not None else list(range(len(columns)))
+    if output == 'pandas':
+        if typed:
+            return decode_frame(columns, col_names, dtypes, infer_types)
+        df = pd.DataFrame(dict(enumerate(columns)))
+        df.columns = col_names
+        return df
+
+    if typed:
+        columns = [decode_column(column, dtypes.get(name) if isinstance(dtypes, dict) else dtypes, infer_types)
+                   for name, column in zip(col_names, columns)]
+    if output == 'dict':
+        return {name: column.tolist() if typed else column for name, column in zip(col_names, columns)}
+    if output == 'records':
+        columns = [column.tolist() if typed else column for column in columns]
+        return [dict(zip(col_names, row)) for row in zip(*columns)]
+    if output == 'arrow':
+        pa = import_optional('pyarrow', "output='arrow'")
+        return pa.Table.from_arrays([_to_arrow(pa, column) for column in columns],
+                                    names=[_column_name(name, i) for i, name in enumerate(col_names)])
+    pl = import_optional('polars', "output='polars'")
+    return pl.DataFrame([_to_polars(pl, _column_name(name, i), column) for i, (name, column)
+                         in enumerate(zip(col_names, columns))])
+
+
+def concat_outputs(parts, output='pandas'):
+    """
+    按行拼接多个build_output的结果(比如多个分片)，列名以第1个为准
+    :param parts:
+    :param output:
+    :return:
+    """
+    if output == 'pandas':
+        col_names = list(parts[0].columns)
+        return pd.concat([x.set_axis(col_names, axis=1) for x in parts], ignore_index=True)
+    if output == 'dict':
+        result = {name: list(column) for name, column in parts[0].items()}
+        for part in parts[1:]:
+            for name, column in zip(result, part.values()):
+                result[name].extend(column)
+        return result
+    if output == 'records':
+        col_names = list(parts[0][0]) if parts[0] else None
+        return [row if col_names is None else dict(zip(col_names, row.values())) for part in parts for row in part]
+    if output == 'arrow':
+        pa = import_optional('pyarrow', "output='arrow'")
+        col_names = parts[0].column_names
+        return pa.concat_tables([x.rename_columns(col_names) for x in parts], promote_options='permissive')
+    pl = import_optional('polars', "output='polars'")
+    col_names = parts[0].columns
+    return pl.concat([x.rename(dict(zip(x.columns, col_names))) for x in parts], how='vertical_relaxed')
+
+
+def group_consecutive(indexes):
+    """
+    把有序的整数序列拆分为连续区间，比如：[1, 2, 3, 7, 8] -> [(1, 3), (7, 8)]
+    :param indexes:
+    :return:
+    """
+    runs = []
+    for i in indexes:
+        if runs and i == runs[-1][1] + 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return [tuple(x) for x in runs]
+
+
+def cells_to_rects(cells):
+    """
+    把一批cell坐标合并为尽量少的矩形：先按行合并连续列，再把列范围相同的相邻行合并
+    比如：{(0, 0), (0, 1), (1, 0), (1, 1), (5, 3)} -> [(0, 0, 1, 1), (5, 3, 5, 3)]
+    :param cells: (row_index, col_index)的集合
+    :return: [(x_start, y_start, x_end, y_end), ...]
+    """
+    row2cols = {}
+    for x, y in cells:
+        row2cols.setdefault(x, []).append(y)
+    rects, opened = [], {}          # opened: (y_start, y_end) -> [x_start, x_end]，还能继续向下扩展的矩形
+    for x in sorted(row2cols):
+        current = {}
+        for y_start, y_end in group_consecutive(sorted(set(row2cols[x]))):
+            rect = opened.pop((y_start, y_end), None)
+            if rect and rect[1] == x - 1:
+                rect[1] = x
+            else:
+                if rect:
+                    rects.append((rect[0], y_start, rect[1], y_end))
+                rect = [x, x]
+            current[(y_start, y_end)] = rect
+        for (y_start, y_end), rect in opened.items():
+            rects.append((rect[0], y_start, rect[1], y_end))
+        opened = current
+    for (y_start, y_end), rect in opened.items():
+        rects.append((rect[0], y_start, rect[1], y_end))
+    return sorted(rects)
+
+
+def rects_to_ranges(rects, get_value, x_offset=0, y_offset=0):
+    """
+    把cells_to_rects得到的矩形转化为_write_ranges需要的range，超过单次写入行列上限的矩形会再拆分
+    :param rects: [(x_start, y_start, x_end, y_end), ...]
+    :param get_value: 函数，get_value(x, y)返回坐标(x, y)处要写入的值
+    :param x_offset: 坐标转化为cell编号时的偏移，比如数据从B3开始写时为(2, 1)
+    :param y_offset:
+    :return: [(cell_start, cell_end, values), ...]
+    """
+    ranges = []
+    for x_start, y_start, x_end, y_end in rects:
+        for a in range(x_start, x_end + 1, WRITE_MAX_ROWS):
+            for b in range(y_start, y_end + 1, WRITE_MAX_COLUMNS):
+                c, d = min(x_end, a + WRITE_MAX_ROWS - 1), min(y_end, b + WRITE_MAX_COLUMNS - 1)
+                values = [[get_value(x, y) for y in range(b, d + 1)] for x in range(a, c + 1)]
+                ranges.append((xy_to_cell(x_offset + a, y_offset + b), xy_to_cell(x_offset + c, y_offset + d), values))
+    return ranges
+
+
 class SpreadSheet(object):
     """
     操作SpreadSheet，暂时只需关注write_df(df写入sheet)和read_sheet(读取sheet为df)这2个API
@@ -71,6 +371,7 @@ class SpreadSheet(object):
             user_access_token = self.idt.user_access_token
         self.user_access_token = user_access_token
         self.headers = get_headers(self.user_access_token)
+        self.revision = None                # 表格版本号，本实例写入数据或调用_get_revision时更新
         if spreadsheet_token:
             self._set_spreadsheet_token(spreadsheet_token)
 
@@ -85,6 +386,7 @@ class SpreadSheet(object):
         self.api_url_v3 = f'https://open.feishu.cn/open-apis/sheets/v3/spreadsheets/{spreadsheet_token}'
         self._update_meta_info()
 
+    @profiled
     def _update_meta_info(self):
         """
         获取并更新表格元数据
@@ -93,7 +395,7 @@ class SpreadSheet(object):
         update: 20230725
         """
         url = self.api_url_v3
-        resp = requests.get(url, headers=self.headers)
+        resp = transport.get(url, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -106,18 +408,60 @@ class SpreadSheet(object):
                 return
 
         url = f'{self.api_url_v3}/sheets/query'
-        resp = requests.get(url, headers=self.headers)
+        resp = transport.get(url, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
                 sheets = resp['data']['sheets']
-                self.sheets = {x['index']: x for x in sheets}
-                self.sheet_index2id = {val['index']: val['sheet_id'] for key, val in self.sheets.items()}
-                self.sheet_title2id = {val['title']: val['sheet_id'] for key, val in self.sheets.items()}
-                self.sheet_id2index = {val: key for key, val in self.sheet_index2id.items()}
+                self._set_sheets({x['index']: x for x in sheets})
             else:
                 logger.error(f'Get SpreadSheet Sheets Meta Info Failed: {resp}')
 
+    def _set_sheets(self, sheets):
+        """
+        用sheets整体替换sheet元数据：先生成所有映射再赋值，已有的字典不会被修改
+        :param sheets: index -> sheet信息
+        :return:
+        """
+        sheet_index2id = {val['index']: val['sheet_id'] for key, val in sheets.items()}
+        sheet_title2id = {val['title']: val['sheet_id'] for key, val in sheets.items()}
+        sheet_id2index = {val: key for key, val in sheet_index2id.items()}
+        self.sheets, self.sheet_index2id, self.sheet_title2id, self.sheet_id2index = \
+            sheets, sheet_index2id, sheet_title2id, sheet_id2index
+
+    def _grow_grid(self, sheet_id, key, count):
+        """
+        记录sheet的行(列)数至少为count：复制该sheet的信息后整体替换元数据，不修改其他调用方可能正在使用的字典
+        :param sheet_id:
+        :param key: 'row_count'或'column_count'
+        :param count:
+        :return:
+        """
+        sheets = dict(self.sheets)
+        index = self.sheet_id2index[sheet_id]
+        grid_properties = sheets[index]['grid_properties']
+        if grid_properties[key] < count:
+            sheets[index] = dict(sheets[index], grid_properties=dict(grid_properties, **{key: count}))
+            self._set_sheets(sheets)
+
+    @profiled
+    def _get_revision(self):
+        """
+        获取表格当前版本号：表格内容每变化1次，revision加1，可用于低成本判断表格是否有变化
+        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet/obtain-spreadsheet-metadata
+        update: 20261019
+        :return:
+        """
+        url = f'{self.api_url_v2}/metainfo'
+        resp = transport.get(url, headers=self.headers)
+        if resp.status_code == 200:
+            resp = resp.json()
+            if resp['code'] == 0:
+                self.revision = resp['data']['properties']['revision']
+                return self.revision
+            else:
+                logger.error(f'Get SpreadSheet Revision Failed: {resp}')
+
     def _change_title(self, title):
         """
         修改表格title
@@ -130,13 +474,14 @@ class SpreadSheet(object):
         body = {
             'title': title
         }
-        resp = requests.patch(url, json=body, headers=self.headers)
+        resp = transport.patch(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
                 self.title = title
             return resp
 
+    @profiled
     def create_spreadsheet(self, folder_token, title=None):
         """
         创建表格
@@ -151,7 +496,7 @@ class SpreadSheet(object):
             'title': title,
             'folder_token': folder_token
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -179,146 +524,102 @@ class SpreadSheet(object):
         sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
         return self.sheets[sheet_id]
 
-    def _add_sheet(self, title, index=-1):
+    def buffered(self, max_cells=WRITE_RANGES_MAX_CELLS, max_delay=5):
         """
-        添加sheet
-        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet-sheet/operate-sheets
-        update: 20230726
-        :param title:
-        :param index: 0表示添加为第1个，1表示添加为第2个，……，-2表示添加为倒数第2个，-1表示添加为最后1个
+        新建写缓冲区，详见WriteBuffer，用法：with spsh.buffered() as buf: buf.write_cell('A1', 1)
+        :param max_cells: 缓冲的cell数达到max_cells时自动写入
+        :param max_delay: 第1个cell进入缓冲区max_delay秒后自动写入，为None表示不按时间写入
         :return:
         """
+        return WriteBuffer(self, max_cells=max_cells, max_delay=max_delay)
+
+    @profiled
+    def _sheets_batch_update(self, reqs, update=True):
+        """
+        批量操作sheet：一次请求内按顺序执行多个添加、复制、删除、更新sheet的操作
+        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet-sheet/operate-sheets
+        update: 20261019
+        :param reqs: 形如[{'addSheet': {...}}, {'copySheet': {...}}, ...]
+        :param update:
+        :return: 与reqs一一对应的replies，失败时返回None
+        """
         url = f'{self.api_url_v2}/sheets_batch_update'      # 其他url是v3，它是v2
         body = {
-            'requests': [{
-                'addSheet': {
-                    'properties': {
-                        'title': title,
-                        'index': len(self.sheets) + 1 + index if index < 0 else index
-                    }
-                }
-            }]
+            'requests': reqs
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
-                self._update_meta_info()
-                properties = list(resp['data']['replies'][0].values())[0]['properties']
-                sheet_id, title, index = properties['sheetId'], properties['title'], properties['index']
-                logger.info(f'Add Sheet Successfully: index={index}, sheet_id={sheet_id}, title={title}')
-                return sheet_id, index
+                if update:
+                    self._update_meta_info()
+                return resp['data']['replies']
             else:
-                logger.error(f'Add Sheet Failed: {resp}')
-                return None, None
+                logger.error(f'Sheets Batch Update Failed: {resp}')
+        else:
+            logger.error(f'Sheets Batch Update Failed: status_code={resp.status_code}')
+        return None
+
+    def sheet_batch(self, max_num=None):
+        """
+        新建sheet结构操作的批处理器，详见SheetBatch
+        :param max_num: 单次sheets_batch_update最多包含的操作数
+        :return:
+        """
+        return SheetBatch(self, max_num=max_num if max_num else SHEETS_BATCH_MAX_NUM)
+
+    def _add_sheet(self, title, index=-1, update=True):
+        """
+        添加sheet
+        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet-sheet/operate-sheets
+        update: 20261019
+        :param title:
+        :param index: 0表示添加为第1个，1表示添加为第2个，……，-2表示添加为倒数第2个，-1表示添加为最后1个
+        :param update:
+        :return:
+        """
+        result = self.sheet_batch().add_sheet(title, index).commit(update=update)[0]
+        return result if result else (None, None)
 
-    def _copy_sheet(self, title, sheet=0):
+    def _copy_sheet(self, title, sheet=0, update=True):
         """
         复制sheet
         doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet-sheet/operate-sheets
-        update: 20230726
+        update: 20261019
         :param title:
         :param sheet:
+        :param update:
         :return:
         """
-        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
-        url = f'{self.api_url_v2}/sheets_batch_update'      # 其他url是v3，它是v2
-        body = {
-            'requests': [{
-                'copySheet': {
-                    'source': {
-                        'sheetId': sheet_id
-                    },
-                    'destination': {
-                        'title': title
-                    }
-                }
-            }]
-        }
-        resp = requests.post(url, json=body, headers=self.headers)
-        if resp.status_code == 200:
-            resp = resp.json()
-            if resp['code'] == 0:
-                self._update_meta_info()
-                properties = list(resp['data']['replies'][0].values())[0]['properties']
-                sheet_id, title, index = properties['sheetId'], properties['title'], properties['index']
-                logger.info(f'Copy Sheet Successfully: index={index}, sheet_id={sheet_id}, title={title}')
-                return sheet_id, index
-            else:
-                logger.error(f'Copy Sheet Failed: {resp}')
-                return None, None
+        result = self.sheet_batch().copy_sheet(title, sheet).commit(update=update)[0]
+        return result if result else (None, None)
 
-    def _delete_sheet(self, sheet=0):
+    def _delete_sheet(self, sheet=0, update=True):
         """
         删除sheet
         doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet-sheet/operate-sheets
-        update: 20230726
+        update: 20261019
         :param sheet:
+        :param update:
         :return:
         """
-        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
-        url = f'{self.api_url_v2}/sheets_batch_update'      # 其他url是v3，它是v2
-        body = {
-            'requests': [{
-                'deleteSheet': {
-                    'sheetId': sheet_id
-                }
-            }]
-        }
-        resp = requests.post(url, json=body, headers=self.headers)
-        if resp.status_code == 200:
-            resp = resp.json()
-            if resp['code'] == 0:
-                info = list(resp['data']['replies'][0].values())[0]
-                result, sheet_id = info['result'], info['sheetId']
-                if result:
-                    self._update_meta_info()
-                    logger.info(f'Delete Sheet Successfully: sheet_id={sheet_id}')
-            else:
-                logger.error(f'Delete Sheet Failed: {resp}')
+        return self.sheet_batch().delete_sheet(sheet).commit(update=update)[0]
 
-    def _change_sheet(self, sheet, title=None, index=None, hidden=None, lock=None, users=None):
+    def _change_sheet(self, sheet, title=None, index=None, hidden=None, lock=None, users=None, update=True):
         """
         更新sheet属性：更新标题，移动index，隐藏sheet，锁定sheet
         doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/spreadsheet-sheet/update-sheet-properties
-        update: 20230726
+        update: 20261019
         :param sheet:
         :param title:
         :param index:
         :param hidden:
         :param lock:
         :param users:
+        :param update:
         :return:
         """
-        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
-        url = f'{self.api_url_v2}/sheets_batch_update'      # 其他url是v3，它是v2
-        properties = {'sheetId': sheet_id}
-        if title:
-            properties.update({'title': title})
-        if index:
-            properties.update({'index': index})
-        if hidden:
-            properties.update({'hidden': hidden})
-        if lock:
-            properties.update({'protect': {'lock': lock}})
-            if users:
-                properties.update({'protect': {'lock': lock, 'userIDs': users}})
-        body = {
-            'requests': [{
-                'updateSheet': {
-                    'properties': properties
-                }
-            }]
-        }
-        resp = requests.post(url, json=body, headers=self.headers)
-        if resp.status_code == 200:
-            resp = resp.json()
-            if resp['code'] == 0:
-                self._update_meta_info()
-                logger.info(f'Change Sheet Meta Info Successfully: sheet_id={sheet_id}, title={title}, index={index}, '
-                            f'hidden={hidden}, lock={lock}, users={users}')
-            else:
-                logger.error(f'Change Sheet Meta Info Failed: {resp}')
+        return self.sheet_batch().change_sheet(sheet, title, index, hidden, lock, users).commit(update=update)[0]
 
     def _prepend_data(self, cell_start, cell_end, values, sheet=0, update=True):
         """
@@ -340,7 +641,7 @@ class SpreadSheet(object):
                 'values': values
             }
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -348,6 +649,7 @@ class SpreadSheet(object):
                     self._update_meta_info()
                 data = resp['data']
                 table_range, revision, updates = data['tableRange'], data['revision'], data['updates']
+                self.revision = revision
                 range, cells = updates['updatedRange'], updates['updatedCells']
                 rows, columns = updates['updatedRows'], updates['updatedColumns']
                 logger.info(f'Prepend Data Successfully: range={range}, {rows} rows, {columns} columns, {cells} cells')
@@ -379,7 +681,7 @@ class SpreadSheet(object):
                 'values': values
             }
         }
-        resp = requests.post(url, params=params, json=body, headers=self.headers)
+        resp = transport.post(url, params=params, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
@@ -387,6 +689,7 @@ class SpreadSheet(object):
                     self._update_meta_info()
                 data = resp['data']
                 table_range, revision, updates = data['tableRange'], data['revision'], data['updates']
+                self.revision = revision
                 range, cells = updates['updatedRange'], updates['updatedCells']
                 rows, columns = updates['updatedRows'], updates['updatedColumns']
                 if FEISHU_VERBOSE in ['spreadsheet', 'all']:
@@ -416,13 +719,14 @@ class SpreadSheet(object):
                 'values': values
             }
         }
-        resp = requests.put(url, json=body, headers=self.headers)
+        resp = transport.put(url, json=body, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
                 if update:
                     self._update_meta_info()
                 data = resp['data']
+                self.revision = data.get('revision', self.revision)
                 range, cells = data['updatedRange'], data['updatedCells']
                 rows, columns = data['updatedRows'], data['updatedColumns']
                 logger.info(f'Write Data Successfully: range={range}, {rows} rows, {columns} columns, {cells} cells')
@@ -430,6 +734,216 @@ class SpreadSheet(object):
             else:
                 logger.error(f'Write Data Failed: {resp}')
 
+    def _write_ranges(self, ranges, sheet=0, update=True):
+        """
+        向多个range范围写入数据，1次请求
+        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/data-operation/write-data-to-multiple-ranges
+        update: 20261019
+        :param ranges: 形如[(cell_start, cell_end, values), ...]
+        :param sheet:
+        :param update:
+        :return: 实际写入的range列表
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        url = f'{self.api_url_v2}/values_batch_update'
+        body = {
+            'valueRanges': [
+                {
+                    'range': f'{sheet_id}!{cell_start}:{cell_end}',
+                    'values': values
+                } for cell_start, cell_end, values in ranges
+            ]
+        }
+        resp = transport.post(url, json=body, headers=self.headers)
+        if resp.status_code == 200:
+            resp = resp.json()
+            if resp['code'] == 0:
+                if update:
+                    self._update_meta_info()
+                self.revision = resp['data'].get('revision', self.revision)
+                responses = resp['data']['responses']
+                cells = sum(x['updatedCells'] for x in responses)
+                logger.info(f'Write Ranges Successfully: {len(responses)} ranges, {cells} cells')
+                return [x['updatedRange'] for x in responses]
+            else:
+                logger.error(f'Write Ranges Failed: {resp}')
+
+    def _write_ranges_batch(self, ranges, sheet=0, max_num=WRITE_RANGES_MAX_NUM, max_cells=WRITE_RANGES_MAX_CELLS):
+        """
+        调用_write_ranges写入大量range：按range数和cell数分批，每批1次请求(不update元数据)，某批失败时抛出ValueError
+        :param ranges: 形如[(cell_start, cell_end, values), ...]
+        :param sheet:
+        :param max_num: 单次请求最多包含的range数
+        :param max_cells: 单次请求最多写入的cell数
+        :return: 请求次数
+        """
+        n_requests = 0
+        batch, batch_cells = [], 0
+        for r in ranges + [None]:
+            r_cells = sum(len(row) for row in r[2]) if r else 0
+            if batch and (r is None or len(batch) >= max_num or batch_cells + r_cells > max_cells):
+                if self._write_ranges(batch, sheet, update=False) is None:
+                    raise ValueError(f'Write Ranges Failed: {n_requests} batches written, failed at {batch[0][0]}')
+                n_requests += 1
+                batch, batch_cells = [], 0
+            if r is not None:
+                batch.append(r)
+                batch_cells += r_cells
+        return n_requests
+
+    def _add_dimension(self, major_dimension, length, sheet=0, update=True):
+        """
+        在sheet末尾增加行或列
+        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/sheet-rowcol/add-rows-or-columns
+        update: 20261019
+        :param major_dimension: ROWS或COLUMNS
+        :param length: 增加的行数或列数，单次最多DIMENSION_MAX_NUM
+        :param sheet:
+        :param update:
+        :return:
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        url = f'{self.api_url_v2}/dimension_range'
+        body = {
+            'dimension': {
+                'sheetId': sheet_id,
+                'majorDimension': major_dimension,
+                'length': length
+            }
+        }
+        resp = transport.post(url, json=body, headers=self.headers)
+        if resp.status_code == 200:
+            resp = resp.json()
+            if resp['code'] == 0:
+                if update:
+                    self._update_meta_info()
+                data = resp['data']
+                logger.info(f'Add Dimension Successfully: sheet_id={sheet_id}, {data["addCount"]} {major_dimension}')
+                return data['addCount']
+            else:
+                logger.error(f'Add Dimension Failed: {resp}')
+
+    def _delete_dimension(self, major_dimension, start_index, end_index, sheet=0, update=True):
+        """
+        删除sheet的行或列
+        doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/sheet-rowcol/-delete-rows-or-columns
+        update: 20261019
+        :param major_dimension: ROWS或COLUMNS
+        :param start_index: 起始位置(从1开始)，包含
+        :param end_index: 结束位置，包含，单次最多删除DIMENSION_MAX_NUM行或列
+        :param sheet:
+        :param update:
+        :return: 删除的行数或列数，失败时返回None
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        url = f'{self.api_url_v2}/dimension_range'
+        body = {
+            'dimension': {
+                'sheetId': sheet_id,
+                'majorDimension': major_dimension,
+                'startIndex': start_index,
+                'endIndex': end_index
+            }
+        }
+        resp = transport.delete(url, json=body, headers=self.headers)
+        if resp.status_code == 200:
+            resp = resp.json()
+            if resp['code'] == 0:
+                if update:
+                    self._update_meta_info()
+                data = resp['data']
+                logger.info(f'Delete Dimension Successfully: sheet_id={sheet_id}, {data["delCount"]} {major_dimension}')
+                return data['delCount']
+            else:
+                logger.error(f'Delete Dimension Failed: {resp}')
+
+    def _shrink_grid(self, row_count, column_count, sheet=0):
+        """
+        删除sheet中row_count行、column_count列以外的行列(从末尾开始，超过DIMENSION_MAX_NUM时分批)，用于清除上次写入的残留数据
+        依赖当前元数据中的grid_properties，调用前需保证元数据是最新的
+        :param row_count: 保留的行数，至少1
+        :param column_count: 保留的列数，至少1
+        :param sheet:
+        :return:
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        grid_properties = dict(self.sheets[self.sheet_id2index[sheet_id]]['grid_properties'])
+        for major_dimension, key, keep in [('ROWS', 'row_count', max(row_count, 1)),
+                                           ('COLUMNS', 'column_count', max(column_count, 1))]:
+            end = grid_properties[key]
+            while end > keep:
+                start = max(keep + 1, end - DIMENSION_MAX_NUM + 1)
+                if not self._delete_dimension(major_dimension, start, end, sheet_id, update=False):
+                    raise ValueError(f'Delete Dimension Failed: sheet_id={sheet_id}, {major_dimension} {start}:{end}')
+                end = start - 1
+
+    def _ensure_grid(self, row_count, column_count, sheet=0):
+        """
+        确保sheet至少有row_count行、column_count列，不够时扩展(行和列各1次请求，超过DIMENSION_MAX_NUM时分批)
+        依赖当前元数据中的grid_properties，调用前需保证元数据是最新的
+        :param row_count:
+        :param column_count:
+        :param sheet:
+        :return:
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        grid_properties = self.sheets[self.sheet_id2index[sheet_id]]['grid_properties']
+        for major_dimension, key, count in [('ROWS', 'row_count', row_count), ('COLUMNS', 'column_count', column_count)]:
+            current = grid_properties[key]
+            while current < count:
+                length = min(count - current, DIMENSION_MAX_NUM)
+                if not self._add_dimension(major_dimension, length, sheet_id, update=False):
+                    break
+                current += length
+                self._grow_grid(sheet_id, key, current)
+
+    def _write_values(self, values, x_start, y_start, sheet=0, max_num=1000, strict=True):
+        """
+        从(x_start, y_start)开始，按预先计算的绝对范围调用_write_range写入二维数组values(不update元数据)
+        每批最多max_num行、WRITE_MAX_COLUMNS列，sheet行列不够时先扩展
+        :param values: 二维数组
+        :param x_start:
+        :param y_start:
+        :param sheet:
+        :param max_num:
+        :param strict: 为True(默认)时某批写入失败则抛出ValueError，避免调用方在缺失数据的位置之后继续写入；为False时只记录日志
+        :return: 写入区域下方第1行的行号(从0开始)
+        """
+        if not values:
+            return x_start
+        n_rows, n_cols = len(values), max(len(x) for x in values)
+        self._ensure_grid(x_start + n_rows, y_start + n_cols, sheet)
+        max_num = min(max_num, WRITE_MAX_ROWS)
+        for i in range(0, n_rows, max_num):
+            rows = values[i: i + max_num]
+            for j in range(0, n_cols, WRITE_MAX_COLUMNS):
+                block = [row[j: j + WRITE_MAX_COLUMNS] for row in rows]
+                cell_start = xy_to_cell(x_start + i, y_start + j)
+                cell_end = xy_to_cell(x_start + i + len(rows) - 1, y_start + j + max(len(x) for x in block) - 1)
+                logger.info(f'Range: {cell_start}:{cell_end}')
+                if self._write_range(cell_start, cell_end, block, sheet, update=False) is None and strict:
+                    raise ValueError(f'Write Values Failed: range={cell_start}:{cell_end}')
+        return x_start + n_rows
+
+    def _write_block(self, values, x_start, y_start, sheet=0):
+        """
+        从(x_start, y_start)开始写入二维数组(行数不超过WRITE_MAX_ROWS)，按WRITE_MAX_COLUMNS列拆分，
+        不扩展sheet行列、不update元数据，可在多个线程中并发调用，失败时抛出ValueError
+        :param values: 二维数组，各行长度可以不同，不足的补None
+        :param x_start:
+        :param y_start:
+        :param sheet:
+        :return:
+        """
+        n_cols = max(len(row) for row in values)
+        values = [list(row) + [None] * (n_cols - len(row)) for row in values]
+        for j in range(0, n_cols, WRITE_MAX_COLUMNS):
+            block = [row[j: j + WRITE_MAX_COLUMNS] for row in values]
+            cell_start = xy_to_cell(x_start, y_start + j)
+            cell_end = xy_to_cell(x_start + len(values) - 1, y_start + j + len(block[0]) - 1)
+            if self._write_range(cell_start, cell_end, block, sheet, update=False) is None:
+                raise ValueError(f'Write Range Failed: sheet={sheet}, range={cell_start}:{cell_end}')
+
     def _write_cell(self, cell, value, sheet=0, update=True):
         """
         向单个单元格写入数据
@@ -441,39 +955,75 @@ class SpreadSheet(object):
         """
         self._write_range(cell_start=cell, cell_end=cell, values=[[value]], sheet=sheet, update=update)
 
-    def _read_range(self, cell_start, cell_end, sheet=0):
+    def _read_range(self, cell_start, cell_end, sheet=0, value_render_option='ToString'):
         """
         读取单个range范围：返回数据限制为10M
         doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/data-operation/reading-a-single-range
-        update: 20230727
+        update: 20261019
         :param cell_start:
         :param cell_end:
         :param sheet:
+        :param value_render_option: ToString表示都返回字符串，UnformattedValue表示数值返回数值(不做格式化)，
+                                    此时包含url、@人等的cell返回分段列表，可用decode_column转为文本
         :return:
         """
         sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
         url = f'{self.api_url_v2}/values/{sheet_id}!{cell_start}:{cell_end}'
         params = {
-            'valueRenderOption': 'ToString',            # 先ToString再读取，否则对于包含url的cell，会按FormattedValue来读取?
+            'valueRenderOption': value_render_option,   # 先ToString再读取，否则对于包含url的cell，会按FormattedValue来读取?
             'dateTimeRenderOption': 'FormattedString'
         }
-        resp = requests.get(url, params=params, headers=self.headers)
+        resp = transport.get(url, params=params, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
                 values = resp['data']['valueRange']['values']
+                transport.record_data(*transport.count_values(values))
                 return values
             else:
                 logger.error(f'Read Range Failed: {resp}')
                 return None
 
-    def _read_ranges(self, cells, sheet=0):
+    def _read_range_stream(self, cell_start, cell_end, sheet=0, chunk_size=1 << 16, value_render_option='ToString'):
+        """
+        流式读取单个range范围：边下载边解析data.valueRange.values，逐行yield，不在内存中保留完整的响应和JSON对象树
+        参数同_read_range，失败时抛出ValueError
+        :param cell_start:
+        :param cell_end:
+        :param sheet:
+        :param chunk_size: 每次从响应流中读取的字节数
+        :param value_render_option:
+        :return:
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        url = f'{self.api_url_v2}/values/{sheet_id}!{cell_start}:{cell_end}'
+        params = {
+            'valueRenderOption': value_render_option,
+            'dateTimeRenderOption': 'FormattedString'
+        }
+        resp = transport.get(url, params=params, headers=self.headers, stream=True)
+        with closing(resp):
+            if resp.status_code != 200:
+                logger.error(f'Read Range Failed: status_code={resp.status_code}')
+                raise ValueError(f'Read Range Failed: status_code={resp.status_code}')
+            rows, cells = 0, 0
+            try:
+                for row in iter_json_array(resp.iter_content(chunk_size=chunk_size), 'values'):
+                    rows, cells = rows + 1, cells + len(row or [])
+                    yield row
+                transport.record_data(rows, cells)
+            except ValueError as e:
+                logger.error(f'Read Range Failed: {e}')
+                raise
+
+    def _read_ranges(self, cells, sheet=0, as_list=False):
         """
         读取多个range范围
         doc: https://open.feishu.cn/document/server-docs/docs/sheets-v3/data-operation/reading-multiple-ranges
-        update: 20230727
+        update: 20261019
         :param cells: 形如[{cell_start, cell_end), (), ...]
         :param sheet:
+        :param as_list: 为True时按cells的顺序返回values列表(API返回的range可能与请求的不完全一致，按顺序对应更可靠)
         :return:
         """
         sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
@@ -483,18 +1033,67 @@ class SpreadSheet(object):
             'valueRenderOption': 'ToString',
             'dateTimeRenderOption': 'FormattedString'
         }
-        resp = requests.get(url, params=params, headers=self.headers)
+        resp = transport.get(url, params=params, headers=self.headers)
         if resp.status_code == 200:
             resp = resp.json()
             if resp['code'] == 0:
                 data = resp['data']
-                value_ranges, total_cells = data['valueRange'], data['totalCells']
+                value_ranges, total_cells = data.get('valueRanges', data.get('valueRange')), data['totalCells']
+                counts = [transport.count_values(x.get('values')) for x in value_ranges]
+                transport.record_data(sum(x[0] for x in counts), sum(x[1] for x in counts))
+                if as_list:
+                    return [x.get('values') or [] for x in value_ranges]
                 range2values = {x['range']: x['values'] for x in value_ranges}
                 return range2values
             else:
                 logger.error(f'Read Ranges Failed: {resp}')
                 return None
 
+    def _iter_range_chunks(self, cell_start, cell_end, sheet=0, chunk_size=1000, max_workers=4,
+                           value_render_option='ToString'):
+        """
+        按chunk_size行分块并发读取range，按顺序yield每块，最多同时有max_workers块在读取或等待消费，
+        内存占用与max_workers * chunk_size有关，与range大小无关，失败时抛出ValueError
+        :param cell_start:
+        :param cell_end:
+        :param sheet:
+        :param chunk_size: 每块的行数
+        :param max_workers: 并发读取的块数
+        :param value_render_option: 见_read_range
+        :return: 迭代器，每个元素为(块起始行号(从0开始), 二维数组)，二维数组的行数可能少于块的行数(末尾的空行)
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        x_start, y_start = cell_to_xy(cell_start)
+        x_end, y_end = cell_to_xy(cell_end)
+        deadline = transport.get_deadline()       # 读取线程继承调用线程的截止时间
+
+        def read_chunk(x):
+            with transport.deadline(at=deadline):
+                values = self._read_range(xy_to_cell(x, y_start), xy_to_cell(min(x_end, x + chunk_size - 1), y_end),
+                                          sheet_id, value_render_option)
+            if values is None:
+                raise ValueError(f'Read Range Failed: sheet_id={sheet_id}, row={x}')
+            return values
+
+        starts = iter(range(x_start, x_end + 1, chunk_size))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = deque()
+            for x in starts:
+                futures.append((x, executor.submit(read_chunk, x)))
+                if len(futures) >= max_workers:
+                    break
+            try:
+                while futures:
+                    x, future = futures.popleft()
+                    values = future.result()
+                    for x_next in starts:
+                        futures.append((x_next, executor.submit(read_chunk, x_next)))
+                        break
+                    yield x, values
+            finally:
+                for _, future in futures:
+                    future.cancel()
+
     def _write_image(self, cell, image=None, image_path=None, image_type=None, name=None, sheet=0, update=True):
         """
         向一个cell写入一张图片，可以直接指定image（优先），也可以指定image文件和类型（以生成image）
@@ -520,7 +1119,7 @@ class SpreadSheet(object):
             'image': image,
             'name': name if name else f'test.{image_type}'
         }
-        resp = requests.post(url, json=body, headers=self.headers)
+        resp = transport.post(url, json=body, headers=self.headers)
         if resp.status_code == 200:         # 需要先判断status_code为200，才能使用json()函数，否则会报错，其他地方同理
             resp = resp.json()
             if resp['code'] == 0:
@@ -531,6 +1130,7 @@ class SpreadSheet(object):
             else:
                 logger.error(f'Write Image Failed: {resp}')
 
+    @profiled
     def write_image(self, image_paths, spreadsheet_token=None, sheet=0, cell_start='A1', axis='column', update=True):
         """
         调用_write_image写入图片，目前只支持写入一列或一行
@@ -556,11 +1156,12 @@ class SpreadSheet(object):
             cells = [xy_to_cell(x_start, y_start + i) for i in range(len(image_paths))]
             next_cell_start = xy_to_cell(x_start, y_start + len(image_paths))
 
-        for cell, image_path in tqdm(zip(cells, image_paths), total=len(cells)):
-            if os.path.exists(image_path):
-                self._write_image(cell, image_path=image_path, sheet=sheet, update=False)
-            else:
-                self._write_cell(cell, value=f'{image_path} not found', sheet=sheet, update=False)
+        with self.buffered() as buf:        # 找不到的图片，写入提示文字，合并为批量请求
+            for cell, image_path in tqdm(zip(cells, image_paths), total=len(cells)):
+                if os.path.exists(image_path):
+                    self._write_image(cell, image_path=image_path, sheet=sheet, update=False)
+                else:
+                    buf.write_cell(cell, value=f'{image_path} not found', sheet=sheet)
         if update:
             self._update_meta_info()  # 写完所有数据后再update
 
@@ -570,12 +1171,14 @@ class SpreadSheet(object):
         return next_cell_start
 
 
-    def write_df(self, df, spreadsheet_token=None, sheet=0, cell_start='A1', xy_start=None, max_num=1000, update=True):
+    @profiled
+    def write_df(self, df, spreadsheet_token=None, sheet=0, cell_start='A1', xy_start=None, max_num=1000, update=True,
+                 mode='append'):
         """
-        调用_append_data，把DataFrame写入sheet，从cell_start或xy_start开始写(append)，返回下一个可用的cell
+        把DataFrame写入sheet，从cell_start或xy_start开始写，返回下一个可用的cell
         支持的cell类型：数值、字符串、日期、None、URL(按字符串写入)
         不支持的cell类型：List, Dict等，若想写入，先转化为str类型；对于图片，会单独处理，此API不处理图片
-        update: 20230801
+        update: 20261019
         :param df:
         :param spreadsheet_token:
         :param sheet:
@@ -583,6 +1186,9 @@ class SpreadSheet(object):
         :param xy_start:
         :param max_num:
         :param update:
+        :param mode: append表示调用_append_data追加写入(API自行寻找第1个空行)；
+                     write表示按cell_start精确计算每批的绝对范围，调用_write_range直接覆写，sheet行列不够时会先扩展，
+                     写入位置确定且更快，适用于已明确知道目标区域的情况，某批写入失败时抛出ValueError
         :return:
         """
         if spreadsheet_token:
@@ -600,11 +1206,25 @@ class SpreadSheet(object):
         # cell_start = xy_to_cell(line_start, 0)
         # cell_end = xy_to_cell(line_start + max_num - 1, df.shape[1] - 1)
 
+        if mode == 'write':
+            with phase('serialize'):
+                values = [list(df.columns)] + [se.to_list() for _, se in tqdm(df.iterrows(), total=df.shape[0])]
+            x_next = self._write_values(values, x_start, y_start, sheet, max_num)
+            if update:
+                self._update_meta_info()    # 写完所有数据后再update
+            cell_start = letter_start + str(x_next + 1)
+            if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+                print(f'下次write_df，请从cell_start={cell_start}开始')
+            logger.info(f'下次write_df，请从cell_start={cell_start}开始')
+            return cell_start
+
         letter_end, row_end = re.findall(PATTERN, cell_end)[0]
         row_end = int(row_end)
         values = [list(df.columns)]
-        for _, se in tqdm(df.iterrows(), total=df.shape[0]):
-            values.append(se.to_list())
+        rows = df.iterrows()
+        for _ in tqdm(range(df.shape[0])):
+            with phase('serialize'):
+                values.append(next(rows)[1].to_list())
             if len(values) == max_num:      # 每次只写max_num行
                 logger.info(f'Range: {cell_start}, {cell_end}')
                 self._append_data(cell_start, cell_end, values, sheet, update=False)    # 单次写入，先不update
@@ -625,12 +1245,315 @@ class SpreadSheet(object):
         logger.info(f'下次write_df，请从cell_start={cell_start}开始')
         return cell_start
 
+    def _read_header(self, cell_start='A1', sheet=0):
+        """
+        读取cell_start所在行从cell_start开始的表头(去掉末尾的空列)，依赖当前元数据中的grid_properties
+        :param cell_start:
+        :param sheet:
+        :return: 列名列表，空sheet返回[]
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        grid_properties = self.sheets[self.sheet_id2index[sheet_id]]['grid_properties']
+        x0, _ = cell_to_xy(cell_start)
+        header = self._read_range(cell_start, xy_to_cell(x0, grid_properties['column_count'] - 1), sheet_id)
+        header = list(header[0]) if header else []
+        while header and header[-1] in [None, '']:
+            header.pop()
+        return header
+
+    def _read_key_index(self, keys, header, cell_start='A1', sheet=0, blocks=None):
+        """
+        只读取key列(表头下方直到sheet最后1行)，建立key -> 行号索引，依赖当前元数据中的grid_properties
+        key统一用normalize_value转化为字符串元组，key全为空的行忽略，重复的key取第1次出现的行
+        :param keys: key列名列表
+        :param header: 表头，见_read_header
+        :param cell_start: 表头左上角
+        :param sheet:
+        :param blocks: 上次调用的分块结果(块起始行号 -> (内容hash, 块内key2row, 块内x_last))，传入时原地更新，
+                       只重新解析内容hash有变化的块；key列位置变化时需要传入空字典
+        :return: (key2row, x_last)，key2row形如{('id1',): 5, ...}，x_last是最后1个非空key所在行号(没有时为表头行号)
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        grid_properties = self.sheets[self.sheet_id2index[sheet_id]]['grid_properties']
+        x0, y0 = cell_to_xy(cell_start)
+        x_end = grid_properties['row_count'] - 1
+        key_cols = [y0 + header.index(x) for x in keys]
+        blocks = {} if blocks is None else blocks
+        starts = list(range(x0 + 1, x_end + 1, KEY_READ_MAX_NUM))
+        parsed = 0
+        for x in starts:
+            cells = [(xy_to_cell(x, y), xy_to_cell(min(x_end, x + KEY_READ_MAX_NUM - 1), y)) for y in key_cols]
+            values_list = self._read_ranges(cells, sheet_id, as_list=True)
+            assert values_list is not None, '读取key列失败'
+            digest = values_digest(values_list)
+            if x in blocks and blocks[x][0] == digest:
+                continue
+            block_key2row, block_x_last = {}, None
+            key_values = [[row[0] if row else None for row in values] for values in values_list]
+            for i, row_key in enumerate(zip(*key_values)):
+                row_key = tuple(normalize_value(v) for v in row_key)
+                if any(row_key):
+                    if row_key in block_key2row:
+                        logger.warning(f'Duplicate Key: key={row_key}, rows={block_key2row[row_key] + 1}, {x + i + 1}')
+                    block_key2row.setdefault(row_key, x + i)
+                    block_x_last = x + i
+            blocks[x] = (digest, block_key2row, block_x_last)
+            parsed += 1
+        for x in [x for x in blocks if x not in starts]:
+            del blocks[x]
+        key2row, x_last = {}, x0
+        for x in starts:
+            _, block_key2row, block_x_last = blocks[x]
+            for row_key, row in block_key2row.items():
+                if row_key in key2row:
+                    logger.warning(f'Duplicate Key: key={row_key}, rows={key2row[row_key] + 1}, {row + 1}')
+                else:
+                    key2row[row_key] = row
+            if block_x_last is not None:
+                x_last = block_x_last
+        logger.info(f'Read Key Index: sheet_id={sheet_id}, {parsed}/{len(starts)} blocks parsed, {len(key2row)} keys')
+        return key2row, x_last
+
+    def _read_shard_meta(self):
+        """
+        读取SHARD_META_SHEET中write_df_sharded的写入记录，没有该sheet时返回空字典
+        :return: sheet_id -> (写入行数(含表头), 写入列数, [续表sheet_id, ...])
+        """
+        meta_id = self.sheet_title2id.get(SHARD_META_SHEET)
+        if meta_id is None:
+            return {}
+        grid_properties = self.sheets[self.sheet_id2index[meta_id]]['grid_properties']
+        values = self._read_range('A1', xy_to_cell(grid_properties['row_count'] - 1,
+                                                    grid_properties['column_count'] - 1), meta_id)
+        if values is None:
+            raise ValueError(f'Read Shard Meta Failed: sheet_id={meta_id}')
+        meta = {}
+        for row in values:
+            row = [str(x) for x in (row or []) if x is not None and x != '']
+            if len(row) >= 3:
+                meta[row[0]] = (int(float(row[1])), int(float(row[2])), row[3:])
+        return meta
+
+    def _write_shard_meta(self, meta, old_meta):
+        """
+        覆写SHARD_META_SHEET，old_meta中多出的行列写入None清空；只保留仍然存在的sheet的记录
+        :param meta: 同_read_shard_meta的返回值
+        :param old_meta: 覆写前的记录
+        :return:
+        """
+        rows = [[sheet_id, n_rows, n_cols] + list(shards) for sheet_id, (n_rows, n_cols, shards) in meta.items()
+                if sheet_id in self.sheet_id2index]
+        width = max([len(x) for x in rows] + [3 + len(x[2]) for x in old_meta.values()])
+        rows += [[]] * (len(old_meta) - len(rows))
+        if rows:
+            self._write_values([row + [None] * (width - len(row)) for row in rows], 0, 0,
+                               self.sheet_title2id[SHARD_META_SHEET], strict=True)
+
+    def _shard_sheet_ids(self, sheet=0, meta=None):
+        """
+        获取分片sheet：sheet本身，以及write_df_sharded创建并记录在SHARD_META_SHEET中的续表
+        只认标题依次为{sheet_title}_2, {sheet_title}_3, ...的连续记录，改名、删除或中断之后的sheet都不视为分片
+        :param sheet:
+        :param meta: _read_shard_meta的返回值，为None时读取
+        :return: [(分片序号, sheet_id), ...]，按分片序号排序，sheet本身的序号为1
+        """
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        title = self.sheets[self.sheet_id2index[sheet_id]]['title']
+        meta = self._read_shard_meta() if meta is None else meta
+        shards = [(1, sheet_id)]
+        for i, shard_id in enumerate(meta.get(sheet_id, (0, 0, []))[2], 2):
+            if self.sheet_title2id.get(f'{title}_{i}') != shard_id:
+                break
+            shards.append((i, shard_id))
+        return shards
+
+    @profiled
+    def write_df_sharded(self, df, spreadsheet_token=None, sheet=0, max_rows=SHEET_MAX_ROWS, max_cells=SHEET_MAX_CELLS,
+                         max_num=1000, max_workers=4):
+        """
+        分片写入超大DataFrame：按列数和单sheet行数、cell数上限，计算每个sheet能写入的行数，超出部分写入续表
+        续表标题为{sheet_title}_2, {sheet_title}_3, ...，每个分片都从A1开始写入并重复表头，多个分片并发写入
+        创建的续表和写入区域记录在隐藏的SHARD_META_SHEET中：
+        - 上次创建的续表先删除再重建(与新建续表在同1次sheets_batch_update中完成)，续表删除数据区域以外的行列；
+          不是本函数创建的sheet不会被删除，与续表标题冲突时抛出ValueError
+        - 第1个分片所在的sheet不删除行列，只把上次写入区域中本次没有覆盖的cell写入None清空，区域外的内容保持不变
+        读取时使用read_sheet(..., sharded=True)拼接所有分片
+        update: 20261019
+        :param df:
+        :param spreadsheet_token:
+        :param sheet: 第1个分片所在的sheet
+        :param max_rows: 单个sheet最多行数(含表头)
+        :param max_cells: 单个sheet最多cell数
+        :param max_num: 单次写入的最多行数
+        :param max_workers: 并发写入的分片数
+        :return: [(sheet_id, 数据行数), ...]
+        """
+        if spreadsheet_token:
+            self._set_spreadsheet_token(spreadsheet_token)
+        else:
+            assert self.spreadsheet_token is not None, '没有spreadsheet_token，需要指定！'
+            self._update_meta_info()
+
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        title = self.sheets[self.sheet_id2index[sheet_id]]['title']
+        n_cols = max(df.shape[1], 1)
+        rows_per_sheet = min(max_rows, max_cells // n_cols) - 1
+        assert rows_per_sheet > 0, f'列数太多({df.shape[1]})，单个sheet无法写入'
+        n_shards = max(1, -(-df.shape[0] // rows_per_sheet))
+
+        meta = self._read_shard_meta()
+        old_rows, old_cols, _ = meta.get(sheet_id, (0, 0, []))
+        old_shards = [x for _, x in self._shard_sheet_ids(sheet_id, meta)[1:]]
+        for i in range(2, n_shards + 1):
+            other = self.sheet_title2id.get(f'{title}_{i}')
+            if other is not None and other not in old_shards:
+                raise ValueError(f'续表标题{title}_{i}已被其他sheet(sheet_id={other})占用，请先改名或删除')
+
+        if old_shards or n_shards > 1 or SHARD_META_SHEET not in self.sheet_title2id:
+            batch = self.sheet_batch()
+            for old_id in old_shards:
+                batch.delete_sheet(old_id)
+            index = self.sheet_id2index[sheet_id]
+            for i in range(2, n_shards + 1):
+                batch.add_sheet(f'{title}_{i}', index=index + i - 1)
+            if SHARD_META_SHEET not in self.sheet_title2id:
+                batch.add_sheet(SHARD_META_SHEET).change_sheet(SHARD_META_SHEET, hidden=True)
+            results = batch.commit()
+            if any(x is None for x in results):
+                raise ValueError(f'Create Shard Sheets Failed: {results}')
+        shard_ids = [sheet_id] + [self.sheet_title2id[f'{title}_{i}'] for i in range(2, n_shards + 1)]
+        for i, shard_id in enumerate(shard_ids[1:], 1):
+            self._shrink_grid(min(df.shape[0] - i * rows_per_sheet, rows_per_sheet) + 1, n_cols, shard_id)
+        self._update_meta_info()
+
+        n_rows = min(df.shape[0], rows_per_sheet) + 1
+        pending = dict(meta)        # 先记录续表和可能写入的区域，写入中途失败时下次仍能清除和删除
+        pending[sheet_id] = (max(n_rows, old_rows), max(n_cols, old_cols), shard_ids[1:])
+        self._write_shard_meta(pending, meta)
+
+        header = list(df.columns)
+        df = df.astype(object).where(df.notna(), None)
+
+        deadline = transport.get_deadline()
+
+        def write_shard(i):
+            part = df.iloc[i * rows_per_sheet: (i + 1) * rows_per_sheet]
+            values = [header] + [list(row) for row in part.itertuples(index=False)]
+            if i == 0:      # 上次写入区域中本次没有覆盖的cell写入None
+                width = max(n_cols, old_cols)
+                values = [row + [None] * (width - len(row)) for row in values]
+                values += [[None] * width for _ in range(old_rows - len(values))]
+            with transport.deadline(at=deadline):
+                self._write_values(values, 0, 0, shard_ids[i], max_num, strict=True)
+            return shard_ids[i], part.shape[0]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            result = list(executor.map(write_shard, range(n_shards)))
+        self._update_meta_info()
+        written = dict(pending)
+        written[sheet_id] = (n_rows, n_cols, shard_ids[1:])
+        self._write_shard_meta(written, pending)
+        if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+            print(f'Write DataFrame Sharded Successfully: {result}')
+        logger.info(f'Write DataFrame Sharded Successfully: {result}')
+        return result
+
+    @profiled
+    def upsert_df(self, df, key='id', spreadsheet_token=None, sheet=0, cell_start='A1', max_num=1000, update=True):
+        """
+        按key列把DataFrame合并进sheet：已有key的行只在内容变化时覆写，新key追加到数据末尾，其他行不动
+        只读取表头、key列和命中的行，变化的行合并为连续区域后批量写入，改几行只需少量请求
+        sheet中以cell_start所在行为表头，df的列必须都在表头中，df中没有的列保持sheet原值
+        update: 20261019
+        :param df:
+        :param key: key列名，多列组合为key时传列表
+        :param spreadsheet_token:
+        :param sheet:
+        :param cell_start: 表头左上角
+        :param max_num: 单次写入的最多行数
+        :param update:
+        :return: 统计信息，形如{'updated': 3, 'appended': 2, 'unchanged': 95}
+        """
+        if spreadsheet_token:
+            self._set_spreadsheet_token(spreadsheet_token)
+        else:
+            assert self.spreadsheet_token is not None, '没有spreadsheet_token，需要指定！'
+            self._update_meta_info()
+
+        keys = [key] if isinstance(key, str) else list(key)
+        sheet_id = self.sheet_index2id.get(sheet, self.sheet_title2id.get(sheet, sheet))
+        x0, y0 = cell_to_xy(cell_start)
+        header = self._read_header(cell_start, sheet_id)
+        if not header:                      # 空sheet，直接写入
+            self.write_df(df, sheet=sheet_id, cell_start=cell_start, max_num=max_num, update=update, mode='write')
+            return {'updated': 0, 'appended': df.shape[0], 'unchanged': 0}
+        missing = [x for x in list(df.columns) if x not in header]
+        assert not missing, f'df的列{missing}不在sheet表头中'
+        assert all(x in df.columns for x in keys), f'df中缺少key列{keys}'
+
+        # 1. 只读取key列，建立key -> 行号索引
+        key2row, x_last = self._read_key_index(keys, header, cell_start, sheet_id)
+
+        # 2. 读取命中的行，与新数据对比
+        df = df.astype(object).where(df.notna(), None)
+        df_keys = [tuple(normalize_value(v) for v in row) for row in df[keys].itertuples(index=False)]
+        positions = [header.index(x) for x in df.columns]
+        hit = sorted({key2row[k] for k in df_keys if k in key2row})
+        y_end = y0 + len(header) - 1
+        current = {}
+        runs = group_consecutive(hit)
+        for i in range(0, len(runs), READ_RANGES_MAX_NUM):
+            cells = [(xy_to_cell(a, y0), xy_to_cell(b, y_end)) for a, b in runs[i: i + READ_RANGES_MAX_NUM]]
+            values_list = self._read_ranges(cells, sheet_id, as_list=True)
+            assert values_list is not None, '读取sheet数据失败'
+            for (a, b), values in zip(runs[i: i + READ_RANGES_MAX_NUM], values_list):
+                for j in range(b - a + 1):
+                    row = list(values[j]) if j < len(values) else []
+                    current[a + j] = row + [None] * (len(header) - len(row))
+
+        changed, appended, unchanged = {}, {}, 0     # df中重复的key同样以后出现的为准，新key只追加1行
+        for df_key, row in zip(df_keys, df.itertuples(index=False)):
+            x = key2row.get(df_key)
+            if x is None:
+                new_row = list(appended.get(df_key, [None] * len(header)))
+                for p, v in zip(positions, row):
+                    new_row[p] = v
+                appended[df_key] = new_row
+                continue
+            old_row = changed.get(x, current[x])
+            new_row = list(old_row)
+            for p, v in zip(positions, row):
+                new_row[p] = v
+            if [normalize_value(v) for v in new_row] != [normalize_value(v) for v in current[x]]:
+                changed[x] = new_row
+            else:
+                unchanged += 1
+
+        # 3. 变化的行合并为连续区域，只写df中有的列(不回写按字符串读到的其他列)，批量写入；新key追加到最后1行数据之后
+        ranges = [(xy_to_cell(a, y0 + c), xy_to_cell(b, y0 + d), [changed[x][c: d + 1] for x in range(a, b + 1)])
+                  for a, b in group_consecutive(sorted(changed))
+                  for c, d in group_consecutive(sorted(header.index(x) for x in df.columns if x not in keys))]
+        self._write_ranges_batch(ranges, sheet_id)
+        if appended:
+            self._write_values(list(appended.values()), x_last + 1, y0, sheet_id, max_num)
+        if update:
+            self._update_meta_info()
+
+        result = {'updated': len(changed), 'appended': len(appended), 'unchanged': unchanged}
+        if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+            print(f'Upsert DataFrame Successfully: {result}')
+        logger.info(f'Upsert DataFrame Successfully: {result}')
+        return result
+
+    @profiled
     def read_sheet(self, spreadsheet_token=None, sheet=0, cell_start='A1', cell_end=None,
-                   xy_start=(0, 0), xy_end=None, has_cols=True, col_names=None, max_num=1000):
+                   xy_start=(0, 0), xy_end=None, has_cols=True, col_names=None, max_num=1000, stream=False,
+                   sharded=False, dtypes=None, infer_types=False, output='pandas', where=None, columns=None,
+                   max_workers=1, drop_trailing_empty=False):
         """
         调用read_range，读取某sheet中某区域的数据，可指定cell_start到cell_end，或xy_start到xy_end
         没指定区域的话，可自行判断所有有效区域，建议明确指定起始cell，尤其是cell_end
-        update: 20230817
+        update: 20261019
         :param spreadsheet_token:
         :param sheet:
         :param cell_start:
@@ -640,6 +1563,21 @@ class SpreadSheet(object):
         :param has_cols: range内第1行是不是列名
         :param col_names: 若range第1行不是列名，指定列名为col_names
         :param max_num:
+        :param stream: 是否调用_read_range_stream流式解析响应，逐行放入按列存储的缓冲区，不构建完整的JSON对象树和行列表，
+                       大范围读取时可明显降低内存峰值
+        :param sharded: 是否读取write_df_sharded写入的所有分片(sheet及其续表)，并拼接为1个DataFrame
+        :param dtypes: 所有列的目标类型，或列名 -> 目标类型的字典，如{'age': 'int64', 'date': 'datetime64[ns]'}，
+                       指定后按UnformattedValue读取，按列向量化转化，见decode_column
+        :param infer_types: 是否按UnformattedValue读取并推断类型：纯数值列转为int64/float64，其他列为object，
+                            默认False，即所有值都按字符串读取(同之前)
+        :param output: 返回类型，pandas(DataFrame)、arrow(pyarrow.Table)、polars(polars.DataFrame)、
+                       dict(列名 -> 列表)或records(每行1个字典的列表)，数据按列拼接后直接构建，不经过pandas
+        :param where: 行过滤条件，每读到1块就过滤1次，只保留满足条件的行，内存占用与结果大小有关，与sheet大小无关
+                      可以是函数，输入1块数据的DataFrame(已按dtypes/infer_types转化类型)，返回bool数组；
+                      也可以是DataFrame.eval表达式，如"city == 'bj' and score > 60"
+        :param columns: 只保留的列名(或列序号)列表，None表示保留所有列
+        :param max_workers: 并发读取的块数(stream=True时不并发)，读取下一块与过滤当前块同时进行
+        :param drop_trailing_empty: 是否去掉末尾的全空行(sheet的行数多于数据行数时)，sharded=True时每个分片都会去掉
         :return:
         """
         if spreadsheet_token:
@@ -648,6 +1586,23 @@ class SpreadSheet(object):
             assert self.spreadsheet_token is not None, '暂无spreadsheet_token，需要指定！'
             self._update_meta_info()        # 读之前先更新一下最新信息，因为sheet可能刚更新，如写入数据、新增sheet等
 
+        if sharded:
+            meta = self._read_shard_meta()
+            shard_ids = [x for _, x in self._shard_sheet_ids(sheet, meta)]
+            n_rows, n_cols, _ = meta.get(shard_ids[0], (None, None, []))
+            dfs = []
+            for i, x in enumerate(shard_ids):
+                shard_end = xy_end
+                if not cell_end and xy_end is None and n_cols:    # 按记录的写入列数读取，续表读到末尾，再去掉末尾的空行
+                    row_count = n_rows if i == 0 else self.sheets[self.sheet_id2index[x]]['grid_properties']['row_count']
+                    shard_end = (row_count - 1, n_cols - 1)
+                dfs.append(self.read_sheet(sheet=x, cell_start=cell_start, cell_end=cell_end, xy_start=xy_start,
+                                           xy_end=shard_end, has_cols=has_cols, col_names=col_names, max_num=max_num,
+                                           stream=stream, dtypes=dtypes, infer_types=infer_types, output=output,
+                                           where=where, columns=columns, max_workers=max_workers,
+                                           drop_trailing_empty=True))
+            return concat_outputs(dfs, output)
+
         if cell_end:                        # 若指定了cell_end，则优先使用cell_start和cell_end
             xy_start = cell_to_xy(cell_start)
             xy_end = cell_to_xy(cell_end)
@@ -660,18 +1615,350 @@ class SpreadSheet(object):
 
         x_start, y_start = xy_start
         x_end, y_end = xy_end
-        values = []
-        for x in range(x_start, x_end + 1, max_num):    # 每次只读取max_num行
-            cell_start = xy_to_cell(x, y_start)
-            cell_end = xy_to_cell(min(x_end, x + max_num - 1), y_end)
-            value = self._read_range(cell_start, cell_end, sheet)
-            values.extend(value)
-
-        if has_cols:
-            col_names = col_names if col_names else values[0]
-            return pd.DataFrame(values[1:], columns=col_names)
+        typed = dtypes is not None or infer_types
+        render = 'UnformattedValue' if typed else 'ToString'
+        n_cols = y_end - y_start + 1
+        header = None
+
+        def iter_chunks():
+            """
+            按块产生按列存储的数据，每块读到后立即拆到各列，不保留行列表；第1块的第1行是表头时先取出
+            """
+            nonlocal header
+            if stream:
+                for x in range(x_start, x_end + 1, max_num):        # 每次只读取max_num行
+                    chunk = [[] for _ in range(n_cols)]
+                    cell_range = (xy_to_cell(x, y_start), xy_to_cell(min(x_end, x + max_num - 1), y_end))
+                    for row in self._read_range_stream(*cell_range, sheet, value_render_option=render):
+                        row = row if row else []
+                        if has_cols and header is None:
+                            header = [segments_to_text(v) for v in row] + [None] * (n_cols - len(row))
+                            continue
+                        for j, column in enumerate(chunk):
+                            column.append(row[j] if j < len(row) else None)
+                    yield chunk
+                return
+            for _, rows in self._iter_range_chunks(xy_to_cell(x_start, y_start), xy_to_cell(x_end, y_end), sheet,
+                                                   max_num, max_workers, render):
+                if has_cols and header is None and rows:
+                    header = [segments_to_text(v) for v in rows[0]] + [None] * (n_cols - len(rows[0] or []))
+                    rows = rows[1:]
+                rows = [row if row and len(row) == n_cols else (list(row or []) + [None] * n_cols)[: n_cols]
+                        for row in rows]
+                yield list(zip(*rows)) if rows else [[] for _ in range(n_cols)]
+
+        def trim_chunks(chunks):
+            """
+            去掉末尾的全空行：每块末尾的全空行先暂存，后面的块中出现数据时再与之拼接产生，最后剩下的丢弃
+            """
+            pending = [[] for _ in range(n_cols)]
+            for chunk in chunks:
+                n_rows = len(chunk[0]) if chunk else 0
+                last = next((i for i in range(n_rows - 1, -1, -1)
+                             if any(column[i] is not None and column[i] != '' for column in chunk)), None)
+                if last is None:
+                    for column, values in zip(pending, chunk):
+                        column.extend(values)
+                    continue
+                yield [column + list(values[: last + 1]) for column, values in zip(pending, chunk)]
+                pending = [list(values[last + 1:]) for values in chunk]
+
+        keep, all_names, names, result, frames = None, None, None, None, []
+        for chunk in (trim_chunks(iter_chunks()) if drop_trailing_empty else iter_chunks()):
+            if keep is None:                # 读到第1块后才知道表头，确定保留的列
+                all_names = list(col_names) if col_names else (header or list(range(n_cols)))
+                keep = list(range(len(all_names)))
+                if columns is not None:
+                    missing = [c for c in columns if c not in all_names and not isinstance(c, int)]
+                    assert not missing, f'列{missing}不存在：{all_names}'
+                    keep = [all_names.index(c) if c in all_names else c for c in columns]
+                names = [all_names[j] for j in keep]
+                result = [[] for _ in keep]
+            if where is None:
+                for column, j in zip(result, keep):
+                    column.extend(chunk[j])
+                continue
+            with phase('filter'):           # 过滤条件可以引用所有列，过滤后再只保留columns
+                df = build_output(chunk[: len(all_names)], all_names, 'pandas', dtypes, infer_types)
+                mask = np.asarray(df.eval(where) if isinstance(where, str) else where(df), dtype=bool)
+                if output == 'pandas':
+                    frames.append(df.iloc[mask, keep])
+                else:
+                    index = np.flatnonzero(mask)
+                    for column, j in zip(result, keep):
+                        column.extend(chunk[j][i] for i in index)
+            del chunk, df
+
+        with phase('to_dataframe'):
+            if keep is None:                # 范围内没有数据
+                names = list(col_names) if col_names else header
+                result = [[] for _ in range(len(names) if names else n_cols)]
+            if frames:
+                return pd.concat(frames, ignore_index=True)
+            return build_output(result, names, output, dtypes, infer_types)
+
+
+class SheetBatch(object):
+    """
+    sheet结构操作的批处理器：先排队添加、复制、删除、更新sheet等操作，commit时合并为尽量少的sheets_batch_update请求，
+    所有请求完成后只更新1次元数据。比如新建30个sheet，只需1次sheets_batch_update加1次元数据更新
+    用法：
+        batch = spsh.sheet_batch()
+        batch.add_sheet('t1').copy_sheet('t2', sheet='t1').delete_sheet('Sheet1')
+        results = batch.commit()
+    或者：
+        with spsh.sheet_batch() as batch:
+            batch.add_sheet('t1')
+    备注：
+    - sheet参数可以是sheet_id, sheet_title或sheet_index，其中sheet_index指的是本批操作开始前的序号
+    - 可以引用本批内新建或改名后的sheet_title，此时会在该操作前切分请求，以便拿到新sheet的sheet_id
+    """
+    def __init__(self, spsh, max_num=SHEETS_BATCH_MAX_NUM):
+        self.spsh = spsh
+        self.max_num = max_num
+        self.ops = []                           # [(op_type, payload), ...]
+        self.num_sheets = len(spsh.sheets)      # 用于计算负数index，考虑了已排队的添加和删除
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+    def add_sheet(self, title, index=-1):
+        """
+        :param title:
+        :param index: 同SpreadSheet._add_sheet
+        :return: self，支持链式调用
+        """
+        self.num_sheets += 1
+        index = self.num_sheets + index if index < 0 else index
+        self.ops.append(('addSheet', {'title': title, 'index': index}))
+        return self
+
+    def copy_sheet(self, title, sheet=0):
+        self.num_sheets += 1
+        self.ops.append(('copySheet', {'title': title, 'sheet': sheet}))
+        return self
+
+    def delete_sheet(self, sheet=0):
+        self.num_sheets -= 1
+        self.ops.append(('deleteSheet', {'sheet': sheet}))
+        return self
+
+    def change_sheet(self, sheet, title=None, index=None, hidden=None, lock=None, users=None):
+        self.ops.append(('updateSheet', {'sheet': sheet, 'title': title, 'index': index, 'hidden': hidden,
+                                         'lock': lock, 'users': users}))
+        return self
+
+    def _build_request(self, op_type, payload, sheet_id):
+        """
+        把排队的操作转化为sheets_batch_update中的单个request
+        """
+        if op_type == 'addSheet':
+            return {'addSheet': {'properties': {'title': payload['title'], 'index': payload['index']}}}
+        if op_type == 'copySheet':
+            return {'copySheet': {'source': {'sheetId': sheet_id}, 'destination': {'title': payload['title']}}}
+        if op_type == 'deleteSheet':
+            return {'deleteSheet': {'sheetId': sheet_id}}
+        properties = {'sheetId': sheet_id}
+        for key in ['title', 'index', 'hidden']:
+            if payload[key] is not None:
+                properties[key] = payload[key]
+        if payload['lock']:
+            properties['protect'] = {'lock': payload['lock']}
+            if payload['users']:
+                properties['protect']['userIDs'] = payload['users']
+        return {'updateSheet': {'properties': properties}}
+
+    def _parse_reply(self, op_type, reply):
+        """
+        解析单个reply，返回值同SpreadSheet中对应的方法
+        """
+        info = list(reply.values())[0]
+        if op_type in ['addSheet', 'copySheet']:
+            properties = info['properties']
+            sheet_id, title, index = properties['sheetId'], properties['title'], properties['index']
+            logger.info(f'{op_type} Successfully: index={index}, sheet_id={sheet_id}, title={title}')
+            return sheet_id, index
+        if op_type == 'deleteSheet':
+            logger.info(f'Delete Sheet Successfully: sheet_id={info["sheetId"]}, result={info["result"]}')
+            return info['result']
+        logger.info(f'Change Sheet Meta Info Successfully: {info.get("properties")}')
+        return True
+
+    @profiled
+    def commit(self, update=True):
+        """
+        提交所有排队的操作
+        :param update: 全部提交后是否更新元数据(只更新1次)
+        :return: 与排队操作一一对应的结果，失败的操作(及其后所有操作)结果为None
+        """
+        spsh = self.spsh
+        ops, self.ops = self.ops, []
+        title2id = dict(spsh.sheet_title2id)    # 本批内新建或改名的sheet会加入进来
+        results = []
+        chunk, chunk_ops, chunk_titles = [], [], set()
+
+        def submit():
+            replies = spsh._sheets_batch_update(list(chunk), update=False) if chunk else []
+            if replies is None:
+                return False
+            for (op_type, payload), reply in zip(chunk_ops, replies):
+                result = self._parse_reply(op_type, reply)
+                if op_type in ['addSheet', 'copySheet']:
+                    title2id[payload['title']] = result[0]
+                results.append(result)
+            chunk.clear()
+            chunk_ops.clear()
+            chunk_titles.clear()
+            return True
+
+        ok = True
+        for op_type, payload in ops:
+            sheet = payload.get('sheet')
+            if sheet in chunk_titles or len(chunk) >= self.max_num:     # 引用了本请求内新建的sheet，需先提交
+                ok = submit()
+                if not ok:
+                    break
+            sheet_id = spsh.sheet_index2id.get(sheet, title2id.get(sheet, sheet))
+            chunk.append(self._build_request(op_type, payload, sheet_id))
+            chunk_ops.append((op_type, payload))
+            if op_type in ['addSheet', 'copySheet']:
+                chunk_titles.add(payload['title'])
+            elif op_type == 'updateSheet' and payload['title']:
+                title2id[payload['title']] = sheet_id
+        if ok:
+            ok = submit()
+        results.extend([None] * (len(ops) - len(results)))
+        if update:
+            spsh._update_meta_info()
+        if not ok:
+            logger.error(f'Sheet Batch Failed: {len(ops) - results.count(None)}/{len(ops)} operations succeeded')
+        return results
+
+
+class WriteBuffer(object):
+    """
+    写缓冲区：收集单个cell和range的写入，写入时把相邻的cell合并为矩形，通过values_batch_update批量写入，
+    避免循环调用_write_cell时每个cell 1次请求。缓冲区内支持读己之写：read_cell/read_range优先返回缓冲中的值
+    退出with时，或缓冲cell数达到max_cells、第1个cell进入后超过max_delay秒时，自动写入
+    用法：
+        with spsh.buffered() as buf:
+            for i, value in enumerate(values):
+                buf.write_cell(f'B{i + 2}', value, sheet='xxx')
+    """
+    def __init__(self, spsh, max_cells=WRITE_RANGES_MAX_CELLS, max_delay=5):
+        self.spsh = spsh
+        self.max_cells = max_cells
+        self.max_delay = max_delay
+        self.cells = {}             # sheet_id -> {(row_index, col_index): value}
+        self.num_cells = 0
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def _sheet_id(self, sheet):
+        return self.spsh.sheet_index2id.get(sheet, self.spsh.sheet_title2id.get(sheet, sheet))
+
+    def write_cell(self, cell, value, sheet=0):
+        """
+        :param cell: 比如'B3'
+        :param value:
+        :param sheet:
+        :return:
+        """
+        self.write_range(cell, cell, [[value]], sheet)
+
+    def write_range(self, cell_start, cell_end, values, sheet=0):
+        """
+        :param cell_start:
+        :param cell_end: 只用于校验values的大小
+        :param values: 二维数组
+        :param sheet:
+        :return:
+        """
+        x_start, y_start = cell_to_xy(cell_start)
+        x_end, y_end = cell_to_xy(cell_end)
+        assert len(values) <= x_end - x_start + 1 and all(len(row) <= y_end - y_start + 1 for row in values), \
+            f'values超出范围{cell_start}:{cell_end}'
+        with self.lock:
+            cells = self.cells.setdefault(self._sheet_id(sheet), {})
+            for i, row in enumerate(values):
+                for j, value in enumerate(row):
+                    if (x_start + i, y_start + j) not in cells:
+                        self.num_cells += 1
+                    cells[(x_start + i, y_start + j)] = value
+            if self.num_cells >= self.max_cells:
+                self.flush()
+            elif self.max_delay is not None and self.timer is None and self.num_cells > 0:
+                self.timer = threading.Timer(self.max_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def read_cell(self, cell, sheet=0):
+        """
+        读取单个cell，优先返回缓冲中的值
+        :param cell:
+        :param sheet:
+        :return:
+        """
+        return self.read_range(cell, cell, sheet)[0][0]
+
+    def read_range(self, cell_start, cell_end, sheet=0):
+        """
+        读取range，缓冲中的cell覆盖sheet中的值；range完全在缓冲中时不发请求
+        :param cell_start:
+        :param cell_end:
+        :param sheet:
+        :return: 二维数组
+        """
+        sheet_id = self._sheet_id(sheet)
+        x_start, y_start = cell_to_xy(cell_start)
+        x_end, y_end = cell_to_xy(cell_end)
+        with self.lock:
+            cells = dict(self.cells.get(sheet_id, {}))
+        coords = [(x, y) for x in range(x_start, x_end + 1) for y in range(y_start, y_end + 1)]
+        if all(xy in cells for xy in coords):
+            values = [[None] * (y_end - y_start + 1) for _ in range(x_end - x_start + 1)]
         else:
-            return pd.DataFrame(values, columns=col_names)
+            values = self.spsh._read_range(cell_start, cell_end, sheet_id) or []
+            values = [list(row) + [None] * (y_end - y_start + 1 - len(row)) for row in values]
+            values += [[None] * (y_end - y_start + 1) for _ in range(x_end - x_start + 1 - len(values))]
+        for x, y in coords:
+            if (x, y) in cells:
+                values[x - x_start][y - y_start] = cells[(x, y)]
+        return values
+
+    @profiled
+    def flush(self):
+        """
+        把缓冲中的cell合并为矩形后批量写入，每个sheet写入成功后才从缓冲区移除，
+        写入失败时抛出ValueError，失败及未写入的sheet的cell保留在缓冲区中，下次flush时重新写入
+        :return: 请求次数
+        """
+        with self.lock:                     # 写完之前不释放锁，保证其他线程读己之写
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            n_requests = 0
+            for sheet_id, cells in list(self.cells.items()):
+                ranges = rects_to_ranges(cells_to_rects(cells), lambda x, y: cells[(x, y)])
+                try:
+                    n_requests += self.spsh._write_ranges_batch(ranges, sheet_id)
+                except ValueError as e:
+                    logger.error(f'Flush Write Buffer Failed: sheet_id={sheet_id}, {len(cells)} cells kept, error={e}')
+                    raise
+                del self.cells[sheet_id]
+                self.num_cells -= len(cells)
+                logger.info(f'Flush Write Buffer: sheet_id={sheet_id}, {len(cells)} cells, {len(ranges)} ranges')
+            return n_requests
 
 
 if __name__ == '__main__':
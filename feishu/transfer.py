@@ -0,0 +1,141 @@
+import time
+import queue
+import logging
+import threading
+
+from . import pool, transport
+from .spreadsheet import SpreadSheet, cell_to_xy, xy_to_cell, FEISHU_VERBOSE, WRITE_MAX_ROWS
+from .profiler import profiled
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()        # 生产者结束的标记
+
+
+def _open(spsh, user_access_token=None):
+    """
+    :param spsh: SpreadSheet实例，或spreadsheet_token
+    :return: SpreadSheet实例，传入spreadsheet_token时从进程级的池中获取，见pool.open
+    """
+    if isinstance(spsh, SpreadSheet):
+        return spsh
+    return pool.open(spsh, user_access_token=user_access_token)
+
+
+@profiled
+def transfer(src, dst, src_sheet=0, dst_sheet=0, src_range=None, dst_cell='A1', chunk_size=1000, read_workers=2,
+             write_workers=4, queue_size=8, skip_rows=0, on_progress=None, user_access_token=None):
+    """
+    把1个sheet(的某个范围)复制到另一个sheet，可以跨表格，生产者/消费者流水线：
+    - 生产者：按chunk_size行分块，read_workers个线程并发读取源sheet，按顺序放入最多queue_size块的有界队列
+    - 消费者：write_workers个线程从队列取块，并发写入目标sheet
+    数据不经过pandas，内存占用与(queue_size + read_workers + write_workers) * chunk_size有关，与sheet大小无关，
+    读写同时进行，总耗时接近max(读, 写)而不是读 + 写。目标sheet的行列在开始前一次扩展到位
+    用法：
+        stats = transfer('src_token', 'dst_token', src_sheet='Sheet1', dst_sheet='Sheet1')
+    update: 20261019
+    :param src: 源SpreadSheet实例或spreadsheet_token
+    :param dst: 目标SpreadSheet实例或spreadsheet_token，与源相同时直接复用源实例
+    :param src_sheet:
+    :param dst_sheet:
+    :param src_range: 源范围，如'A1:F1000'，或只指定左上角'B2'，为None时取整个sheet
+    :param dst_cell: 写入位置左上角
+    :param chunk_size: 每块的行数，最多WRITE_MAX_ROWS
+    :param read_workers: 并发读取的块数
+    :param write_workers: 并发写入的块数
+    :param queue_size: 队列中最多缓存的块数，队列满时读取暂停，等待写入
+    :param skip_rows: 跳过源范围的前skip_rows行，用于断点续传
+    :param on_progress: 函数，on_progress(rows)，rows为(含skip_rows)从头开始连续写完的行数，用于保存断点
+    :param user_access_token: src/dst为spreadsheet_token时用于新建实例
+    :return: 统计信息，形如{'rows': 10000, 'cells': 60000, 'chunks': 10, 'seconds': 3.2}
+    """
+    src = _open(src, user_access_token)
+    dst = src if dst in (src, getattr(src, 'spreadsheet_token', None)) else _open(dst, user_access_token)
+    src_id = src.sheet_index2id.get(src_sheet, src.sheet_title2id.get(src_sheet, src_sheet))
+    dst_id = dst.sheet_index2id.get(dst_sheet, dst.sheet_title2id.get(dst_sheet, dst_sheet))
+    cell_start, _, cell_end = (src_range or 'A1').partition(':')
+    x_start, y_start = cell_to_xy(cell_start)
+    if cell_end:
+        x_end, y_end = cell_to_xy(cell_end)
+    else:
+        grid_properties = src.sheets[src.sheet_id2index[src_id]]['grid_properties']
+        x_end, y_end = grid_properties['row_count'] - 1, grid_properties['column_count'] - 1
+    x0, y0 = cell_to_xy(dst_cell)
+    chunk_size = min(chunk_size, WRITE_MAX_ROWS)
+    start_time = time.perf_counter()
+
+    dst._ensure_grid(x0 + x_end - x_start + 1, y0 + y_end - y_start + 1, dst_id)
+    chunks = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+    lock = threading.Lock()
+    stats = {'rows': 0, 'cells': 0, 'chunks': 0}
+    done, progress = {}, [skip_rows]        # 已写完的块：起始偏移 -> 行数；从头开始连续写完的行数
+    deadline = transport.get_deadline()
+
+    def produce():
+        try:
+            for x, values in src._iter_range_chunks(xy_to_cell(x_start + skip_rows, y_start),
+                                                    xy_to_cell(x_end, y_end), src_id, chunk_size, read_workers):
+                n_rows = min(x_end, x + chunk_size - 1) - x + 1
+                values = [values[i] or [] if i < len(values) else [] for i in range(n_rows)]
+                while not stop_event.is_set():
+                    try:
+                        chunks.put((x - x_start, values), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop_event.is_set():
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            for _ in range(write_workers):
+                chunks.put(_STOP)
+
+    def consume():
+        while True:
+            item = chunks.get()
+            if item is _STOP:
+                return
+            if stop_event.is_set():
+                continue                # 出错后丢弃剩余的块，直到生产者结束
+            offset, values = item
+            try:
+                dst._write_block(values, x0 + offset, y0, dst_id)
+            except Exception as e:
+                errors.append(e)
+                stop_event.set()
+                continue
+            with lock:
+                stats['rows'] += len(values)
+                stats['cells'] += sum(len(row) for row in values)
+                stats['chunks'] += 1
+                done[offset] = len(values)
+                while progress[0] in done:
+                    progress[0] += done.pop(progress[0])
+                    if on_progress:
+                        on_progress(progress[0])
+
+    def run(target):
+        with transport.deadline(at=deadline):       # 读写线程继承调用线程的截止时间
+            target()
+
+    producer = threading.Thread(target=run, args=(produce,), daemon=True)
+    consumers = [threading.Thread(target=run, args=(consume,), daemon=True) for _ in range(write_workers)]
+    producer.start()
+    for t in consumers:
+        t.start()
+    producer.join()
+    for t in consumers:
+        t.join()
+    if errors:
+        logger.error(f'Transfer Failed: {progress[0]} rows done, error={errors[0]}')
+        raise errors[0]
+
+    stats['seconds'] = round(time.perf_counter() - start_time, 3)
+    if FEISHU_VERBOSE in ['spreadsheet', 'all']:
+        print(f'Transfer Successfully: {src_id} -> {dst_id}, {stats}')
+    logger.info(f'Transfer Successfully: {src_id} -> {dst_id}, {stats}')
+    return stats
@@ -0,0 +1,894 @@
+import re
+import copy
+import heapq
+import itertools
+import json
+import time
+import random
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from . import profiler
+
+logger = logging.getLogger(__name__)
+
+
+# 0. Common
+API_PREFIX = re.compile(r'^https?://[^/]+(/open-apis)?/')
+# url中的token、range等变量替换为占位符，便于按接口汇总统计
+ENDPOINT_PATTERNS = [
+    (re.compile(r'(spreadsheets|permissions)/[^/?]+'), r'\1/:token'),
+    (re.compile(r'/values/[^/?]+'), '/values/:range'),
+]
+CODE_PATTERN = re.compile(rb'^\s*\{\s*"code"\s*:\s*(-?\d+)')     # 飞书响应体以code开头，不解析整个JSON即可取到
+RATE_LIMIT_CODE = 99991400          # 请求频率超限
+MAX_RETRIES = 3                     # 失败重试次数，为0表示不重试
+RETRY_BACKOFF = 0.5                 # 第n次重试前等待RETRY_BACKOFF * 2 ** n秒(加随机抖动)
+RETRY_MAX_DELAY = 30                # 单次重试最多等待的秒数
+IDEMPOTENT_METHODS = {'GET', 'PUT'}     # 服务端报错(5xx)或网络异常时，只重试幂等的请求，避免重复追加数据或发送消息
+CONNECT_TIMEOUT = 5                 # 建立连接的超时秒数
+READ_TIMEOUT = 60                   # 等待响应(两次收到数据之间)的超时秒数，调用方没有指定timeout时使用
+HEDGE_AFTER = None                  # GET请求超过HEDGE_AFTER秒没有响应时，在后台再发1个相同的请求，原请求失败时使用它的响应，为None表示不对冲
+HEDGE_RATIO = 0.1                   # 对冲请求数最多为GET请求数的HEDGE_RATIO倍(另有最多HEDGE_BURST次的突发额度)，避免加剧限流
+HEDGE_BURST = 10
+HEDGE_WORKERS = 32                  # 对冲请求(只有重复发出的那个)使用的线程数
+CREDENTIAL_REFRESH_RETRY = 60       # CredentialPool中的token refresh失败后，多少秒后再试
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    超过deadline设置的截止时间
+    """
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    熔断中，请求没有发出
+    """
+
+
+def get_endpoint(method, url):
+    """
+    把url归一化为接口名，比如：
+    https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/xxx/values/yyy!A1:B2 -> GET sheets/v2/spreadsheets/:token/values/:range
+    :param method:
+    :param url:
+    :return:
+    """
+    path = API_PREFIX.sub('', url.split('?')[0])
+    for pattern, repl in ENDPOINT_PATTERNS:
+        path = pattern.sub(repl, path)
+    return f'{method.upper()} {path.rstrip("/")}'
+
+
+def get_code(resp):
+    """
+    从响应体开头提取飞书的code，流式响应不读取响应体
+    :param resp:
+    :return: code，取不到时返回None
+    """
+    if getattr(resp, '_content_consumed', True):
+        match = CODE_PATTERN.match(resp.content[:64])
+        return int(match.group(1)) if match else None
+    return None
+
+
+def count_values(values):
+    """
+    :param values: 二维数组
+    :return: (行数, cell数)
+    """
+    values = values or []
+    return len(values), sum(len(row) for row in values if row)
+
+
+# 1. Hooks
+class Hook(object):
+    """
+    请求钩子基类，按需覆盖以下方法，通过add_hook注册后对所有飞书API请求生效：
+    - before_request(ctx): 发送请求前(包括重试前只调用1次)
+    - after_request(ctx, resp): 收到最终响应后(重试结束后)
+    - on_retry(ctx, reason, delay): 每次重试前，reason为'429'、'503'、'code=99991400'、'ConnectionError'等
+    - on_error(ctx, error): 请求抛出异常(重试后仍失败)时
+    - on_data(ctx, rows, cells): 成功读写sheet数据后，rows/cells为本次请求读写的行数和cell数
+    钩子中的异常只记录日志，不影响请求本身
+    """
+    def before_request(self, ctx):
+        pass
+
+    def after_request(self, ctx, resp):
+        pass
+
+    def on_retry(self, ctx, reason, delay):
+        pass
+
+    def on_error(self, ctx, error):
+        pass
+
+    def on_data(self, ctx, rows, cells):
+        pass
+
+
+class RequestContext(object):
+    """
+    单次请求(含重试)的上下文，传给各个钩子
+    """
+    def __init__(self, method, url):
+        self.method = method.upper()
+        self.url = url
+        self.endpoint = get_endpoint(method, url)
+        self.attempt = 0            # 当前是第几次重试，0表示首次请求
+        self.sent = 0               # 请求体字节数
+        self.received = 0           # 响应体字节数，流式响应取Content-Length
+        self.seconds = 0.0          # 最后1次请求的总耗时
+        self.wait = 0.0             # 最后1次请求等待响应头的耗时(网络+服务端处理)，其余为下载响应体的耗时
+        self.status_code = None
+        self.code = None            # 飞书响应中的code，取不到时为None
+        self.rows = 0               # 请求体中写入的行数和cell数
+        self.cells = 0
+        self.hedged = False         # 是否发出了对冲请求
+
+
+_hooks = []
+_local = threading.local()
+
+
+def add_hook(hook):
+    """
+    注册钩子，见Hook
+    :param hook:
+    :return: hook
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def _get_hooks():
+    prof = profiler.get_profiler()
+    return _hooks if prof is None else _hooks + [prof]
+
+
+def _call_hooks(hooks, name, *args):
+    for hook in hooks:
+        method = getattr(hook, name, None)
+        if method is None:
+            continue
+        try:
+            method(*args)
+        except Exception as e:
+            logger.error(f'Hook Failed: {type(hook).__name__}.{name}, error={e}')
+
+
+def record_data(rows, cells):
+    """
+    记录当前线程最近1次请求读取到的数据量，供钩子统计每秒读取的行数和cell数
+    :param rows:
+    :param cells:
+    :return:
+    """
+    ctx = getattr(_local, 'context', None)
+    hooks = _get_hooks()
+    if ctx is None or not hooks:
+        return
+    _call_hooks(hooks, 'on_data', ctx, rows, cells)
+
+
+def _body_values(body):
+    """
+    :param body: 写入sheet的请求体
+    :return: 其中所有range的values
+    """
+    if not isinstance(body, dict):
+        return []
+    if 'valueRange' in body:
+        return body['valueRange'].get('values') or []
+    if 'valueRanges' in body:
+        return [row for x in body['valueRanges'] for row in x.get('values') or []]
+    return []
+
+
+# 2. Retry
+def _retry_reason(method, resp, stream):
+    """
+    :return: 需要重试时返回原因，否则返回None
+    """
+    if resp.status_code == 429:
+        return '429'
+    if resp.status_code == 400:
+        if stream:
+            resp.content        # 错误响应很小，读出响应体以取code，之后iter_content仍可从缓存的响应体读取
+        if get_code(resp) == RATE_LIMIT_CODE:
+            return f'code={RATE_LIMIT_CODE}'
+    if resp.status_code >= 500 and method in IDEMPOTENT_METHODS:
+        return str(resp.status_code)
+    return None
+
+
+def _retry_delay(attempt, resp=None):
+    """
+    优先使用响应头中的Retry-After或x-ogw-ratelimit-reset，否则指数退避
+    """
+    if resp is not None:
+        for name in ['Retry-After', 'x-ogw-ratelimit-reset']:
+            try:
+                return min(float(resp.headers[name]), RETRY_MAX_DELAY)
+            except (KeyError, ValueError, TypeError):
+                pass
+    return min(RETRY_BACKOFF * 2 ** attempt * (1 + random.random() / 2), RETRY_MAX_DELAY)
+
+
+# 3. Request
+def request(method, url, **kwargs):
+    """
+    统一的HTTP请求入口，所有飞书API请求都经过这里，参数同requests.request
+    - 频率超限(429或code=99991400)时重试；服务端报错(5xx)或网络异常时，幂等请求(GET/PUT)也会重试，最多MAX_RETRIES次
+    - 注册了钩子或开启性能统计(见profiler)时，调用各个钩子，记录JSON编码耗时，以及每个接口的耗时、收发字节数
+    - 启用了SingleFlight时，同时发起的相同GET请求合并为1个请求；其他请求会清空SingleFlight缓存的结果
+    - 默认超时为(CONNECT_TIMEOUT, READ_TIMEOUT)，在deadline内时不超过剩余时间；设置HEDGE_AFTER时对GET请求对冲；
+      启用了CircuitBreaker时，API持续出错后快速失败
+    - 启用了CredentialPool且请求使用池中的token时，每次请求(含重试)按负载选择1个应用的token
+    :param method:
+    :param url:
+    :param kwargs:
+    :return: requests.Response，合并的GET请求返回SharedResponse
+    """
+    flight = _single_flight
+    if flight is not None:
+        if method.upper() == 'GET' and not kwargs.get('stream', False):
+            return flight.call(method, url, kwargs)
+        flight.forget()
+    return _send(method, url, **kwargs)
+
+
+def _send(method, url, **kwargs):
+    hooks = _get_hooks()
+    ctx = RequestContext(method, url)
+    stream = kwargs.get('stream', False)
+    if hooks:
+        if kwargs.get('json') is not None:
+            ctx.rows, ctx.cells = count_values(_body_values(kwargs['json']))
+            with profiler.phase('json_encode'):
+                kwargs['data'] = json.dumps(kwargs.pop('json'), allow_nan=False).encode('utf-8')
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Type': 'application/json'})
+        data = kwargs.get('data')
+        ctx.sent = len(data) if isinstance(data, (bytes, str)) else 0
+        _call_hooks(hooks, 'before_request', ctx)
+
+    timeout = kwargs.pop('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    deadline = get_deadline()
+    breaker = _breaker
+    creds = _credential_pool if _credential_pool is not None and _credential_pool.owns(kwargs.get('headers')) else None
+    hedge = HEDGE_AFTER is not None and ctx.method == 'GET' and not stream
+    while True:
+        try:
+            kwargs['timeout'] = _attempt_timeout(timeout, deadline, ctx)
+            if breaker is not None:
+                breaker.acquire(ctx)
+        except (DeadlineExceeded, CircuitOpenError) as e:
+            _call_hooks(hooks, 'on_error', ctx, e)
+            raise
+        if creds is not None:
+            credential = creds.acquire()
+            kwargs['headers'] = dict(kwargs['headers'], Authorization=f'Bearer {credential.token}')
+        start = time.perf_counter()
+        try:
+            resp = _hedged_request(ctx, method, url, kwargs) if hedge else requests.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            ctx.seconds = ctx.wait = time.perf_counter() - start
+            if creds is not None:
+                creds.release(credential, ctx.seconds)
+            if breaker is not None:
+                breaker.record(False)
+            if ctx.method in IDEMPOTENT_METHODS and ctx.attempt < MAX_RETRIES:
+                delay = _retry_delay(ctx.attempt)
+                if _within_deadline(deadline, delay):
+                    _retry(hooks, ctx, type(e).__name__, delay)
+                    continue
+            _call_hooks(hooks, 'on_error', ctx, e)
+            raise
+        except Exception as e:
+            ctx.seconds = ctx.wait = time.perf_counter() - start
+            if creds is not None:
+                creds.release(credential, ctx.seconds)
+            if breaker is not None:
+                breaker.release()           # 不是服务端的问题，不计入成败
+            _call_hooks(hooks, 'on_error', ctx, e)
+            raise
+        if breaker is not None:
+            breaker.record(resp.status_code < 500)
+        reason = _retry_reason(ctx.method, resp, stream)
+        throttled = reason in ('429', f'code={RATE_LIMIT_CODE}')
+        delay = _retry_delay(ctx.attempt, resp) if reason else None
+        if creds is not None:
+            creds.release(credential, time.perf_counter() - start, delay if throttled else None)
+        if reason and ctx.attempt < MAX_RETRIES:
+            if throttled and creds is not None and creds.available():
+                delay = 0                   # 还有没被限流的应用，换1个应用立即重试
+            if _within_deadline(deadline, delay):
+                resp.close()
+                _retry(hooks, ctx, reason, delay)
+                continue
+        break
+
+    if hooks:
+        if stream:      # 流式响应不提前读取响应体，按Content-Length统计
+            ctx.received = int(resp.headers.get('Content-Length') or 0)
+        else:
+            ctx.received = len(resp.content)
+        ctx.seconds = time.perf_counter() - start
+        ctx.wait = min(resp.elapsed.total_seconds(), ctx.seconds)
+        ctx.status_code = resp.status_code
+        ctx.code = get_code(resp)
+        _local.context = ctx
+        _call_hooks(hooks, 'after_request', ctx, resp)
+        if ctx.cells and ctx.status_code == 200 and ctx.code == 0:
+            _call_hooks(hooks, 'on_data', ctx, ctx.rows, ctx.cells)
+    return resp
+
+
+def _retry(hooks, ctx, reason, delay):
+    logger.info(f'Request Retry: {ctx.endpoint}, reason={reason}, attempt={ctx.attempt + 1}, delay={delay:.2f}s')
+    _call_hooks(hooks, 'on_retry', ctx, reason, delay)
+    ctx.attempt += 1
+    time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request('PATCH', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+
+# 4. Single flight
+class SharedResponse(object):
+    """
+    多个调用方共享的响应：json()只解析1次，每次调用返回解析结果的深拷贝，调用方修改返回的数据不影响其他调用方；其余属性同requests.Response
+    """
+    def __init__(self, resp):
+        self.response = resp
+        self.status_code = resp.status_code
+        self._json = None
+        self._lock = threading.Lock()
+
+    def json(self, **kwargs):
+        with self._lock:
+            if self._json is None:
+                self._json = self.response.json(**kwargs)
+        return copy.deepcopy(self._json)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+def default_key(method, url, kwargs):
+    """
+    默认的合并键：url、params和Authorization(即token所属的应用或用户)都相同的GET请求视为同一个请求
+    :param method:
+    :param url:
+    :param kwargs: 同requests.request的参数
+    :return: 可hash的键，返回None表示不合并
+    """
+    params = kwargs.get('params') or {}
+    headers = kwargs.get('headers') or {}
+    params = sorted(params.items()) if isinstance(params, dict) else params
+    return url, repr(params), headers.get('Authorization')
+
+
+_single_flight = None
+
+
+class SingleFlight(object):
+    """
+    合并相同的GET请求：同时发起的相同请求(见key_func)只有第1个真正发出，其余等待并共享它的响应(JSON只解析1次，各自得到副本)；
+    成功的响应(status_code=200且code=0)在ttl秒内继续复用，发起其他请求(写入等)时清空，保证之后读到自己写入的数据
+    适合多线程服务中大量请求同时读取同一个表格(_read_range、_update_meta_info等)，减少API调用，避免触发频率限制
+    用法：
+        flight = SingleFlight(ttl=1).install()     # 对所有飞书API的GET请求生效
+        ...
+        print(flight.stats)                         # {'requests': 真正发出的请求数, 'shared': 合并的请求数, 'cached': 命中缓存的请求数}
+    """
+    def __init__(self, ttl=1.0, key_func=default_key, max_entries=128):
+        """
+        :param ttl: 成功的响应缓存的秒数，为0表示只合并同时发起的请求
+        :param key_func: 函数，key_func(method, url, kwargs)，返回合并键，返回None表示该请求不合并，默认见default_key
+        :param max_entries: 最多缓存的响应数
+        """
+        self.ttl = ttl
+        self.key_func = key_func
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.calls = {}                 # 合并键 -> 进行中请求的Future
+        self.cache = OrderedDict()      # 合并键 -> (过期时间, SharedResponse)
+        self.generation = 0             # 每次清空缓存加1，清空前发出的请求结果不再缓存
+        self.stats = {'requests': 0, 'shared': 0, 'cached': 0}
+
+    def install(self):
+        global _single_flight
+        _single_flight = self
+        return self
+
+    def uninstall(self):
+        global _single_flight
+        if _single_flight is self:
+            _single_flight = None
+
+    def forget(self):
+        """
+        清空缓存的响应
+        :return:
+        """
+        with self.lock:
+            if self.cache:
+                self.cache.clear()
+            self.generation += 1
+
+    def call(self, method, url, kwargs):
+        key = self.key_func(method, url, kwargs)
+        if key is None:
+            return _send(method, url, **kwargs)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                self.stats['cached'] += 1
+                _local.context = None       # 没有发出请求，读取到的数据不计入钩子统计
+                return entry[1]
+            if entry is not None:
+                del self.cache[key]
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                generation = self.generation
+                self.stats['requests'] += 1
+            else:
+                self.stats['shared'] += 1
+        if not leader:
+            _local.context = None
+            deadline = get_deadline()
+            try:
+                return future.result(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                raise DeadlineExceeded(f'Deadline Exceeded: waiting for shared request {get_endpoint(method, url)}')
+
+        try:
+            resp = SharedResponse(_send(method, url, **kwargs))
+            with self.lock:
+                del self.calls[key]
+                if self.ttl and generation == self.generation and resp.status_code == 200 and get_code(resp) == 0:
+                    self.cache[key] = (time.monotonic() + self.ttl, resp)
+                    while len(self.cache) > self.max_entries:
+                        self.cache.popitem(last=False)
+            future.set_result(resp)
+            return resp
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is future:
+                    del self.calls[key]
+            if not future.done():       # 被KeyboardInterrupt等中断时，等待中的请求也结束
+                future.set_exception(requests.ConnectionError(f'Shared request aborted: {get_endpoint(method, url)}'))
+
+
+
+# 5. Timeout, deadline, hedging and circuit breaker
+@contextmanager
+def deadline(seconds=None, at=None):
+    """
+    为一段代码设置截止时间：其中的每次请求(含重试)的超时不超过剩余时间，到期后抛出DeadlineExceeded，
+    嵌套时取更早的截止时间，read_sheet、transfer等内部的并发读写会继承调用线程的截止时间
+    用法：
+        with transport.deadline(300):
+            df = spsh.read_sheet(...)
+    update: 20261019
+    :param seconds: 从现在开始的秒数
+    :param at: 或者直接指定截止时间(time.monotonic())，用于传给其他线程
+    :return: 截止时间
+    """
+    previous = get_deadline()
+    current = time.monotonic() + seconds if seconds is not None else at
+    if current is None or (previous is not None and previous < current):
+        current = previous
+    _local.deadline = current
+    try:
+        yield current
+    finally:
+        _local.deadline = previous
+
+
+def get_deadline():
+    """
+    :return: 当前线程的截止时间(time.monotonic())，没有设置时返回None
+    """
+    return getattr(_local, 'deadline', None)
+
+
+def _attempt_timeout(timeout, deadline, ctx):
+    """
+    本次请求的timeout：不超过截止时间的剩余秒数，已到期时抛出DeadlineExceeded
+    """
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded(f'Deadline Exceeded: {ctx.endpoint}, attempt={ctx.attempt}')
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(remaining if x is None else min(x, remaining) for x in timeout)
+    return min(timeout, remaining)
+
+
+def _within_deadline(deadline, delay):
+    return deadline is None or time.monotonic() + delay < deadline
+
+
+class _HedgeBudget(object):
+    """
+    对冲请求的额度：每个GET请求积累HEDGE_RATIO，最多HEDGE_BURST，每次对冲消耗1
+    另有1个调度线程，到时间后发起对冲请求(在线程池中)，避免每个GET请求都占用1个线程等待
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = HEDGE_BURST
+        self.executor = None
+        self.cond = threading.Condition(self.lock)
+        self.timers = []                # 堆，[到期时间, 序号, 函数]，函数为None表示已取消
+        self.counter = itertools.count()
+        self.scheduler = None
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(HEDGE_BURST, self.tokens + HEDGE_RATIO)
+
+    def spend(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def submit(self, *args, **kwargs):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='feishu-hedge')
+        return self.executor.submit(*args, **kwargs)
+
+    def schedule(self, delay, fn):
+        """
+        delay秒后在调度线程中调用fn
+        :return: 定时条目，cancel时传入
+        """
+        with self.cond:
+            entry = [time.monotonic() + delay, next(self.counter), fn]
+            heapq.heappush(self.timers, entry)
+            if self.scheduler is None:
+                self.scheduler = threading.Thread(target=self._run, name='feishu-hedge-scheduler', daemon=True)
+                self.scheduler.start()
+            self.cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.cond:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.cond.wait(None if not self.timers else self.timers[0][0] - time.monotonic())
+                entry = heapq.heappop(self.timers)
+                fn, entry[2] = entry[2], None
+            if fn is not None:
+                try:
+                    fn()
+                except Exception as e:
+                    logger.error(f'Hedge Failed: {e}')
+
+
+_hedge_budget = _HedgeBudget()
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def _hedged_request(ctx, method, url, kwargs):
+    """
+    对冲请求：在调用线程中发出请求，超过HEDGE_AFTER秒没有响应且有额度时，在线程池中再发1个相同的请求
+    调用线程的请求成功时直接返回，关闭另1个的响应；失败(网络异常、超时)时等待另1个，它也失败则抛出原来的异常
+    线程池只用于重复的请求，不限制GET请求的并发数，也不会因为排队而提前触发对冲
+    """
+    _hedge_budget.earn()
+    lock = threading.Lock()
+    hedge = []              # 发出的对冲请求的Future
+    finished = []           # 调用线程的请求已结束，不再发起对冲
+
+    def fire():
+        with lock:
+            if not finished and _hedge_budget.spend():
+                ctx.hedged = True
+                logger.info(f'Request Hedged: {ctx.endpoint}, after={HEDGE_AFTER}s')
+                hedge.append(_hedge_budget.submit(requests.request, method, url, **kwargs))
+
+    def finish():
+        _hedge_budget.cancel(entry)
+        with lock:
+            finished.append(True)
+            return hedge[0] if hedge else None
+
+    entry = _hedge_budget.schedule(HEDGE_AFTER, fire)
+    try:
+        resp = requests.request(method, url, **kwargs)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        future = finish()
+        if future is None:
+            raise
+        try:
+            return future.result()
+        except Exception:
+            raise e
+    future = finish()
+    if future is not None:
+        future.add_done_callback(_close_response)
+    return resp
+
+
+_breaker = None
+
+
+class CircuitBreaker(object):
+    """
+    熔断器：连续failure_threshold次请求失败(网络异常、超时或5xx)后熔断，recovery_time秒内的请求直接抛出CircuitOpenError，
+    不再等待超时；之后放行1个试探请求，成功则恢复，失败则继续熔断。429限流不算失败，由重试处理
+    用法：
+        breaker = CircuitBreaker(failure_threshold=5, recovery_time=30).install()     # 对所有飞书API请求生效
+    """
+    def __init__(self, failure_threshold=5, recovery_time=30):
+        """
+        :param failure_threshold: 连续失败多少次后熔断
+        :param recovery_time: 熔断多少秒后放行试探请求
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.lock = threading.Lock()
+        self.state = 'closed'       # closed: 正常，open: 熔断中，half_open: 等待试探请求的结果
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False        # 半开状态下是否已放行试探请求
+
+    def install(self):
+        global _breaker
+        _breaker = self
+        return self
+
+    def uninstall(self):
+        global _breaker
+        if _breaker is self:
+            _breaker = None
+
+    def acquire(self, ctx):
+        """
+        请求前调用，熔断中时抛出CircuitOpenError
+        """
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.recovery_time:
+                self.state, self.probing = 'half_open', False
+            if self.state == 'open' or (self.state == 'half_open' and self.probing):
+                raise CircuitOpenError(f'Circuit Open: {ctx.endpoint}, {self.failures} consecutive failures')
+            if self.state == 'half_open':
+                self.probing = True
+
+    def release(self):
+        """
+        请求没有结果(如本地异常)时调用，半开状态下允许再放行1个试探请求
+        """
+        with self.lock:
+            self.probing = False
+
+    def record(self, success):
+        """
+        请求后调用，记录成功或失败
+        """
+        with self.lock:
+            if success:
+                if self.state != 'closed':
+                    logger.info('Circuit Closed: Feishu API recovered')
+                self.state, self.failures, self.probing = 'closed', 0, False
+                return
+            self.failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                logger.error(f'Circuit Opened: {self.failures} consecutive failures, '
+                             f'failing fast for {self.recovery_time}s')
+                self.state, self.opened_at, self.probing = 'open', time.monotonic(), False
+
+
+
+# 6. Credential pool
+class Credential(object):
+    """
+    凭证池中的1个应用：缓存的token及其负载统计
+    """
+    def __init__(self, source, name):
+        self.source = source        # token字符串，或有user_access_token属性的对象(如Identification，过期前自动refresh)
+        self.name = name
+        self.token = source if isinstance(source, str) else source.user_access_token
+        self.refresh_at = self.expire()     # 到这个时间(time.time())后由CredentialPool在后台refresh，None表示不需要
+        self.refreshing = False
+        self.inflight = 0           # 正在进行的请求数
+        self.latency = 0.5          # 请求耗时的指数移动平均(秒)
+        self.throttled_until = 0.0  # 被限流到什么时候(time.monotonic())
+        self.requests = 0
+        self.throttled = 0
+
+    def expire(self):
+        """
+        :return: source中token的过期时间(time.time()，Identification已提前2分钟)，token字符串或没有过期时间时返回None
+        """
+        return None if isinstance(self.source, str) else getattr(self.source, 'user_access_token_expire', None)
+
+    def refresh(self):
+        """
+        从source获取新的token，可能发出请求，不在请求的路径上调用
+        :return: token
+        """
+        get_token = getattr(self.source, 'get_user_access_token', None)
+        return get_token() if get_token is not None else self.source.user_access_token
+
+
+_credential_pool = None
+
+
+def get_credential_pool():
+    """
+    :return: 当前启用的CredentialPool，没有时返回None
+    """
+    return _credential_pool
+
+
+class CredentialPool(object):
+    """
+    多个应用的凭证池：单个应用的QPS配额有限，把请求分散到多个应用(各自的user或tenant token)上，总吞吐量随应用数近似线性增长
+    - 使用池中任意1个token发出的请求，每次发送(含重试)前重新选择token，替换Authorization
+    - 按负载调度：选择没被限流的应用中(进行中的请求数 + 1) * 平均耗时最小的；被限流(429或code=99991400)的应用
+      在Retry-After或退避时间内不再分配请求，此时重试会立即换1个应用，所有应用都被限流时选择最早恢复的
+    - 每个应用都需要有目标文档的权限，写入的数据在文档历史中显示为各自的身份
+    - token缓存在池中，请求时不会refresh；token快过期(Identification提前2分钟)时在后台线程refresh，
+      refresh期间继续使用旧token，失败时CREDENTIAL_REFRESH_RETRY秒后再试
+    用法：
+        from feishu.identification import identify_apps
+        creds = CredentialPool(identify_apps()).install()      # 应用列表见FEISHU_APPS
+        spsh = SpreadSheet(user_access_token=creds.user_access_token)
+        print(creds.stats())
+    """
+    def __init__(self, credentials, alpha=0.2):
+        """
+        :param credentials: token字符串，或有user_access_token属性的对象(如Identification)的列表，或{名称: 同前}
+        :param alpha: 平均耗时的平滑系数，越大越看重最近的请求
+        """
+        if isinstance(credentials, dict):
+            credentials = [Credential(v, str(k)) for k, v in credentials.items()]
+        else:
+            credentials = [Credential(v, getattr(v, 'app_id', None) or str(i)) for i, v in enumerate(credentials)]
+        assert credentials, 'credentials不能为空！'
+        self.credentials = credentials
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.auths = {f'Bearer {x.token}' for x in credentials}    # 池中所有token(含refresh前的)对应的Authorization
+
+    @property
+    def user_access_token(self):
+        """
+        第1个应用的token，用于初始化SpreadSheet等，实际请求时会被替换
+        """
+        return self.credentials[0].token
+
+    def install(self):
+        global _credential_pool
+        _credential_pool = self
+        return self
+
+    def uninstall(self):
+        global _credential_pool
+        if _credential_pool is self:
+            _credential_pool = None
+
+    def owns(self, headers):
+        """
+        :return: headers中的Authorization是否为池中的token
+        """
+        return (headers or {}).get('Authorization') in self.auths
+
+    def available(self):
+        """
+        :return: 是否有没被限流的应用
+        """
+        now = time.monotonic()
+        return any(x.throttled_until <= now for x in self.credentials)
+
+    def _refresh(self, credential):
+        """
+        在后台线程中refresh credential的token
+        """
+        try:
+            token = credential.refresh()
+        except Exception as e:
+            logger.error(f'Refresh Credential Failed: {credential.name}, {e}')
+            token = None
+        with self.lock:
+            expire = credential.expire()
+            if token is not None:
+                credential.token = token
+                self.auths.add(f'Bearer {token}')
+            if token is None or (expire is not None and expire <= time.time()):
+                credential.refresh_at = time.time() + CREDENTIAL_REFRESH_RETRY
+            else:
+                credential.refresh_at = expire
+            credential.refreshing = False
+
+    def acquire(self):
+        with self.lock:
+            wall = time.time()
+            for x in self.credentials:
+                if x.refresh_at is not None and wall >= x.refresh_at and not x.refreshing:
+                    x.refreshing = True
+                    threading.Thread(target=self._refresh, args=(x,), daemon=True).start()
+            now = time.monotonic()
+            ready = [x for x in self.credentials if x.throttled_until <= now]
+            if ready:
+                credential = min(ready, key=lambda x: (x.inflight + 1) * x.latency)
+            else:
+                credential = min(self.credentials, key=lambda x: x.throttled_until)
+            credential.inflight += 1
+            credential.requests += 1
+            return credential
+
+    def release(self, credential, seconds, throttle=None):
+        """
+        :param credential:
+        :param seconds: 本次请求耗时
+        :param throttle: 被限流时为需要等待的秒数
+        """
+        with self.lock:
+            credential.inflight -= 1
+            credential.latency += self.alpha * (seconds - credential.latency)
+            if throttle is not None:
+                credential.throttled += 1
+                credential.throttled_until = max(credential.throttled_until, time.monotonic() + throttle)
+                logger.info(f'Credential Throttled: {credential.name}, {throttle:.2f}s')
+
+    def stats(self):
+        """
+        :return: 应用名 -> {'requests', 'throttled', 'inflight', 'latency'}
+        """
+        with self.lock:
+            return {x.name: {'requests': x.requests, 'throttled': x.throttled, 'inflight': x.inflight,
+                             'latency': round(x.latency, 3)} for x in self.credentials}
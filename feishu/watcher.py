@@ -0,0 +1,135 @@
+import logging
+import threading
+
+from .spreadsheet import SpreadSheet, cell_to_xy, xy_to_cell, values_digest
+from .profiler import profiled
+
+logger = logging.getLogger(__name__)
+
+
+class SheetWatcher(object):
+    """
+    基于revision的sheet变化监听：每次轮询先获取表格revision(1次很小的请求)，没变化则跳过；
+    有变化时按block_size行分块读取，计算每块内容的hash，只输出hash变化的块
+    用法：
+        watcher = SheetWatcher(spreadsheet_token='xxx', sheet='xxx', interval=60)
+        for block in watcher:               # 迭代器，阻塞等待变化
+            print(block['row_start'], block['values'])
+    或者：
+        watcher.run(callback)               # 回调，阻塞运行，直到调用watcher.stop()或callback返回False
+    每个block形如{'block': 块序号, 'row_start': 起始行号, 'row_end': 结束行号(行号从0开始), 'values': 二维数组}，
+    sheet行数减少时，多出来的块会输出一次values为[]的block
+    """
+    def __init__(self, spsh=None, spreadsheet_token=None, sheet=0, interval=60, block_size=1000, cell_start='A1',
+                 cell_end=None, emit_initial=True, value_render_option='ToString'):
+        """
+        :param spsh: SpreadSheet实例，默认新建一个
+        :param spreadsheet_token:
+        :param sheet:
+        :param interval: 轮询间隔(秒)
+        :param block_size: 每块的行数，也是单次读取的行数
+        :param cell_start: 监听范围左上角
+        :param cell_end: 监听范围右下角，为None时取sheet的全部行列
+        :param emit_initial: 第1次轮询时是否输出所有块
+        :param value_render_option: 读取方式，见SpreadSheet._read_range
+        """
+        self.spsh = spsh if spsh else SpreadSheet()
+        if spreadsheet_token:
+            self.spsh._set_spreadsheet_token(spreadsheet_token)
+        else:
+            assert getattr(self.spsh, 'spreadsheet_token', None) is not None, '没有spreadsheet_token，需要指定！'
+        self.sheet_id = self.spsh.sheet_index2id.get(sheet, self.spsh.sheet_title2id.get(sheet, sheet))
+        self.interval = interval
+        self.block_size = block_size
+        self.cell_start = cell_start
+        self.cell_end = cell_end
+        self.emit_initial = emit_initial
+        self.value_render_option = value_render_option
+        self.revision = None
+        self.hashes = {}                    # 块序号 -> 内容hash
+        self.stop_event = threading.Event()
+
+    def _block_ranges(self):
+        """
+        按当前元数据计算所有块的范围
+        :return: [(row_start, row_end, cell_start, cell_end), ...]
+        """
+        x_start, y_start = cell_to_xy(self.cell_start)
+        if self.cell_end:
+            x_end, y_end = cell_to_xy(self.cell_end)
+        else:
+            grid_properties = self.spsh.sheets[self.spsh.sheet_id2index[self.sheet_id]]['grid_properties']
+            x_end, y_end = grid_properties['row_count'] - 1, grid_properties['column_count'] - 1
+        return [(x, min(x_end, x + self.block_size - 1), xy_to_cell(x, y_start),
+                 xy_to_cell(min(x_end, x + self.block_size - 1), y_end))
+                for x in range(x_start, x_end + 1, self.block_size)]
+
+    @profiled
+    def poll(self):
+        """
+        轮询1次
+        :return: 内容有变化的块列表，没有变化时返回[]
+        """
+        spsh = self.spsh
+        revision = spsh._get_revision()
+        if revision is not None and revision == self.revision:
+            return []
+        initial = self.revision is None
+        if not self.cell_end:
+            spsh._update_meta_info()        # sheet行列数可能有变化
+        changed = []
+        ranges = self._block_ranges()
+        for i, (row_start, row_end, cell_start, cell_end) in enumerate(ranges):
+            values = spsh._read_range(cell_start, cell_end, self.sheet_id, self.value_render_option)
+            if values is None:
+                logger.error(f'Watch Sheet Failed: sheet_id={self.sheet_id}, range={cell_start}:{cell_end}')
+                return changed      # 不更新revision，下次轮询重试
+            digest = values_digest(values)
+            if self.hashes.get(i) != digest:
+                self.hashes[i] = digest
+                if self.emit_initial or not initial:
+                    changed.append({'block': i, 'row_start': row_start, 'row_end': row_end, 'values': values})
+        for i in sorted(x for x in self.hashes if x >= len(ranges)):
+            del self.hashes[i]
+            changed.append({'block': i, 'row_start': None, 'row_end': None, 'values': []})
+        self.revision = revision
+        logger.info(f'Watch Sheet: sheet_id={self.sheet_id}, revision={revision}, {len(changed)} blocks changed')
+        return changed
+
+    def __iter__(self):
+        while not self.stop_event.is_set():
+            try:
+                blocks = self.poll()
+            except Exception as e:
+                logger.error(f'Watch Sheet Failed: sheet_id={self.sheet_id}, error={e}')
+                blocks = []
+            for block in blocks:
+                yield block
+            self.stop_event.wait(self.interval)
+
+    def run(self, callback):
+        """
+        阻塞运行，每个变化的块调用1次callback(block)，直到调用stop()或callback返回False
+        :param callback:
+        :return:
+        """
+        for block in self:
+            if callback(block) is False:
+                self.stop()
+                break
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def watch(spreadsheet_token, sheet=0, interval=60, callback=None, spsh=None, block_size=1000, cell_start='A1',
+          cell_end=None, emit_initial=True):
+    """
+    监听sheet变化，参数详见SheetWatcher
+    :return: 指定callback时阻塞运行，直到callback返回False；否则返回SheetWatcher，可直接迭代
+    """
+    watcher = SheetWatcher(spsh, spreadsheet_token, sheet, interval, block_size, cell_start, cell_end, emit_initial)
+    if callback is None:
+        return watcher
+    watcher.run(callback)
+    return watcher
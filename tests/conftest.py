@@ -0,0 +1,4 @@
+import os
+
+# feishu.config_util在导入时读取CONFIG_SERVICE_IP，测试不访问配置中心
+os.environ.setdefault('CONFIG_SERVICE_IP', '127.0.0.1')
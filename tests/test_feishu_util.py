@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from feishu import feishu_util
+from feishu.feishu_util import iter_json_array, add_permissions
+
+
+def split(data, size):
+    return [data[i: i + size] for i in range(0, len(data), size)]
+
+
+ROWS = [
+    [1, 'a"]b', None],
+    [2.5, '[x], {y}', True],
+    [-1234567, '反斜杠\\"和中文', {'text': 'a\\b'}],
+    [],
+]
+BODY = json.dumps({'code': 0, 'data': {'valueRange': {'range': 's0!A1:C4', 'values': ROWS}}, 'msg': 'ok'},
+                  ensure_ascii=False).encode('utf-8')
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 64, len(BODY)])
+def test_tokens_split_across_chunks(size):
+    assert list(iter_json_array(split(BODY, size), 'values')) == ROWS
+
+
+def test_escaped_quotes_and_brackets_inside_strings():
+    rows = [['"]', '\\', '[[', '],[', '\\"]\\"']]
+    body = json.dumps({'code': 0, 'data': {'values': rows}}).encode('utf-8')
+    assert list(iter_json_array(split(body, 2), 'values')) == rows
+
+
+def test_multibyte_characters_split_across_chunks():
+    rows = [['飞书表格', '😀']]
+    body = json.dumps({'code': 0, 'data': {'values': rows}}, ensure_ascii=False).encode('utf-8')
+    assert list(iter_json_array(split(body, 1), 'values')) == rows
+
+
+def test_empty_array():
+    assert list(iter_json_array([b'{"code": 0, "data": {"values": []}}'], 'values')) == []
+
+
+def test_error_code_without_array():
+    body = json.dumps({'code': 99991400, 'msg': 'request trigger frequency limit'}).encode('utf-8')
+    with pytest.raises(ValueError, match='99991400'):
+        list(iter_json_array(split(body, 4), 'values'))
+
+
+def test_error_code_with_array():
+    body = json.dumps({'code': 90202, 'data': {'values': [[1]]}, 'msg': 'bad'}).encode('utf-8')
+    with pytest.raises(ValueError, match='90202'):
+        list(iter_json_array(split(body, 4), 'values'))
+
+
+def test_empty_body():
+    with pytest.raises(ValueError):
+        list(iter_json_array([b''], 'values'))
+
+
+def test_truncated_body():
+    with pytest.raises(ValueError, match='Incomplete'):
+        list(iter_json_array(split(b'{"code": 0, "data": {"values": [[1], [2', 3), 'values'))
+
+
+def test_add_permissions_skips_only_listed_member_types(monkeypatch):
+    created = []
+    listed = []
+    monkeypatch.setattr(feishu_util, 'list_permission_members', lambda *args: listed.append(args) or {
+        ('openid', 'ou_1'): 'edit', ('email', 'a@x.com'): 'full_access'})
+    monkeypatch.setattr(feishu_util, '_create_permission_members',
+                        lambda file_token, file_type, token, members: created.extend(members) or {'code': 0, 'data': {}})
+    members = [('openid', 'ou_1'), ('email', 'a@x.com', 'edit')]
+    results = add_permissions(['f1'], 'sheet', 'u', members)
+    assert results[('f1', 'openid', 'ou_1')]['msg'] == 'exists'
+    assert results[('f1', 'email', 'a@x.com')]['msg'] == 'ok'
+    assert created == [('email', 'a@x.com', 'edit')]
+
+    listed.clear()
+    add_permissions(['f1'], 'sheet', 'u', [('email', 'b@x.com')])
+    assert listed == []
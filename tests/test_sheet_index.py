@@ -0,0 +1,59 @@
+import pytest
+
+from feishu import spreadsheet
+from feishu.spreadsheet import SpreadSheet, cell_to_xy
+
+
+def make_spsh(column):
+    """
+    只有1列key的sheet，column包含表头，记录_read_ranges读取的range
+    """
+    spsh = SpreadSheet.__new__(SpreadSheet)
+    spsh.sheets = {0: {'sheet_id': 's0', 'grid_properties': {'row_count': len(column), 'column_count': 1}}}
+    spsh.sheet_index2id, spsh.sheet_title2id, spsh.sheet_id2index = {0: 's0'}, {'Sheet1': 's0'}, {'s0': 0}
+    spsh.reads = []
+
+    def _read_ranges(cells, sheet_id, as_list=False):
+        spsh.reads.extend(cells)
+        result = []
+        for cell_start, cell_end in cells:
+            (x_start, _), (x_end, _) = cell_to_xy(cell_start), cell_to_xy(cell_end)
+            result.append([[v] for v in column[x_start: x_end + 1]])
+        return result
+    spsh._read_ranges = _read_ranges
+    return spsh
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(spreadsheet, 'KEY_READ_MAX_NUM', 2)
+
+
+def test_read_key_index_matches_full_read_after_changes():
+    column = ['id', 'a', 'b', 'c', 'd', None]
+    spsh = make_spsh(column)
+    blocks = {}
+    assert spsh._read_key_index(['id'], ['id'], blocks=blocks) == \
+        ({('a',): 1, ('b',): 2, ('c',): 3, ('d',): 4}, 4)
+    assert sorted(blocks) == [1, 3, 5]
+
+    unchanged = blocks[1]
+    column[3] = 'x'
+    key2row, x_last = spsh._read_key_index(['id'], ['id'], blocks=blocks)
+    assert blocks[1] is unchanged
+    assert key2row == {('a',): 1, ('b',): 2, ('x',): 3, ('d',): 4}
+    assert (key2row, x_last) == make_spsh(column)._read_key_index(['id'], ['id'])
+
+
+def test_read_key_index_drops_stale_blocks_and_keeps_first_duplicate():
+    column = ['id', 'a', 'b', 'c', 'a', 'e']
+    spsh = make_spsh(column)
+    blocks = {}
+    key2row, _ = spsh._read_key_index(['id'], ['id'], blocks=blocks)
+    assert key2row[('a',)] == 1
+
+    del column[3:]
+    spsh.sheets[0]['grid_properties']['row_count'] = len(column)
+    key2row, x_last = spsh._read_key_index(['id'], ['id'], blocks=blocks)
+    assert sorted(blocks) == [1]
+    assert (key2row, x_last) == ({('a',): 1, ('b',): 2}, 2)
@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+from feishu.snapshot import DiffWriter
+
+
+class FakeSpreadSheet(object):
+    """
+    只实现DiffWriter用到的接口，记录写入的range
+    """
+    def __init__(self):
+        self.spreadsheet_token = 'token'
+        self.sheet_index2id = {0: 's0'}
+        self.sheet_title2id = {'Sheet1': 's0'}
+        self.revision = 1
+        self.full_writes = []
+        self.ranges = []
+        self.fail = False
+
+    def _update_meta_info(self):
+        pass
+
+    def _ensure_grid(self, row_count, column_count, sheet=0):
+        pass
+
+    def _write_values(self, values, x_start, y_start, sheet=0, max_num=1000, strict=True):
+        if self.fail:
+            raise ValueError('Write Values Failed')
+        self.full_writes.append(values)
+        return x_start + len(values)
+
+    def _write_ranges_batch(self, ranges, sheet=0):
+        if self.fail:
+            raise ValueError('Write Ranges Failed')
+        self.ranges.extend(ranges)
+        return 1 if ranges else 0
+
+
+def test_diff_writer_writes_only_changed_cells():
+    spsh = FakeSpreadSheet()
+    writer = DiffWriter(spsh)
+    writer.write_df(pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']}))
+    assert len(spsh.full_writes) == 1
+
+    stats = writer.write_df(pd.DataFrame({'a': [1, 5, 3], 'b': ['x', 'y', 'w']}))
+    assert stats == {'cells': 2, 'rects': 2, 'requests': 1}
+    assert spsh.ranges == [('A3', 'A3', [[5]]), ('B4', 'B4', [['w']])]
+
+
+def test_diff_writer_clears_cells_when_data_shrinks():
+    spsh = FakeSpreadSheet()
+    writer = DiffWriter(spsh)
+    writer.write_df(pd.DataFrame({'a': [1, 2, 3]}))
+    writer.write_df(pd.DataFrame({'a': [1]}))
+    assert spsh.ranges == [('A3', 'A4', [[None], [None]])]
+
+
+def test_diff_writer_drops_snapshot_on_failure():
+    spsh = FakeSpreadSheet()
+    writer = DiffWriter(spsh)
+    writer.write_df(pd.DataFrame({'a': [1, 2]}))
+    spsh.fail = True
+    with pytest.raises(ValueError):
+        writer.write_df(pd.DataFrame({'a': [1, 3]}))
+    assert writer.snapshots == {}
+
+    spsh.fail = False
+    writer.write_df(pd.DataFrame({'a': [1, 3]}))
+    assert len(spsh.full_writes) == 2       # 快照被丢弃，整体重写
@@ -0,0 +1,147 @@
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from feishu import spreadsheet
+from feishu.spreadsheet import cells_to_rects, rects_to_ranges, decode_column, WRITE_MAX_ROWS, WRITE_MAX_COLUMNS
+
+
+def test_cells_to_rects_merges_adjacent_cells():
+    cells = {(0, 0), (0, 1), (1, 0), (1, 1), (5, 3)}
+    assert cells_to_rects(cells) == [(0, 0, 1, 1), (5, 3, 5, 3)]
+
+
+def test_cells_to_rects_single_row_and_column():
+    assert cells_to_rects({(2, y) for y in range(3, 8)}) == [(2, 3, 2, 7)]
+    assert cells_to_rects({(x, 4) for x in range(10, 20)}) == [(10, 4, 19, 4)]
+
+
+def test_cells_to_rects_duplicate_cells():
+    assert cells_to_rects([(0, 0), (0, 0), (0, 1), (0, 1)]) == [(0, 0, 0, 1)]
+
+
+def test_cells_to_rects_does_not_merge_across_gaps():
+    cells = {(0, 0), (0, 2), (2, 0)}
+    assert cells_to_rects(cells) == [(0, 0, 0, 0), (0, 2, 0, 2), (2, 0, 2, 0)]
+
+
+def test_cells_to_rects_overlapping_shapes():
+    # L形：第0~1行的A:C与第2行的A:A，列范围不同的行不合并
+    cells = {(x, y) for x in range(2) for y in range(3)} | {(2, 0)}
+    rects = cells_to_rects(cells)
+    assert rects == [(0, 0, 1, 2), (2, 0, 2, 0)]
+    covered = {(x, y) for a, b, c, d in rects for x in range(a, c + 1) for y in range(b, d + 1)}
+    assert covered == cells
+
+
+def test_cells_to_rects_reopens_column_range_after_break():
+    cells = {(0, 0), (1, 0), (2, 1), (3, 0)}
+    assert cells_to_rects(cells) == [(0, 0, 1, 0), (2, 1, 2, 1), (3, 0, 3, 0)]
+
+
+def test_cells_to_rects_empty():
+    assert cells_to_rects(set()) == []
+
+
+def test_rects_to_ranges_values_and_offset():
+    ranges = rects_to_ranges([(0, 0, 1, 1)], lambda x, y: x * 10 + y, x_offset=2, y_offset=1)
+    assert ranges == [('B3', 'C4', [[0, 1], [10, 11]])]
+
+
+def test_rects_to_ranges_splits_wide_rect():
+    width = WRITE_MAX_COLUMNS + 5
+    ranges = rects_to_ranges([(0, 0, 0, width - 1)], lambda x, y: y)
+    assert len(ranges) == 2
+    assert [len(values[0]) for _, _, values in ranges] == [WRITE_MAX_COLUMNS, 5]
+    assert ranges[1][2][0][0] == WRITE_MAX_COLUMNS
+    assert sum(sum(row) for _, _, values in ranges for row in values) == sum(range(width))
+
+
+def test_rects_to_ranges_splits_tall_rect():
+    ranges = rects_to_ranges([(0, 0, WRITE_MAX_ROWS, 0)], lambda x, y: x)
+    assert [(start, end) for start, end, _ in ranges] == [('A1', f'A{WRITE_MAX_ROWS}'),
+                                                          (f'A{WRITE_MAX_ROWS + 1}', f'A{WRITE_MAX_ROWS + 1}')]
+
+
+@pytest.mark.parametrize('dtype', ['int64', np.dtype('int64'), np.int64])
+def test_decode_column_numpy_int_dtypes(dtype):
+    series = decode_column([1, 2.0, '3'], dtype)
+    assert series.dtype == np.dtype('int64')
+    assert series.tolist() == [1, 2, 3]
+
+
+@pytest.mark.parametrize('dtype', ['float64', np.dtype('float64'), np.float32])
+def test_decode_column_numpy_float_dtypes(dtype):
+    series = decode_column([1, None, '2.5', ''], dtype)
+    assert series.dtype == np.dtype(dtype)
+    assert series.iloc[0] == 1 and np.isnan(series.iloc[1]) and series.iloc[2] == 2.5 and np.isnan(series.iloc[3])
+
+
+@pytest.mark.parametrize('dtype', ['Int64', pd.Int64Dtype()])
+def test_decode_column_nullable_int_dtypes(dtype):
+    series = decode_column([1, None, '3'], dtype)
+    assert series.dtype == pd.Int64Dtype()
+    assert series.tolist() == [1, pd.NA, 3]
+
+
+@pytest.mark.parametrize('dtype', ['object', object, np.dtype('O')])
+def test_decode_column_object_dtypes_keep_values(dtype):
+    series = decode_column([1, 'a', True, None], dtype)
+    assert series.dtype == object
+    assert series.tolist() == [1, 'a', True, None]
+
+
+@pytest.mark.parametrize('dtype', ['category', pd.CategoricalDtype()])
+def test_decode_column_category_dtypes(dtype):
+    series = decode_column(['a', 'b', 'a'], dtype)
+    assert series.dtype == 'category'
+    assert series.tolist() == ['a', 'b', 'a']
+
+
+@pytest.mark.parametrize('dtype', ['datetime64[ns]', np.dtype('datetime64[ns]')])
+def test_decode_column_datetime_dtypes(dtype):
+    series = decode_column(['2024-01-02', None, ''], dtype)
+    assert series.dtype == np.dtype('datetime64[ns]')
+    assert series.iloc[0] == pd.Timestamp('2024-01-02') and series.isna().tolist() == [False, True, True]
+
+
+def test_decode_column_infers_numeric_columns():
+    assert decode_column([1, 2, 3]).dtype == np.dtype('int64')
+    assert decode_column([1, None, 2.5]).dtype == np.dtype('float64')
+
+
+@pytest.mark.parametrize('values', [[1, 2, True], [1, '12', 3], [True, None, 2.5], [1.5, 'x']])
+def test_decode_column_mixed_columns_stay_object(values):
+    series = decode_column(values)
+    assert series.dtype == object
+    assert series.tolist() == values
+
+
+def test_decode_column_mixed_column_with_numeric_dtype():
+    series = decode_column([1, '12', 'x', None], 'float64')
+    assert series.tolist()[:2] == [1.0, 12.0]
+    assert series.isna().tolist() == [False, False, True, True]
+
+
+def test_decode_column_without_inference_keeps_text():
+    assert decode_column([1, '2'], infer_types=False).tolist() == [1, '2']
+
+
+def test_import_optional_reports_missing_and_old_versions(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(ImportError, match=r'pyarrow>=14\.0'):
+        spreadsheet.import_optional('pyarrow', "output='arrow'")
+    monkeypatch.setitem(sys.modules, 'polars', types.SimpleNamespace(__version__='0.19.12'))
+    with pytest.raises(ImportError, match='0.19.12'):
+        spreadsheet.concat_outputs([None], output='polars')
+
+
+def test_concat_outputs_arrow_promotes_types():
+    pytest.importorskip('pyarrow', minversion='14.0')
+    parts = [spreadsheet.build_output([[1, 2]], ['a'], output='arrow'),
+             spreadsheet.build_output([[2.5]], ['b'], output='arrow')]
+    table = spreadsheet.concat_outputs(parts, output='arrow')
+    assert table.column_names == ['a'] and table.column('a').to_pylist() == [1, 2, 2.5]
@@ -0,0 +1,34 @@
+import io
+import json
+
+import requests
+
+from feishu import transport
+
+
+def make_response(status_code, body, headers=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.raw = io.BytesIO(json.dumps(body).encode('utf-8'))
+    resp.headers.update(headers or {})
+    return resp
+
+
+def test_stream_read_retries_rate_limit_code(monkeypatch):
+    responses = [
+        make_response(400, {'code': transport.RATE_LIMIT_CODE, 'msg': 'frequency limit'}, {'Retry-After': '0'}),
+        make_response(200, {'code': 0, 'data': {'valueRange': {'values': [[1]]}}}),
+    ]
+    monkeypatch.setattr(transport.requests, 'request', lambda method, url, **kwargs: responses.pop(0))
+    resp = transport.get('https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/x/values/s0!A1:A1', stream=True)
+    assert resp.status_code == 200
+    assert not responses
+    assert b''.join(resp.iter_content(4)) == b'{"code": 0, "data": {"valueRange": {"values": [[1]]}}}'
+
+
+def test_stream_read_keeps_other_errors(monkeypatch):
+    responses = [make_response(400, {'code': 90202, 'msg': 'bad range'})]
+    monkeypatch.setattr(transport.requests, 'request', lambda method, url, **kwargs: responses.pop(0))
+    resp = transport.get('https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/x/values/s0!A1:A1', stream=True)
+    assert resp.status_code == 400
+    assert json.loads(b''.join(resp.iter_content(4)))['code'] == 90202